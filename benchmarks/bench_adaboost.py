@@ -0,0 +1,42 @@
+"""Benchmark fitting and predicting with the AdaBoost classifier.
+
+Fit ``adaboost.AdaBoost`` with trees of several depths to synthetic
+features, with distinct and with repeated values, and time the fit and
+the prediction of new samples.
+
+Run from the repository root::
+
+    python benchmarks/bench_adaboost.py --samples 2000 --features 30
+"""
+
+import argparse
+
+import numpy as np
+
+from gala.adaboost import AdaBoost
+from bench_util import timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--features', type=int, default=30)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 3])
+    args = parser.parse_args()
+    rs = np.random.RandomState(0)
+    n, m = args.samples, args.features
+    for name, X in [('distinct', rs.randn(n, m)),
+                    ('repeated', rs.randint(10, size=(n, m)).astype(float))]:
+        y = np.where(X[:, 0] + X[:, 1] * X[:, 2] + rs.randn(n) > 0, 1, -1)
+        X_new = rs.randn(n, m)
+        for depth in args.depths:
+            ab, t_fit = timed(AdaBoost().fit, X, y, depth=depth,
+                              T=args.rounds)
+            p, t_predict = timed(ab.predict_proba, X_new)
+            print('%-8s depth %d: fit %6.2fs, predict %d samples %7.4fs'
+                  % (name, depth, t_fit, n, t_predict))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark loading a classifier in several worker processes.
+
+Fit a random forest and save it compressed with joblib, the default of
+``save_classifier``, uncompressed with joblib, and flat. Then start
+several processes at once, each loading the classifier with
+``load_classifier`` and predicting a batch of rows, as segmentation
+workers would, and report each worker's load time and private memory.
+Pages of the memory-mapped flat file are shared between the workers,
+so they do not count towards private memory.
+
+Run from the repository root::
+
+    python benchmarks/bench_classifier_io.py --trees 100 --workers 4
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from gala import classify
+from bench_util import timed
+
+
+def private_bytes():
+    """Return the memory of this process not shared with any other."""
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_'):
+                total += int(line.split()[1]) * 1024
+    return total
+
+
+def _worker(fn, X, barrier, queue):
+    start = private_bytes()
+    cl, t = timed(classify.load_classifier, fn)
+    p = cl.predict_proba(X)
+    barrier.wait()  # all workers hold the classifier at once
+    queue.put((t, private_bytes() - start))
+
+
+def load_in_workers(fn, X, num_workers):
+    """Return the mean load time and private bytes of concurrent workers."""
+    queue = multiprocessing.Queue()
+    barrier = multiprocessing.Barrier(num_workers) \
+              if hasattr(multiprocessing, 'Barrier') else _Barrier(num_workers)
+    workers = [multiprocessing.Process(target=_worker,
+                                       args=(fn, X, barrier, queue))
+               for i in range(num_workers)]
+    for w in workers:
+        w.start()
+    results = [queue.get() for w in workers]
+    for w in workers:
+        w.join()
+    return np.mean(results, axis=0)
+
+
+class _Barrier(object):
+    """A process barrier, which Python 2 lacks."""
+    def __init__(self, parties):
+        self.parties = parties
+        self.count = multiprocessing.Value('i', 0)
+        self.event = multiprocessing.Event()
+
+    def wait(self):
+        with self.count.get_lock():
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.event.set()
+        self.event.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--trees', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=50000)
+    parser.add_argument('--features', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    rs = np.random.RandomState(0)
+    X = rs.rand(args.samples, args.features)
+    y = (X[:, 0] + X[:, 1] * X[:, 2] + rs.rand(args.samples) > 1.2)
+    rf = classify.DefaultRandomForest(n_estimators=args.trees,
+                                      random_state=0).fit(X, y.astype(int))
+    X_new = rs.rand(1000, args.features)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, kwargs in [('joblib compress=3', {}),
+                             ('joblib uncompressed', {'compress': 0}),
+                             ('flat', {'flat': True})]:
+            fn = os.path.join(tmpdir, name.replace(' ', '-'))
+            classify.save_classifier(rf, fn, **kwargs)
+            t, private = load_in_workers(fn, X_new, args.workers)
+            print('%-20s %7.1f MB on disk; per worker: load %6.3fs, '
+                  'private memory %7.1f MB' % (name,
+                  os.path.getsize(fn) / 2.0**20, t, private / 2.0**20))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
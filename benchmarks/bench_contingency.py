@@ -0,0 +1,61 @@
+"""Benchmark the memory and time of learning with a large ground truth.
+
+Build a ``Rag`` from a synthetic superpixel map, and learn the
+agglomeration of its superpixels into a synthetic ground truth with
+many bodies, each time in a fresh process. The graph is built with the
+ground truth too, so that it tracks its contingency table and split VI
+through the agglomeration epochs.
+
+The reported peak resident memory is net of the memory in use before
+the graph is built. Run from the repository root, optionally with an
+older version of gala on the ``PYTHONPATH`` for comparison::
+
+    python benchmarks/bench_contingency.py --seeds 20000 --gt-seeds 2000
+"""
+
+import argparse
+import resource
+import multiprocessing
+
+from gala import agglo, features
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def _learn(ws, probs, gt, queue):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fm = features.moments.Manager()
+    g, t_build = timed(agglo.Rag, ws, probs, feature_manager=fm, gt_vol=gt)
+    (data, _), t_learn = timed(g.learn_agglomerate, gt, fm,
+                               priority_mode='mean', min_num_epochs=2)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(((peak - start) * 1024, t_build, t_learn, len(data[0])))
+
+
+def measure(ws, probs, gt):
+    """Return the peak bytes, build and learning times, and sample count."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_learn, args=(ws, probs, gt, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[40, 200, 200])
+    parser.add_argument('--seeds', type=int, default=20000)
+    parser.add_argument('--gt-seeds', type=int, default=2000)
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    ws = synthetic_watershed(shape, args.seeds, boundaries=True)
+    gt = synthetic_watershed(shape, args.gt_seeds, seed=1)
+    peak, t_build, t_learn, n = measure(ws, synthetic_probabilities(ws), gt)
+    print('%d superpixels, %d bodies' % (args.seeds, args.gt_seeds))
+    print('peak memory %.1f MB, build %.2fs, learn %.2fs, %d samples' %
+          (peak / 2.0**20, t_build, t_learn, n))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Benchmark copying a graph, and learning with a copy per epoch.
+
+Build a ``Rag`` with moment and histogram features from a synthetic
+superpixel map, then time ``Rag.copy`` and ``Rag.learn_agglomerate``,
+which agglomerates a fresh copy of the graph in every epoch. The
+reported peak resident memory of a copy is the growth of the memory
+in use while copying, measured in a fresh process.
+
+Run from the repository root, optionally with an older version of gala
+on the ``PYTHONPATH`` for comparison::
+
+    python benchmarks/bench_copy.py --shape 60 300 300 --seeds 8000
+"""
+
+import argparse
+import resource
+import multiprocessing
+
+from gala import agglo, features
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def _copy(g, queue):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    h, t = timed(g.copy)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(((peak - start) * 1024, t))
+
+
+def measure_copy(g):
+    """Return the peak bytes and time of copying `g`."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_copy, args=(g, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[60, 300, 300])
+    parser.add_argument('--seeds', type=int, default=8000)
+    parser.add_argument('--gt-seeds', type=int, default=800)
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    ws = synthetic_watershed(shape, args.seeds, boundaries=True)
+    gt = synthetic_watershed(shape, args.gt_seeds, seed=1)
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    g = agglo.Rag(ws, synthetic_probabilities(ws), feature_manager=fm,
+                  compact=True)
+    peak, t_copy = measure_copy(g)
+    print('copy: %.2fs, peak memory %.1f MB' % (t_copy, peak / 2.0**20))
+    (data, _), t_learn = timed(g.learn_agglomerate, gt, fm,
+                               min_num_epochs=args.epochs,
+                               max_num_epochs=args.epochs,
+                               priority_mode='mean', unique=False)
+    print('learn_agglomerate: %d epochs, %.2fs, %d samples' %
+          (args.epochs, t_learn, len(data[0])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Benchmark fitting the classifier of each learning epoch.
+
+Run ``Rag.learn_agglomerate`` in active mode on a synthetic volume with
+moment and histogram features, once refitting a new random forest to
+all the data in every epoch, and once warm-starting the forest with
+trees fitted to the latest epoch, and report the fit time and number of
+samples of each epoch, recorded by ``classify.EpochTrainer``.
+
+Run from the repository root::
+
+    python benchmarks/bench_epochs.py --shape 40 200 200 --epochs 5
+"""
+
+import argparse
+
+from gala import agglo, classify, features
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[40, 200, 200])
+    parser.add_argument('--seeds', type=int, default=4000)
+    parser.add_argument('--gt-seeds', type=int, default=400)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--new-trees', type=int, default=20)
+    parser.add_argument('--jobs', type=int, default=1)
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    ws = synthetic_watershed(shape, args.seeds, boundaries=True)
+    gt = synthetic_watershed(shape, args.gt_seeds, seed=1)
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    g = agglo.Rag(ws, synthetic_probabilities(ws), feature_manager=fm)
+    for warm_start in [False, True]:
+        trainer = classify.EpochTrainer(warm_start=warm_start,
+                                        n_jobs=args.jobs,
+                                        new_trees=args.new_trees,
+                                        random_state=0)
+        (data, alldata), t = timed(g.learn_agglomerate, gt, fm,
+                                   min_num_epochs=args.epochs,
+                                   max_num_epochs=args.epochs,
+                                   trainer=trainer)
+        print('%s: %.2fs, %d samples' % ('warm start' if warm_start
+                                         else 'refit', t, len(data[0])))
+        for i, fit in enumerate(trainer.history):
+            print('  fit %d: %6d of %6d samples, %3d trees, %6.2fs' %
+                  (i + 1, fit['samples'], fit['total_samples'], fit['trees'],
+                   fit['fit_time']))
+        print('  total fit time: %.2fs' %
+              sum(fit['fit_time'] for fit in trainer.history))
+
+
+if __name__ == '__main__':
+    main()
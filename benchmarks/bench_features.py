@@ -0,0 +1,68 @@
+"""Benchmark feature cache initialization.
+
+Report the time taken to set up the node and edge feature caches of a
+``Rag`` with the moments and histogram feature managers, on the example
+test volume and on a synthetic Voronoi volume, with Python-set and with
+compact voxel storage.
+
+Run from the repository root::
+
+    python benchmarks/bench_features.py --shape 50 200 200 --seeds 2000
+"""
+
+import os
+import argparse
+
+from gala import agglo, features, imio
+from bench_util import (synthetic_watershed, synthetic_probabilities,
+                        thin_boundaries, timed)
+
+
+D = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', 'tests', 'example-data')
+
+
+def cache_setup_time(ws, probs, feature_manager, compact=False):
+    """Return the time spent creating the feature caches of a Rag."""
+    times = []
+    compute_feature_caches = agglo.Rag.compute_feature_caches
+    def timed_compute_feature_caches(g):
+        times.append(timed(compute_feature_caches, g)[1])
+    agglo.Rag.compute_feature_caches = timed_compute_feature_caches
+    try:
+        agglo.Rag(ws, probs, feature_manager=feature_manager,
+                  compact=compact)
+    finally:
+        agglo.Rag.compute_feature_caches = compute_feature_caches
+    return sum(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[50, 200, 200])
+    parser.add_argument('--seeds', type=int, default=2000)
+    args = parser.parse_args()
+    ws = imio.read_h5_stack(os.path.join(D, 'test-ws.lzf.h5'))
+    probs = imio.read_h5_stack(os.path.join(D, 'test-p1.lzf.h5'))
+    synthetic = synthetic_watershed(tuple(args.shape), args.seeds)
+    volumes = [('example', ws, probs),
+               ('synthetic', synthetic, synthetic_probabilities(synthetic))]
+    synthetic = thin_boundaries(synthetic)
+    volumes.append(('synthetic-0', synthetic,
+                    synthetic_probabilities(synthetic)))
+    managers = [('moments', features.moments.Manager()),
+                ('histogram', features.histogram.Manager()),
+                ('composite', features.base.Composite(children=[
+                    features.moments.Manager(),
+                    features.histogram.Manager()]))]
+    for name, ws, probs in volumes:
+        for fm_name, fm in managers:
+            t = cache_setup_time(ws, probs, fm)
+            t_compact = cache_setup_time(ws, probs, fm, compact=True)
+            print('%-12s %-10s %7.3fs  compact %7.3fs' %
+                  (name, fm_name, t, t_compact))
+
+
+if __name__ == '__main__':
+    main()
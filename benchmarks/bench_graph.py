@@ -0,0 +1,55 @@
+"""Benchmark region adjacency graph construction.
+
+Report the throughput, in voxels per second, of
+``agglo.Rag.build_graph_from_watershed`` on the example test volume and
+on a synthetic Voronoi volume, with and without 0-labeled boundaries.
+
+Run from the repository root::
+
+    python benchmarks/bench_graph.py --shape 100 200 200 --seeds 2000
+"""
+
+import os
+import argparse
+
+from gala import agglo, imio
+from bench_util import synthetic_watershed, thin_boundaries, timed
+
+
+D = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', 'tests', 'example-data')
+
+
+def graph_build_rate(ws, **kwargs):
+    """Return the voxels per second of a graph build on watershed `ws`."""
+    g = agglo.Rag(ws, **kwargs)
+    g.clear()
+    _, t = timed(g.build_graph_from_watershed,
+                 kwargs.get('allow_shared_boundaries', True),
+                 nozerosfast=kwargs.get('nozeros', False))
+    return g.watershed.size / t, g.number_of_nodes(), g.number_of_edges()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[50, 200, 200])
+    parser.add_argument('--seeds', type=int, default=1000)
+    args = parser.parse_args()
+    example = imio.read_h5_stack(os.path.join(D, 'test-ws.lzf.h5'))
+    synthetic = synthetic_watershed(tuple(args.shape), args.seeds)
+    volumes = [('example', example), ('synthetic', synthetic)]
+    for name, ws in volumes:
+        for label, ws_, kwargs in [
+                ('no boundaries', ws, {}),
+                ('nozeros', ws, {'nozeros': True}),
+                ('thin boundaries', thin_boundaries(ws), {}),
+                ('unshared boundaries', thin_boundaries(ws),
+                                    {'allow_shared_boundaries': False})]:
+            rate, nn, ne = graph_build_rate(ws_, **kwargs)
+            print('%-10s %-20s %9.0f voxels/s (%d nodes, %d edges)' %
+                  (name, label, rate, nn, ne))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Benchmark labeling all the edges of a graph against a ground truth.
+
+Build a ``Rag`` from a synthetic superpixel map with the moments and
+histogram feature managers, and time ``learn_flat`` against a synthetic
+ground truth, which computes the features, weights, and labels of every
+edge of the graph.
+
+Run from the repository root, optionally with an older version of gala
+on the ``PYTHONPATH`` for comparison::
+
+    python benchmarks/bench_learn_flat.py --shape 40 200 200 --seeds 8000
+"""
+
+import argparse
+
+from gala import agglo, features
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[40, 200, 200])
+    parser.add_argument('--seeds', type=int, default=8000)
+    parser.add_argument('--gt-seeds', type=int, default=800)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    ws = synthetic_watershed(shape, args.seeds, boundaries=True)
+    gt = synthetic_watershed(shape, args.gt_seeds, seed=1)
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    g = agglo.Rag(ws, synthetic_probabilities(ws), feature_manager=fm)
+    times = []
+    for i in range(args.repeats):
+        data, t = timed(g.learn_flat, gt, fm)
+        times.append(t)
+    print('%d edges, %d features' % data[0].shape)
+    print('learn_flat: best %.2fs of %d' % (min(times), args.repeats))
+
+
+if __name__ == '__main__':
+    main()
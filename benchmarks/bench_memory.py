@@ -0,0 +1,87 @@
+"""Benchmark the memory used by Rag boundary and extent storage.
+
+For each volume, build a ``Rag`` with Python-set storage and with compact
+(``compact=True``) storage, and report:
+
+- the bytes held by the edge boundaries after construction, and
+- the peak resident memory of the construction, measured in a fresh
+  process and net of the memory used by the input volumes.
+
+Run from the repository root::
+
+    python benchmarks/bench_memory.py --shape 64 256 256 --seeds 5000
+"""
+
+import os
+import sys
+import argparse
+import resource
+import multiprocessing
+
+from gala import agglo, imio
+from gala.indexset import IndexSet
+from bench_util import (synthetic_watershed, synthetic_probabilities,
+                        thin_boundaries)
+
+
+D = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', 'tests', 'example-data')
+
+
+def set_nbytes(s):
+    """Return the bytes used by a set of voxel indices, elements included."""
+    if isinstance(s, IndexSet):
+        return sys.getsizeof(s) + s.nbytes
+    return sys.getsizeof(s) + sum(sys.getsizeof(i) for i in s)
+
+
+def boundary_nbytes(g):
+    return sum(set_nbytes(g[u][v]['boundary']) for u, v in g.edges_iter())
+
+
+def _build(ws, probs, compact, queue):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    g = agglo.Rag(ws, probs, compact=compact)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((boundary_nbytes(g), (peak - start) * 1024,
+               sum(len(g[u][v]['boundary']) for u, v in g.edges_iter())))
+
+
+def measure(ws, probs, compact):
+    """Return boundary bytes, peak build bytes and total boundary length."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_build,
+                                args=(ws, probs, compact, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[64, 256, 256])
+    parser.add_argument('--seeds', type=int, default=5000)
+    args = parser.parse_args()
+    volumes = []
+    for name in ['train', 'test']:
+        ws = imio.read_h5_stack(os.path.join(D, name + '-ws.lzf.h5'))
+        probs = imio.read_h5_stack(os.path.join(D, name + '-p1.lzf.h5'))
+        volumes.append((name, ws, probs))
+    ws = synthetic_watershed(tuple(args.shape), args.seeds)
+    volumes.append(('synthetic', ws, synthetic_probabilities(ws)))
+    ws = thin_boundaries(ws)
+    volumes.append(('synthetic-0', ws, synthetic_probabilities(ws)))
+    print('%-12s %10s %12s %12s %12s %12s' % ('volume', 'boundary',
+          'sets (MB)', 'compact (MB)', 'peak sets', 'peak compact'))
+    for name, ws, probs in volumes:
+        set_bytes, set_peak, total = measure(ws, probs, False)
+        compact_bytes, compact_peak, _ = measure(ws, probs, True)
+        print('%-12s %10d %12.1f %12.1f %12.1f %12.1f' % (name, total,
+              set_bytes / 2.0**20, compact_bytes / 2.0**20,
+              set_peak / 2.0**20, compact_peak / 2.0**20))
+
+
+if __name__ == '__main__':
+    main()
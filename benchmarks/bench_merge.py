@@ -0,0 +1,51 @@
+"""Benchmark node merging when agglomerating into high-degree bodies.
+
+Agglomerate synthetic Voronoi volumes without 0-labeled boundaries (so
+that no boundary refinement takes place) to a single body, with mean
+boundary priority, and report the total time, the time spent renaming
+merged nodes (``Rag.rename_node``), and the largest node degree seen.
+
+Run from the repository root::
+
+    python benchmarks/bench_merge.py --shape 40 200 200 --seeds 2000 8000
+"""
+
+import argparse
+
+import numpy as np
+
+from gala import agglo
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def merge_time(ws, probs):
+    """Return the number of merges, total and renaming time, and degree."""
+    times, degrees = [], []
+    rename = agglo.Rag.rename_node
+    def timed_rename(g, old, new):
+        degrees.append(g.degree(old))
+        times.append(timed(rename, g, old, new)[1])
+    agglo.Rag.rename_node = timed_rename
+    try:
+        g = agglo.Rag(ws, probs, nozeros=True)
+        _, t = timed(g.agglomerate, np.inf)
+    finally:
+        agglo.Rag.rename_node = rename
+    return len(times), t, sum(times), max(degrees)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[40, 200, 200])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[2000, 8000])
+    args = parser.parse_args()
+    for num_seeds in args.seeds:
+        ws = synthetic_watershed(tuple(args.shape), num_seeds) + 1
+        n, t, t_rename, degree = merge_time(ws, synthetic_probabilities(ws))
+        print('%5d seeds  %5d merges  %7.2fs total  %6.2fs renaming  '
+              'max degree %d' % (num_seeds, n, t, t_rename, degree))
+
+
+if __name__ == '__main__':
+    main()
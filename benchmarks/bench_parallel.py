@@ -0,0 +1,40 @@
+"""Benchmark building a Rag in several processes.
+
+Build a ``Rag`` with the moments and histogram feature managers from a
+synthetic volume, first serially and in memory, then from slabs built
+in pools of 1 to N worker processes (``nprocessors``), with one slab
+per process. The input arrays are shared with the workers, not copied.
+
+Run from the repository root::
+
+    python benchmarks/bench_parallel.py --shape 64 256 256 --nprocessors 1 2 4 8
+"""
+
+import argparse
+
+from gala import agglo, features
+from bench_util import (synthetic_watershed, synthetic_probabilities,
+                        thin_boundaries, timed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[64, 256, 256])
+    parser.add_argument('--seeds', type=int, default=5000)
+    parser.add_argument('--nprocessors', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    ws = thin_boundaries(synthetic_watershed(tuple(args.shape), args.seeds))
+    probs = synthetic_probabilities(ws)
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    _, serial = timed(agglo.Rag, ws, probs, feature_manager=fm)
+    print('%-12s %8.2fs' % ('serial', serial))
+    for n in args.nprocessors:
+        _, t = timed(agglo.Rag, ws, probs, feature_manager=fm, nprocessors=n)
+        print('%-12s %8.2fs  %5.2fx' % ('%d processes' % n, t, serial / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Benchmark the latency of classifier predictions on small batches.
+
+Time ``predict_proba`` on batches of rows of the shipped training set,
+from a single row up, with the shipped random forest (or an AdaBoost
+ensemble fitted to the same data) and with its ``classify.FlatForest``,
+and check that both give the same probabilities.
+
+Run from the repository root::
+
+    python benchmarks/bench_predict.py --channels 1 --sizes 1 4 16 256
+"""
+
+import os
+import argparse
+import timeit
+
+import numpy as np
+
+from gala import classify
+from bench_priority import D, load_random_forest
+
+
+def latency(function, X, repeats):
+    """Return the best time of `repeats` calls of `function` on `X`."""
+    return min(timeit.repeat(lambda: function(X), number=1, repeat=repeats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--channels', type=int, choices=[1, 4], default=1)
+    parser.add_argument('--classifier', choices=['rf', 'adaboost'],
+                        default='rf')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 4, 16, 256])
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+    training = np.load(os.path.join(D, 'train-set-%i.npz' % args.channels))
+    X, y = training['X'], training['y'][:, 0]
+    if args.classifier == 'rf':
+        cl = load_random_forest(args.channels)
+    else:
+        cl = classify.AdaBoost().fit(X, y, depth=3, T=100)
+    flat = classify.FlatForest(cl)
+    rows = np.random.RandomState(0).permutation(len(X))
+    print('%6s %12s %12s %8s' % ('rows', 'original', 'flat', 'speedup'))
+    for size in args.sizes:
+        batch = X[rows[:size]]
+        t0 = latency(cl.predict_proba, batch, args.repeats)
+        t1 = latency(flat.predict_proba, batch, args.repeats)
+        print('%6d %10.3fms %10.3fms %7.0fx' % (size, 1e3 * t0, 1e3 * t1,
+                                                t0 / t1))
+    same = np.allclose(cl.predict_proba(X), flat.predict_proba(X),
+                       rtol=0, atol=1e-12)
+    print('same probabilities: %s' % same)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Benchmark classifier-driven agglomeration of the example volume.
+
+Time ``Rag.agglomerate`` on the example test volume with a shipped random
+forest, scoring edges one at a time and in batches, and check that both
+modes make the same merges.
+
+If the shipped classifier cannot be loaded (for example, because it was
+pickled by another scikit-learn version), an equivalent
+``DefaultRandomForest`` is fitted to the matching shipped training set.
+
+Run from the repository root::
+
+    python benchmarks/bench_priority.py --channels 1
+"""
+
+import os
+import argparse
+
+import numpy as np
+
+from gala import agglo, classify, features, imio
+from bench_util import timed
+
+
+D = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', 'tests', 'example-data')
+
+
+def load_random_forest(channels):
+    try:
+        return classify.load_classifier(
+                        os.path.join(D, 'rf-%i.joblib' % channels))
+    except Exception as e:
+        print('could not load rf-%i.joblib (%s); refitting' % (channels, e))
+        training = np.load(os.path.join(D, 'train-set-%i.npz' % channels))
+        return classify.DefaultRandomForest(random_state=0).fit(
+                                        training['X'], training['y'][:, 0])
+
+
+def unbatched(priority_function):
+    """Return `priority_function` without its batched evaluation."""
+    def predict(g, n1, n2):
+        return priority_function(g, n1, n2)
+    return predict
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--channels', type=int, choices=[1, 4], default=1)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+    ws = imio.read_h5_stack(os.path.join(D, 'test-ws.lzf.h5'))
+    probs = imio.read_h5_stack(os.path.join(D,
+                                            'test-p%i.lzf.h5' % args.channels))
+    fc = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    rf = load_random_forest(args.channels)
+    policy = agglo.classifier_probability(fc, rf)
+    results = []
+    for name, mpf in [('per edge', unbatched(policy)), ('batched', policy)]:
+        g = agglo.Rag(ws, probs, mpf, feature_manager=fc)
+        history, t = timed(g.agglomerate, args.threshold, save_history=True)
+        results.append(history)
+        print('%-10s %7.2fs  %d merges' % (name, t, len(history[0])))
+    print('same merges: %s' % (results[0][0] == results[1][0] and
+                               np.array_equal(results[0][1], results[1][1])))
+
+
+if __name__ == '__main__':
+    main()
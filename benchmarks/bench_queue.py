@@ -0,0 +1,63 @@
+"""Benchmark merge queue churn during agglomeration.
+
+Agglomerate the example test volume and a synthetic Voronoi volume with
+mean boundary priority up to a threshold, and report the agglomeration
+time, the peak number of entries held by the merge queue against the
+number of live edges, and the queue counters (pushes, in-place updates,
+removals and stale pops).
+
+Run from the repository root::
+
+    python benchmarks/bench_queue.py --shape 30 150 150 --seeds 2000
+"""
+
+import os
+import argparse
+
+from gala import agglo, imio
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+D = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', 'tests', 'example-data')
+
+
+def agglomerate_churn(g, threshold):
+    """Agglomerate `g` to `threshold`; return peak queue entries and edges."""
+    g.rebuild_merge_queue()
+    mq = g.merge_queue
+    peak_entries, peak_live = len(mq.q), len(mq)
+    while len(mq) > 0 and mq.peek()[0] < threshold:
+        merge_priority, _, n1, n2 = mq.pop()
+        g.merge_nodes(n1, n2, merge_priority)
+        peak_entries = max(peak_entries, len(mq.q))
+        peak_live = max(peak_live, len(mq))
+    return peak_entries, peak_live
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[30, 150, 150])
+    parser.add_argument('--seeds', type=int, default=2000)
+    parser.add_argument('--threshold', type=float, default=0.95)
+    args = parser.parse_args()
+    ws = imio.read_h5_stack(os.path.join(D, 'test-ws.lzf.h5'))
+    probs = imio.read_h5_stack(os.path.join(D, 'test-p1.lzf.h5'))
+    synthetic = synthetic_watershed(tuple(args.shape), args.seeds)
+    volumes = [('example', ws, probs),
+               ('synthetic', synthetic, synthetic_probabilities(synthetic))]
+    for name, ws, probs in volumes:
+        g = agglo.Rag(ws, probs)
+        (peak_entries, peak_live), t = timed(agglomerate_churn, g,
+                                               args.threshold)
+        mq = g.merge_queue
+        print('%-10s %7.2fs  peak entries %7d  peak live %7d' %
+              (name, t, peak_entries, peak_live))
+        print('%-10s pushes %d  updates %d  removals %d  stale pops %d' %
+              ('', mq.num_pushes, mq.num_updates, mq.num_removals,
+               mq.num_stale_pops))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Benchmark loading a saved graph against building it.
+
+Build a ``Rag`` with moment and histogram features from a synthetic
+superpixel map with 0-labeled boundaries, save it with ``Rag.save``,
+then load it back with ``Rag.load``, reading the edge boundaries in or
+memory-mapping them. The graph is built or loaded in a fresh process
+each time, and the reported peak resident memory is net of the memory
+in use beforehand.
+
+Run from the repository root::
+
+    python benchmarks/bench_ragio.py --shape 60 300 300 --seeds 8000
+"""
+
+import os
+import shutil
+import tempfile
+import argparse
+import resource
+import multiprocessing
+
+from gala import agglo, features
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def feature_manager():
+    return features.base.Composite(children=[features.moments.Manager(),
+                                             features.histogram.Manager()])
+
+
+def build(ws, probs, fn):
+    return agglo.Rag(ws, probs, feature_manager=feature_manager(),
+                     compact=True)
+
+
+def load(ws, probs, fn):
+    return agglo.Rag.load(fn)
+
+
+def load_mmap(ws, probs, fn):
+    return agglo.Rag.load(fn, mmap=True)
+
+
+def _measure(function, args, queue):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    g, t = timed(function, *args)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _, t_merge = timed(g.agglomerate, 0.5)
+    queue.put(((peak - start) * 1024, t, t_merge))
+
+
+def measure(function, *args):
+    """Return the peak bytes and time of a call, and the merge time."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure,
+                                args=(function, args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[60, 300, 300])
+    parser.add_argument('--seeds', type=int, default=8000)
+    args = parser.parse_args()
+    ws = synthetic_watershed(tuple(args.shape), args.seeds, boundaries=True)
+    probs = synthetic_probabilities(ws)
+    out = tempfile.mkdtemp()
+    fn = os.path.join(out, 'rag.h5')
+    try:
+        _, t_save = timed(build(ws, probs, fn).save, fn)
+        print('saved in %.2fs, %.1f MB on disk' %
+              (t_save, os.path.getsize(fn) / 2.0**20))
+        print('%-10s %10s %9s %10s' % ('graph', 'peak (MB)', 'time (s)',
+                                       'merge (s)'))
+        for function in [build, load, load_mmap]:
+            peak, t, t_merge = measure(function, ws, probs, fn)
+            print('%-10s %10.1f %9.2f %10.2f' % (function.__name__,
+                                                 peak / 2.0**20, t, t_merge))
+    finally:
+        shutil.rmtree(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Benchmark boundary refinement after merges between large bodies.
+
+Merge every segment of a volume with 0-labeled boundaries into a single
+growing body, largest neighbor first, with the moments and histogram
+feature managers, and report the time spent in
+``Rag.refine_post_merge_boundaries``, which runs after every merge of
+two adjacent bodies. The merge queue is never built, so the time is not
+dominated by merge priority computations.
+
+The volumes are synthetic Voronoi volumes with few, large superpixels.
+With full connectivity, the boundary pixels at junctions between three
+or more bodies must be reassigned after each merge.
+
+Run from the repository root::
+
+    python benchmarks/bench_refine.py --shape 40 200 200 --seeds 50 200
+"""
+
+import argparse
+
+from gala import agglo, features
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def refine_time(ws, probs, feature_manager, connectivity):
+    """Return the number of refinements and the time spent in them."""
+    times = []
+    refine = agglo.Rag.refine_post_merge_boundaries
+    def timed_refine(g, *args):
+        times.append(timed(refine, g, *args)[1])
+    agglo.Rag.refine_post_merge_boundaries = timed_refine
+    try:
+        g = agglo.Rag(ws, probs, feature_manager=feature_manager,
+                      connectivity=connectivity)
+        size = lambda n: g.node[n]['size']
+        body = max([n for n in g.nodes() if n != g.boundary_body], key=size)
+        neighbors = [n for n in g.neighbors(body) if n != g.boundary_body]
+        while len(neighbors) > 0:
+            body = g.merge_nodes(body, max(neighbors, key=size))
+            neighbors = [n for n in g.neighbors(body)
+                         if n != g.boundary_body]
+    finally:
+        agglo.Rag.refine_post_merge_boundaries = refine
+    return len(times), sum(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[40, 200, 200])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--connectivity', type=int, default=3)
+    args = parser.parse_args()
+    for num_seeds in args.seeds:
+        ws = synthetic_watershed(tuple(args.shape), num_seeds,
+                                 boundaries=True)
+        fm = features.base.Composite(children=[features.moments.Manager(),
+                                               features.histogram.Manager()])
+        n, t = refine_time(ws, synthetic_probabilities(ws), fm,
+                           args.connectivity)
+        print('%5d seeds  %5d refinements  %8.2fs  %7.2fms each' %
+              (num_seeds, n, t, 1000 * t / max(n, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Benchmark how agglomeration time scales with the superpixel count.
+
+Agglomerate synthetic Voronoi volumes with one-voxel-thick, 0-labeled
+boundaries (so that every merge must refine the boundaries of the merged
+segments) and an increasing number of superpixels, with mean boundary
+priority up to a threshold, and report the time per merge.
+
+Run from the repository root::
+
+    python benchmarks/bench_scaling.py --shape 20 100 100 --seeds 500 1000 2000
+"""
+
+import argparse
+
+from gala import agglo
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[20, 100, 100])
+    parser.add_argument('--seeds', type=int, nargs='+',
+                        default=[500, 1000, 2000, 4000, 8000])
+    parser.add_argument('--threshold', type=float, default=0.9)
+    args = parser.parse_args()
+    for num_seeds in args.seeds:
+        ws = synthetic_watershed(tuple(args.shape), num_seeds,
+                                 boundaries=True)
+        g = agglo.Rag(ws, synthetic_probabilities(ws))
+        num_nodes = g.number_of_nodes()
+        _, t = timed(g.agglomerate, args.threshold)
+        num_merges = num_nodes - g.number_of_nodes()
+        print('%6d superpixels  %6d merges  %8.2fs  %7.2fms/merge' %
+              (num_nodes - 1, num_merges, t, 1000 * t / max(num_merges, 1)))
+
+
+if __name__ == '__main__':
+    main()
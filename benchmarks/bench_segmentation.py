@@ -0,0 +1,94 @@
+"""Benchmark the peak memory of writing a segmentation to HDF5.
+
+Agglomerate synthetic superpixel maps with 0-labeled boundaries, of
+increasing size, then write the segmentation to an HDF5 file in two
+ways:
+
+- full volume: map the whole padded superpixel volume to bodies,
+  remove the merged boundaries and crop the padding, as
+  ``Rag.get_segmentation`` used to, then write the result;
+- chunked: ``Rag.write_segmentation``, which computes and writes one
+  chunk at a time in the smallest integer type.
+
+Each write runs in a forked process, and the reported peak is the
+growth of its resident memory during the write alone.
+
+Run from the repository root::
+
+    python benchmarks/bench_segmentation.py --sizes 100 200 300
+"""
+
+import os
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+from gala import agglo, imio, morpho
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def full_volume(g, fn):
+    snapshot = g.snapshot()
+    seg = snapshot.sp2body[snapshot.watershed]
+    seg = morpho.remove_merged_boundaries(seg, g.connectivity)
+    imio.write_h5_stack(morpho.juicy_center(seg, g.pad_thickness), fn)
+
+
+def chunked(g, fn):
+    g.write_segmentation(fn)
+
+
+def _status(field):
+    with open('/proc/self/status') as f:
+        line = [l for l in f if l.startswith(field)][0]
+    return int(line.split()[1]) * 1024
+
+
+def _measure(function, args, queue):
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5') # reset the peak to the current resident memory
+    start = _status('VmRSS')
+    _, t = timed(function, *args)
+    queue.put((_status('VmHWM') - start, t))
+
+
+def peak_rss(function, *args):
+    """Return the growth of the peak resident memory during a call."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure,
+                                args=(function, args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 200, 300],
+                        help='The side of each (cubic) volume.')
+    parser.add_argument('--seeds', type=int, default=2000)
+    args = parser.parse_args()
+    out = tempfile.mkdtemp()
+    fn = os.path.join(out, 'seg.h5')
+    try:
+        print('%-12s %-12s %10s %8s' % ('volume', 'writer', 'peak (MB)',
+                                        'time (s)'))
+        for size in args.sizes:
+            ws = synthetic_watershed((size,) * 3, args.seeds, boundaries=True)
+            g = agglo.Rag(ws, synthetic_probabilities(ws), compact=True)
+            g.agglomerate(0.5)
+            del ws
+            for writer in [full_volume, chunked]:
+                peak, t = peak_rss(writer, g, fn)
+                os.remove(fn)
+                print('%-12s %-12s %10.1f %8.2f' % ('%d^3' % size,
+                      writer.__name__, peak / 2.0**20, t))
+    finally:
+        shutil.rmtree(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark the peak memory of building a Rag from slabs of an HDF5 file.
+
+Write a synthetic superpixel map and probability map to a chunked HDF5
+file, then build a compact ``Rag`` with the moments feature manager from
+it, each time in a fresh process:
+
+- in memory: reading both volumes in full and building as usual;
+- from slabs: passing the HDF5 datasets with several values of
+  `slab_size`, so that only a few planes are in memory at once.
+
+The reported peak resident memory is net of the memory in use before
+the graph is built.
+
+Run from the repository root::
+
+    python benchmarks/bench_slabs.py --shape 64 256 256 --slab-sizes 4 16
+"""
+
+import os
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import h5py
+
+from gala import agglo, features
+from bench_util import (synthetic_watershed, synthetic_probabilities,
+                        thin_boundaries, timed)
+
+
+def _build(fn, slab_size, queue):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    f = h5py.File(fn, 'r')
+    ws, probs = f['ws'], f['probs']
+    if slab_size is None:
+        ws, probs = ws[...], probs[...]
+    g, t = timed(agglo.Rag, ws, probs, compact=True, slab_size=slab_size,
+                 feature_manager=features.moments.Manager())
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(((peak - start) * 1024, t, g.number_of_edges()))
+
+
+def measure(fn, slab_size):
+    """Return the peak build bytes, build time and number of edges."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_build, args=(fn, slab_size, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[64, 256, 256])
+    parser.add_argument('--seeds', type=int, default=5000)
+    parser.add_argument('--slab-sizes', type=int, nargs='+',
+                        default=[4, 16])
+    args = parser.parse_args()
+    out = tempfile.mkdtemp()
+    fn = os.path.join(out, 'volume.h5')
+    try:
+        ws = thin_boundaries(synthetic_watershed(tuple(args.shape),
+                                                 args.seeds))
+        chunks = (1,) + tuple(args.shape[1:])
+        with h5py.File(fn, 'w') as f:
+            f.create_dataset('ws', data=ws, chunks=chunks)
+            f.create_dataset('probs', data=synthetic_probabilities(ws),
+                             chunks=chunks)
+        del ws
+        print('%-10s %10s %9s %8s' % ('slab size', 'peak (MB)', 'time (s)',
+                                      'edges'))
+        for slab_size in [None] + args.slab_sizes:
+            peak, t, edges = measure(fn, slab_size)
+            print('%-10s %10.1f %9.2f %8d' % (slab_size or 'in memory',
+                                              peak / 2.0**20, t, edges))
+    finally:
+        shutil.rmtree(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark agglomeration with segmentation output at several thresholds.
+
+Agglomerate the example test volume through a list of thresholds and
+write the segmentation at each one, both as a full HDF5 volume and as a
+mapped segmentation (superpixel map plus superpixel to body map), in two
+ways:
+
+- loop: ``agglomerate`` then ``get_segmentation`` for each threshold,
+  computing the body map from the full volume, as the pipeline used to;
+- snapshots: ``agglomerate_to_thresholds``, with each snapshot written
+  out in background threads while merging continues.
+
+Run from the repository root::
+
+    python benchmarks/bench_thresholds.py --thresholds 0.1 0.3 0.5 0.7 0.9
+"""
+
+import os
+import shutil
+import tempfile
+import argparse
+
+from gala import agglo, imio
+from bench_util import (synthetic_watershed, synthetic_probabilities,
+                        timed)
+
+
+D = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', 'tests', 'example-data')
+
+
+def loop(g, ws, thresholds, out):
+    for t in sorted(thresholds):
+        g.agglomerate(t)
+        seg = g.get_segmentation()
+        imio.write_image_stack(seg, os.path.join(out, 'seg-%s.h5' % t))
+        imio.write_mapped_segmentation(ws, imio.compute_sp_to_body_map(ws, seg),
+                                       os.path.join(out, 'map-%s.h5' % t))
+
+
+def snapshots(g, ws, thresholds, out):
+    writers = []
+    def write(snapshot):
+        t = snapshot.threshold
+        writers.append(snapshot.write_segmentation(
+            os.path.join(out, 'seg-%s.h5' % t), background=True))
+        writers.append(snapshot.write_mapped_segmentation(
+            os.path.join(out, 'map-%s.h5' % t), background=True))
+    g.agglomerate_to_thresholds(thresholds, callback=write)
+    for writer in writers:
+        writer.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--thresholds', type=float, nargs='+',
+                        default=[0.1, 0.3, 0.5, 0.7, 0.9])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[50, 200, 200])
+    parser.add_argument('--seeds', type=int, default=2000)
+    args = parser.parse_args()
+    ws = imio.read_h5_stack(os.path.join(D, 'test-ws.lzf.h5'))
+    probs = imio.read_h5_stack(os.path.join(D, 'test-p1.lzf.h5'))
+    synthetic = synthetic_watershed(tuple(args.shape), args.seeds)
+    volumes = [('example', ws, probs),
+               ('synthetic', synthetic, synthetic_probabilities(synthetic))]
+    out = tempfile.mkdtemp()
+    try:
+        for name, ws, probs in volumes:
+            for mode in [loop, snapshots]:
+                g = agglo.Rag(ws, probs)
+                _, t = timed(mode, g, ws, args.thresholds, out)
+                print('%-10s %-10s %7.2fs' % (name, mode.__name__, t))
+    finally:
+        shutil.rmtree(out)
+
+
+if __name__ == '__main__':
+    main()
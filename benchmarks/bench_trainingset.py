@@ -0,0 +1,110 @@
+"""Benchmark combining and sampling the learning sets of many volumes.
+
+Write synthetic learning sets of several volumes with
+``save_training_data_to_disk``, then, in a fresh process each, time and
+measure the peak resident memory of:
+
+- combining them into one file, by loading and saving them all with
+  ``load_training_data_from_disk``, or by appending each to a
+  ``TrainingSet``;
+- drawing a stratified random sample of the combined features, from
+  the loaded arrays or from the memory-mapped ``TrainingSet``.
+
+Run from the repository root::
+
+    python benchmarks/bench_trainingset.py --volumes 10 --rows 100000
+"""
+
+import os
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from gala import classify
+from gala.trainingset import TrainingSet
+from bench_util import timed
+
+
+def _measure(function, args, queue):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result, t = timed(function, *args)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((t, (peak - start) * 1024, result))
+
+
+def measure(function, *args):
+    """Return the time, peak bytes and result of `function` in a process."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure,
+                                args=(function, args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def combine_loaded(fns, out):
+    data = [classify.load_training_data_from_disk(fn) for fn in fns]
+    classify.save_training_data_to_disk(
+                            classify.concatenate_data_elements(data), out)
+    return len(data[0][0]) * len(data)
+
+
+def combine_appended(fns, out):
+    with TrainingSet(out) as ts:
+        for fn in fns:
+            ts.append(classify.load_training_data_from_disk(fn), name=fn)
+        return len(ts)
+
+
+def sample_loaded(fn, num_samples):
+    features, labels = classify.load_training_data_from_disk(fn)[:2]
+    X, y = classify.sample_training_data(features, labels[:, 0],
+                                         num_samples, stratified=True)
+    return X.sum()
+
+
+def sample_appended(fn, num_samples):
+    with TrainingSet(fn, 'r') as ts:
+        X, y = ts.sample(num_samples, stratified=True)
+    return X.sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--volumes', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--features', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=10000)
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rs = np.random.RandomState(0)
+        fns = []
+        for i in range(args.volumes):
+            fns.append(os.path.join(tmpdir, 'volume-%i.h5' % i))
+            n = args.rows
+            classify.save_training_data_to_disk([rs.rand(n, args.features),
+                rs.randint(2, size=(n, 3)) * 2 - 1, rs.rand(n, 2),
+                rs.randint(10**6, size=(n, 2))], fns[-1])
+        outs = [os.path.join(tmpdir, name) for name in ['loaded.h5',
+                                                        'appended.h5']]
+        for name, combine, sample, out in [
+                ('load and save', combine_loaded, sample_loaded, outs[0]),
+                ('TrainingSet', combine_appended, sample_appended, outs[1])]:
+            t, peak, rows = measure(combine, fns, out)
+            print('%-14s combine %d rows: %6.2fs, peak memory %7.1f MB' %
+                  (name, rows, t, peak / 2.0**20))
+            t, peak, total = measure(sample, out, args.samples)
+            print('%-14s sample %d rows:  %6.2fs, peak memory %7.1f MB' %
+                  (name, args.samples, t, peak / 2.0**20))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark agglomeration with an eager and a deferred UCM.
+
+Build a ``Rag`` from a synthetic superpixel map with 0-labeled
+boundaries and agglomerate it, each time in a fresh process:
+
+- eager: with ``eager_ucm=True``, which allocates the full-volume
+  ultrametric contour map up front and writes every merged boundary
+  into it;
+- deferred: the default, which records the merged boundaries and
+  builds the map only when ``get_ucm`` is called.
+
+The reported peak resident memory is net of the memory in use before
+the graph is built, and excludes the final ``get_ucm`` call.
+
+Run from the repository root::
+
+    python benchmarks/bench_ucm.py --shape 60 300 300 --seeds 8000
+"""
+
+import argparse
+import resource
+import multiprocessing
+
+from gala import agglo
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+def _agglomerate(ws, probs, threshold, eager_ucm, queue):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    g, t_build = timed(agglo.Rag, ws, probs, compact=True,
+                       eager_ucm=eager_ucm)
+    _, t_merge = timed(g.agglomerate, threshold)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _, t_ucm = timed(g.get_ucm)
+    queue.put(((peak - start) * 1024, t_build, t_merge, t_ucm))
+
+
+def measure(ws, probs, threshold, eager_ucm):
+    """Return the peak bytes, and the build, merge and get_ucm times."""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_agglomerate,
+                                args=(ws, probs, threshold, eager_ucm, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[60, 300, 300])
+    parser.add_argument('--seeds', type=int, default=8000)
+    parser.add_argument('--threshold', type=float, default=0.9)
+    args = parser.parse_args()
+    ws = synthetic_watershed(tuple(args.shape), args.seeds, boundaries=True)
+    probs = synthetic_probabilities(ws)
+    print('%-9s %10s %9s %9s %9s' % ('ucm', 'peak (MB)', 'build (s)',
+                                     'merge (s)', 'get (s)'))
+    for name, eager_ucm in [('eager', True), ('deferred', False)]:
+        peak, t_build, t_merge, t_ucm = measure(ws, probs, args.threshold,
+                                                eager_ucm)
+        print('%-9s %10.1f %9.2f %9.2f %9.2f' % (name, peak / 2.0**20,
+                                                 t_build, t_merge, t_ucm))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Benchmark removing repeated feature vectors from growing learning sets.
+
+Simulate the learning sets of many epochs, each repeating a fraction of
+the feature vectors of the previous ones, and time the deduplication
+after every epoch, as ``learn_agglomerate`` does with ``memory`` and
+``unique``: once with ``unique_learning_data_elements`` on all epochs
+so far, and once adding each epoch to a ``UniqueTrainingData`` store,
+in memory and in an HDF5 file.
+
+Run from the repository root::
+
+    python benchmarks/bench_unique.py --epochs 20 --rows 20000
+"""
+
+import os
+import argparse
+import tempfile
+
+import numpy as np
+
+from gala import classify
+from bench_util import timed
+
+
+def synthetic_epochs(num_epochs, num_rows, num_features, repeats, seed=0):
+    """Return learning sets repeating a fraction of the earlier rows."""
+    rs = np.random.RandomState(seed)
+    epochs = []
+    for i in range(num_epochs):
+        features = rs.rand(num_rows, num_features)
+        if i > 0:
+            old = rs.randint(i * num_rows, size=int(repeats * num_rows))
+            features[:len(old)] = np.concatenate(
+                                        [e[0] for e in epochs])[old]
+        epochs.append([features, rs.randint(2, size=(num_rows, 3)),
+                       rs.rand(num_rows, 2),
+                       rs.randint(1000, size=(num_rows, 2))])
+    return epochs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--features', type=int, default=33)
+    parser.add_argument('--repeats', type=float, default=0.3)
+    args = parser.parse_args()
+    epochs = synthetic_epochs(args.epochs, args.rows, args.features,
+                              args.repeats)
+
+    def sort_all():
+        for i in range(len(epochs)):
+            data = classify.unique_learning_data_elements(epochs[:i + 1])
+        return data
+
+    def store(fn=None):
+        s = classify.UniqueTrainingData(fn)
+        for epoch in epochs:
+            s.add(epoch)
+            data = s.get_data()
+        s.close()
+        return data
+
+    handle, fn = tempfile.mkstemp(suffix='.h5')
+    os.close(handle)
+    os.remove(fn)
+    try:
+        results = []
+        for name, function, fargs in [('unique_learning_data_elements',
+                                       sort_all, ()),
+                                      ('store in memory', store, ()),
+                                      ('store in HDF5', store, (fn,))]:
+            data, t = timed(function, *fargs)
+            results.append(data)
+            print('%-30s %7.2fs  %d unique rows' % (name, t, len(data[0])))
+    finally:
+        if os.path.exists(fn):
+            os.remove(fn)
+    print('same rows: %s' % all(
+        len(r[0]) == len(results[0][0]) and
+        set(map(tuple, r[0])) == set(map(tuple, results[0][0]))
+        for r in results[1:]))
+
+
+if __name__ == '__main__':
+    main()
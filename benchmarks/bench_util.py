@@ -0,0 +1,67 @@
+"""Helpers shared by the gala benchmark scripts."""
+
+import time
+
+import numpy as np
+from scipy import ndimage as nd
+
+
+def synthetic_watershed(shape, num_seeds, boundaries=False, seed=0):
+    """Return a Voronoi superpixel map of randomly placed seeds.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of the volume.
+    num_seeds : int
+        The number of seeds (and thus, approximately, of superpixels).
+    boundaries : bool, optional
+        If ``True``, separate the superpixels by one-voxel-thick,
+        0-labeled boundaries.
+    seed : int, optional
+        The random seed.
+
+    Returns
+    -------
+    ws : array of int32, shape `shape`
+        The superpixel map.
+    """
+    random = np.random.RandomState(seed)
+    markers = np.zeros(shape, np.int32)
+    coords = tuple(random.randint(0, s, num_seeds) for s in shape)
+    markers[coords] = np.arange(1, num_seeds + 1)
+    _, inds = nd.distance_transform_edt(markers == 0, return_indices=True)
+    ws = markers[tuple(inds)]
+    if boundaries:
+        ws = thin_boundaries(ws)
+    return ws
+
+
+def thin_boundaries(ws):
+    """Set to 0 every voxel whose label differs from its successor's."""
+    is_boundary = np.zeros(ws.shape, bool)
+    for ax in range(ws.ndim):
+        head = [slice(None)] * ws.ndim
+        tail = [slice(None)] * ws.ndim
+        head[ax], tail[ax] = slice(0, -1), slice(1, None)
+        is_boundary[tuple(head)] |= ws[tuple(head)] != ws[tuple(tail)]
+    out = ws.copy()
+    out[is_boundary] = 0
+    return out
+
+
+def synthetic_probabilities(ws, seed=0):
+    """Return a noisy boundary probability map for a superpixel map."""
+    random = np.random.RandomState(seed)
+    strel = nd.generate_binary_structure(ws.ndim, 1)
+    boundary = (nd.maximum_filter(ws, footprint=strel) !=
+                nd.minimum_filter(ws, footprint=strel)) | (ws == 0)
+    probs = 0.8 * boundary + 0.2 * random.rand(*ws.shape)
+    return probs.astype(np.float32)
+
+
+def timed(function, *args, **kwargs):
+    """Return the result of `function(*args, **kwargs)` and its run time."""
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
@@ -0,0 +1,68 @@
+"""Benchmark agglomeration while recording the split VI of every merge.
+
+Agglomerate the example test volume and a synthetic volume, built with
+their ground truths, with ``save_history=True``, which evaluates the
+split VI after every merge:
+
+- recomputed: from the full contingency table with
+  ``evaluate.split_vi``, as ``Rag.split_vi`` used to;
+- tracked: from the running entropy sums that ``Rag.merge_nodes``
+  updates.
+
+Run from the repository root::
+
+    python benchmarks/bench_vi.py --shape 40 200 200 --seeds 8000 --gt-seeds 200
+"""
+
+import os
+import argparse
+
+import numpy as np
+
+from gala import agglo, imio
+from gala import evaluate as ev
+from bench_util import synthetic_watershed, synthetic_probabilities, timed
+
+
+D = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', 'tests', 'example-data')
+
+
+def recomputed_split_vi(g, gt=None):
+    return ev.split_vi(g.rig.tocsr())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threshold', type=float, default=0.9)
+    parser.add_argument('--shape', type=int, nargs='+',
+                        default=[40, 200, 200])
+    parser.add_argument('--seeds', type=int, default=8000)
+    parser.add_argument('--gt-seeds', type=int, default=200)
+    args = parser.parse_args()
+    example = [imio.read_h5_stack(os.path.join(D, 'test-%s.lzf.h5' % n))
+               for n in ['ws', 'p1', 'gt']]
+    ws = synthetic_watershed(tuple(args.shape), args.seeds, boundaries=True)
+    gt = synthetic_watershed(tuple(args.shape), args.gt_seeds, seed=1)
+    synthetic = [ws, synthetic_probabilities(ws), gt]
+    tracked = agglo.Rag.split_vi
+    for volume, (ws, probs, gt) in [('example', example),
+                                    ('synthetic', synthetic)]:
+        results = []
+        for name, split_vi in [('recomputed', recomputed_split_vi),
+                               ('tracked', tracked)]:
+            agglo.Rag.split_vi = split_vi
+            try:
+                g = agglo.Rag(ws, probs, gt_vol=gt)
+                (history, _, evaluation), t = timed(g.agglomerate,
+                                                    args.threshold, True)
+            finally:
+                agglo.Rag.split_vi = tracked
+            results.append(np.array([e[1] for e in evaluation]))
+            print('%-10s %-10s %5d merges  %7.2fs' %
+                  (volume, name, len(history), t))
+        print('max difference: %.2g' % abs(results[0] - results[1]).max())
+
+
+if __name__ == '__main__':
+    main()
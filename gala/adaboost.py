@@ -7,7 +7,8 @@ import cPickle
 import numpy
 
 # local modules
-from decision_tree import DecisionTree
+from decision_tree import DecisionTree, presort, concatenate_trees
+from . import optimized as opt
 from iterprogress import with_progress, NoProgressBar, StandardProgressBar
 
 class AdaBoost(object):
@@ -33,11 +34,14 @@ class AdaBoost(object):
         self.weights /= float(sum(self.weights))
         self.weak_classifier_ensemble = []
         self.alpha = []
+        # sort the features once for all rounds
+        order = presort(self.X)
         
         for t in with_progress(range(T), pbar=self.progressbar):
             # Apply asymmetric weights
             self.weights *= self.weights_asymmetric
-            weak_learner = DecisionTree().fit(self.X,self.Y,self.weights, depth=depth)
+            weak_learner = DecisionTree().fit(self.X,self.Y,self.weights, depth=depth,
+                                              order=order)
             Y_pred = weak_learner.predict(self.X)
             e = sum(0.5*self.weights*abs(self.Y-Y_pred))/sum(self.weights)
             if e > 0.5:
@@ -53,10 +57,19 @@ class AdaBoost(object):
         return self
 
     def predict_score(self,X):
-        X = numpy.array(X)
-        Y = sum([alpha * weak_classifier.predict(X) for alpha, weak_classifier
-                            in zip(self.alpha, self.weak_classifier_ensemble)])
-        return Y
+        # evaluate all trees in one pass, adding up their weighted
+        # predictions in order, like summing them one tree at a time
+        X = numpy.array(X, dtype=numpy.double, ndmin=2)
+        trees = self.weak_classifier_ensemble
+        flat = getattr(self, '_flat', None)
+        if flat is None or flat[0] is not trees or flat[1] != len(trees):
+            flat = (trees, len(trees),
+                    concatenate_trees([t.flatten() for t in trees]))
+            self._flat = flat
+        roots, feature, threshold, left, right, values = flat[2]
+        alpha = numpy.array(self.alpha[:len(trees)], numpy.double)
+        return opt.predict_tree_ensemble(X, roots, feature, threshold, left,
+                                         right, alpha, values)[:, 0]
         
     def predict_proba(self, X):
         p = 1.0/(1.0 + numpy.exp(-2.0*self.predict_score(X)))
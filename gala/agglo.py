@@ -1,11 +1,18 @@
 # built-ins
 from itertools import combinations, izip, repeat, product
+from collections import OrderedDict, defaultdict
+from copy import deepcopy
+import os
+import inspect
+import tempfile
 import itertools as it
+import functools
+import multiprocessing
 import argparse
 import random
 import logging
+import time
 import json
-from copy import deepcopy
 from math import isnan
 # libraries
 from numpy import (array, mean, zeros, zeros_like, uint8, where, unique,
@@ -13,7 +20,7 @@ from numpy import (array, mean, zeros, zeros_like, uint8, where, unique,
     flatnonzero, sign, unravel_index, bincount)
 import numpy as np
 from scipy.stats import sem
-from scipy.sparse import lil_matrix
+from scipy.sparse import lil_matrix, csr_matrix
 from scipy.misc import comb as nchoosek
 from scipy.ndimage.measurements import label
 from networkx import Graph, biconnected_components
@@ -27,19 +34,51 @@ from . import iterprogress as ip
 from . import optimized as opt
 from .ncut import ncutW
 from .mergequeue import MergeQueue
+from .indexset import IndexSet
+from .chainedlist import ChainedList
+from .unionfind import UnionFind
+from .snapshot import Snapshot
+from .contingency import ContingencyTable, add_rows
 from .evaluate import contingency_table as ev_contingency_table, split_vi, xlogx
 from . import features
+from . import ragio
 from . import classify
 from .classify import get_classifier, \
     unique_learning_data_elements, concatenate_data_elements
 
 
-def contingency_table(a, b):
-    ct = ev_contingency_table(a, b)
-    nx, ny = ct.shape
-    ctout = np.zeros((2 * nx, ny), ct.dtype)
-    ct.todense(out=ctout[:nx, :])
-    return ctout
+def contingency_table(a, b, ignore_seg=[0], ignore_gt=[0]):
+    """Return the contingency table of `a` and `b` as a sparse table.
+
+    The rows of the ``ContingencyTable`` can be merged as the segments
+    of `a` are, and the table holds unnormalized voxel counts.
+    """
+    return ContingencyTable(ev_contingency_table(a, b, ignore_seg, ignore_gt,
+                                                 norm=False))
+
+
+def _planewise_contingency_table(a, b, ignore_seg, ignore_gt):
+    """Return the contingency table of `a` and `b`, read plane by plane.
+
+    The result equals ``contingency_table(a, b, ignore_seg, ignore_gt)``,
+    but only one plane (along axis 0) of each volume is held in memory
+    at a time, so `a` and `b` can be any array-likes supporting slicing,
+    such as ``h5py`` datasets.
+    """
+    rows, cols, counts = [], [], []
+    for z in range(a.shape[0]):
+        seg, gt = np.asarray(a[z]).ravel(), np.asarray(b[z]).ravel()
+        keep = ~(np.in1d(seg, ignore_seg) | np.in1d(gt, ignore_gt))
+        if not keep.any():
+            continue
+        plane = csr_matrix((ones(keep.sum()), (seg[keep], gt[keep])),
+                           shape=(seg.max() + 1, gt.max() + 1)).tocoo()
+        rows.append(plane.row)
+        cols.append(plane.col)
+        counts.append(plane.data)
+    return ContingencyTable(csr_matrix((np.concatenate(counts),
+                                        (np.concatenate(rows),
+                                         np.concatenate(cols)))))
 
 
 arguments = argparse.ArgumentParser(add_help=False)
@@ -169,6 +208,35 @@ def mito_merge():
 
 
 def classifier_probability(feature_extractor, classifier):
+    """Return a merge priority function from a classifier's predictions.
+
+    Parameters
+    ----------
+    feature_extractor : callable
+        A function taking ``(g, n1, n2)`` and returning the feature
+        vector of edge ``(n1, n2)``, such as a feature manager.
+    classifier : classifier object
+        A trained classifier supporting ``predict_proba`` or
+        ``predict``.
+
+    Returns
+    -------
+    predict : callable
+        The priority function, taking ``(g, n1, n2)``. It also supports
+        batched evaluation through two attributes: ``predict.features``
+        computes the feature vector of a single edge, and
+        ``predict.batch(g, edges, features)`` returns the priorities of
+        a list of edges, given their feature vectors, in a single
+        classifier call. ``Rag`` uses these whenever they are present.
+
+    Notes
+    -----
+    Fitted tree ensembles are evaluated through a
+    ``classify.FlatForest``, which gives the same probabilities much
+    faster for the single edges and small batches scored during
+    agglomeration.
+    """
+    classifier = classify.flatten_classifier(classifier)
     def predict(g, n1, n2):
         if n1 == g.boundary_body or n2 == g.boundary_body:
             return inf
@@ -183,6 +251,21 @@ def classifier_probability(feature_extractor, classifier):
         except AttributeError:
             prediction = classifier.predict(features)[0]
         return prediction
+    def predict_batch(g, edges, features):
+        features = np.array(features, ndmin=2)
+        try:
+            prediction_arr = np.array(classifier.predict_proba(features))
+            if prediction_arr.ndim > 2: prediction_arr = prediction_arr[0]
+            if prediction_arr.ndim == 2 and prediction_arr.shape[1] > 1:
+                prediction = prediction_arr[:, 1]
+            else:
+                prediction = prediction_arr.ravel()
+        except AttributeError:
+            prediction = np.ravel(classifier.predict(features))
+        return [inf if g.boundary_body in edge else p
+                for edge, p in izip(edges, prediction)]
+    predict.features = feature_extractor
+    predict.batch = predict_batch
     return predict
 
 
@@ -200,14 +283,22 @@ def ordered_priority(edges):
 
 def expected_change_vi(feature_extractor, classifier, alpha=1.0, beta=1.0):
     prob_func = classifier_probability(feature_extractor, classifier)
-    def predict(g, n1, n2):
-        p = prob_func(g, n1, n2) # Prediction from the classifier
+    def expected_change(g, n1, n2, p):
         # Calculate change in VI if n1 and n2 should not be merged
         v = compute_local_vi_change(
             g.node[n1]['size'], g.node[n2]['size'], g.volume_size
         )
         # Return expected change
         return  (p*alpha*v + (1.0-p)*(-beta*v))
+    def predict(g, n1, n2):
+        p = prob_func(g, n1, n2) # Prediction from the classifier
+        return expected_change(g, n1, n2, p)
+    def predict_batch(g, edges, features):
+        ps = prob_func.batch(g, edges, features)
+        return [expected_change(g, n1, n2, p)
+                for (n1, n2), p in izip(edges, ps)]
+    predict.features = prob_func.features
+    predict.batch = predict_batch
     return predict
 
 
@@ -220,24 +311,37 @@ def compute_local_vi_change(s1, s2, n):
 
 
 def compute_true_delta_vi(ctable, n1, n2):
-    p1 = ctable[n1].sum()
-    p2 = ctable[n2].sum()
-    p3 = p1+p2
-    p1g_log_p1g = xlogx(ctable[n1]).sum()
-    p2g_log_p2g = xlogx(ctable[n2]).sum()
-    p3g_log_p3g = xlogx(ctable[n1]+ctable[n2]).sum()
+    """Compute change in VI obtained by merging rows n1 and n2.
+
+    This takes time proportional to the nonzero entries of the rows of
+    the ``ContingencyTable`` `ctable`.
+    """
+    row1, row2 = ctable.row(n1), ctable.row(n2)
+    row3 = add_rows(row1, row2)
+    p1, p2, p3 = [row[1] / ctable.total for row in [row1, row2, row3]]
+    p1g_log_p1g, p2g_log_p2g, p3g_log_p3g = \
+                                    [xlogx(p).sum() for p in [p1, p2, p3]]
+    p1, p2, p3 = p1.sum(), p2.sum(), p3.sum()
     return p3*log2(p3) - p1*log2(p1) - p2*log2(p2) - \
                                 2*(p3g_log_p3g - p1g_log_p1g - p2g_log_p2g)
 
 
 def expected_change_rand(feature_extractor, classifier, alpha=1.0, beta=1.0):
     prob_func = classifier_probability(feature_extractor, classifier)
-    def predict(g, n1, n2):
-        p = float(prob_func(g, n1, n2)) # Prediction from the classifier
+    def expected_change(g, n1, n2, p):
         v = compute_local_rand_change(
             g.node[n1]['size'], g.node[n2]['size'], g.volume_size
         )
         return p*v*alpha + (1.0-p)*(-beta*v)
+    def predict(g, n1, n2):
+        p = float(prob_func(g, n1, n2)) # Prediction from the classifier
+        return expected_change(g, n1, n2, p)
+    def predict_batch(g, edges, features):
+        ps = prob_func.batch(g, edges, features)
+        return [expected_change(g, n1, n2, float(p))
+                for (n1, n2), p in izip(edges, ps)]
+    predict.features = prob_func.features
+    predict.batch = predict_batch
     return predict
 
 
@@ -249,14 +353,81 @@ def compute_local_rand_change(s1, s2, n):
 def compute_true_delta_rand(ctable, n1, n2, n):
     """Compute change in RI obtained by merging rows n1 and n2.
 
-    This function assumes ctable is normalized to sum to 1.
+    `ctable` is a ``ContingencyTable``, normalized here to sum to 1.
     """
-    localct = n*ctable[(n1,n2),]
+    row1, row2 = ctable.row(n1), ctable.row(n2)
+    cols = np.union1d(row1[0], row2[0])
+    localct = np.zeros((2, len(cols)))
+    for i, (c, v) in enumerate([row1, row2]):
+        localct[i, np.searchsorted(cols, c)] = v
+    localct *= n / ctable.total
     delta_sxy = 1.0/2*((localct.sum(axis=0)**2).sum()-(localct**2).sum())
     delta_sx = 1.0/2*(localct.sum()**2 - (localct.sum(axis=1)**2).sum())
     return (2*delta_sxy - delta_sx) / nchoosek(n,2)
 
 
+def _row_sums(table, values):
+    """Sum `values`, aligned with the entries of `table`, by row."""
+    rows = np.repeat(np.arange(table.shape[0]), np.diff(table.indptr))
+    return np.bincount(rows, values, minlength=table.shape[0])
+
+
+def compute_true_deltas(ctable, n1s, n2s, n):
+    """Compute the VI and RI changes obtained by merging many row pairs.
+
+    This computes ``compute_true_delta_vi(ctable, n1, n2)`` and
+    ``compute_true_delta_rand(ctable, n1, n2, n)`` for all pairs at
+    once, from the sparse rows of the ``ContingencyTable`` `ctable`.
+    The sums are accumulated in a different order, so the results can
+    differ from those functions by rounding, and each comes with a
+    bound on that difference.
+
+    Parameters
+    ----------
+    ctable : ContingencyTable
+        The contingency table.
+    n1s, n2s : array of int
+        The rows to merge.
+    n : int
+        The volume size.
+
+    Returns
+    -------
+    deltas : array of float, shape ``(len(n1s), 2)``
+        The VI and RI change of each merge.
+    errors : array of float, shape ``(len(n1s), 2)``
+        The bounds on their rounding errors.
+    """
+    rows1, rows2 = ctable.take(n1s), ctable.take(n2s)
+    rows3 = rows1 + rows2
+    rows3.sort_indices()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # VI: the entropy terms of each row and of their sum
+        terms = []
+        for rows in [rows1, rows2, rows3]:
+            p = rows.data / ctable.total
+            psum = _row_sums(rows, p)
+            terms.append((psum * log2(psum), _row_sums(rows, xlogx(p))))
+        (h1, g1), (h2, g2), (h3, g3) = terms
+        delta_vi = h3 - h1 - h2 - 2*(g3 - g1 - g2)
+        error_vi = abs(h3) + abs(h1) + abs(h2) + \
+                                        2*(abs(g3) + abs(g1) + abs(g2))
+    # RI: the pair counts of each row and of their sum
+    scale = n / ctable.total
+    (s1, q1), (s2, q2), (s3, q3) = [
+        (_row_sums(rows, rows.data * scale),
+         _row_sums(rows, (rows.data * scale)**2))
+        for rows in [rows1, rows2, rows3]]
+    delta_sxy = 1.0/2*(q3 - q1 - q2)
+    delta_sx = 1.0/2*((s1 + s2)**2 - (s1**2 + s2**2))
+    delta_rand = (2*delta_sxy - delta_sx) / nchoosek(n,2)
+    error_rand = (q3 + q1 + q2 + (s1 + s2)**2 + s1**2 + s2**2) / \
+                                                            nchoosek(n,2)
+    deltas = np.transpose([delta_vi, delta_rand])
+    errors = np.transpose([error_vi, error_rand]) * 1e-9
+    return deltas, errors
+
+
 def boundary_mean_ladder(g, n1, n2, threshold, strictness=1):
     f = make_ladder(boundary_mean, threshold, strictness)
     return f(g, n1, n2)
@@ -273,6 +444,72 @@ def random_priority(g, n1, n2):
     return random.random()
 
 
+def _copy_attributes(attrs, memo):
+    """Copy a dictionary of node or edge attributes.
+
+    Lists, such as the feature caches of composite feature managers,
+    are copied recursively, other values with their ``copy`` method if
+    they have one. Merge queue items (``qlink``) are copied through
+    `memo`, so that they refer to the items of the copied merge queue.
+    """
+    def copy_value(value):
+        if isinstance(value, list):
+            return [copy_value(v) for v in value]
+        return value.copy() if hasattr(value, 'copy') else value
+    copied = {}
+    for key, value in attrs.iteritems():
+        if key == 'qlink':
+            copied[key] = deepcopy(value, memo)
+        else:
+            copied[key] = copy_value(value)
+    return copied
+
+
+def label_index_sets(sets):
+    """Concatenate sets of voxel indices, labeling each voxel by its set.
+
+    Parameters
+    ----------
+    sets : list of set or indexset.IndexSet of int
+        The voxel index sets, such as node extents or edge boundaries.
+
+    Returns
+    -------
+    idxs : array of int
+        The elements of all the sets, each set in its iteration order.
+    labels : array of int
+        The position in `sets` of the set containing each voxel.
+    """
+    idxs = [np.asarray(s) if isinstance(s, (IndexSet, np.ndarray)) else
+            np.fromiter(s, np.intp, len(s)) for s in sets]
+    lengths = [len(s) for s in idxs]
+    labels = np.repeat(np.arange(len(sets)), lengths)
+    if len(idxs) == 0:
+        return np.zeros(0, np.intp), labels
+    return np.concatenate(idxs).astype(np.intp), labels
+
+
+def _last_values(idxs, values):
+    """Return the unique indices in `idxs` with their last value.
+
+    Parameters
+    ----------
+    idxs : array of int
+        Voxel indices, possibly repeated.
+    values : array, same shape as `idxs`
+        The value associated with each index.
+
+    Returns
+    -------
+    idxs : array of int
+        The sorted unique indices.
+    values : array
+        For each index, the value of its last occurrence in `idxs`.
+    """
+    idxs, first = np.unique(idxs[::-1], return_index=True)
+    return idxs, values[::-1][first]
+
+
 class Rag(Graph):
     """Region adjacency graph for segmentation of nD volumes."""
 
@@ -283,7 +520,8 @@ class Rag(Graph):
             show_progress=False, lowmem=False, connectivity=1,
             channel_is_oriented=None, orientation_map=array([]),
             normalize_probabilities=False, nozeros=False, exclusions=array([]),
-            isfrozennode=None, isfrozenedge=None):
+            isfrozennode=None, isfrozenedge=None, compact=False,
+            slab_size=None, nprocessors=1, eager_ucm=False):
         """Create a graph from label and image/probability volumes.
 
         The label field can be complete (every pixel belongs to a
@@ -354,6 +592,31 @@ class Rag(Graph):
         isfrozenedge : function, optional
             As `isfrozennode`, but the function should take the graph
             and *two* nodes, to specify an edge that cannot be merged.
+        compact : bool, optional
+            Store the voxel indices of edge boundaries and node extents
+            as sorted arrays (``indexset.IndexSet``) rather than as
+            Python sets. This uses about a tenth of the memory, and
+            merging boundaries only concatenates arrays.
+        slab_size : int, optional
+            Build the graph out of core, reading `watershed` and
+            `probabilities`, which can then be any array-likes
+            supporting slicing, such as ``h5py`` datasets, this many
+            planes (along axis 0) at a time. See
+            ``build_graph_from_slabs``. Orientation maps and feature
+            managers whose caches are not sums over voxels are not
+            supported.
+        nprocessors : int, optional
+            Build the graph from slabs in this many processes. Unless
+            `slab_size` is given, the volume is split into one slab per
+            process. Without `slab_size`, graphs with an
+            `orientation_map` or a feature manager whose caches are not
+            sums over voxels are built in a single process instead, as
+            their slab graphs would differ.
+        eager_ucm : bool, optional
+            Keep the ultrametric contour map as a full-volume array that
+            is updated after every merge. By default, the graph only
+            records the boundary and height of each merge, and
+            ``get_ucm`` builds the map from these records on demand.
 
         Returns
         -------
@@ -366,26 +629,42 @@ class Rag(Graph):
         self.show_progress = show_progress
         self.nozeros = nozeros
         self.connectivity = connectivity
+        self.compact = compact
         self.pbar = (ip.StandardProgressBar() if self.show_progress
                      else ip.NoProgressBar())
-        self.set_watershed(watershed, lowmem, connectivity)
-        self.set_probabilities(probabilities, normalize_probabilities)
-        self.set_orientations(orientation_map, channel_is_oriented)
-        if watershed is None:
-            self.ucm = None
-        else:
-            self.ucm = -inf*ones(self.watershed.shape, dtype=float)
-            self.ucm[self.watershed==0] = inf
-            self.ucm_r = self.ucm.ravel()
         self.merge_priority_function = merge_priority_function
         self.max_merge_score = -inf
-        self.build_graph_from_watershed(allow_shared_boundaries,
-                                        nozerosfast=self.nozeros)
-        self.set_feature_manager(feature_manager)
+        self.eager_ucm = eager_ucm
+        self.ucm_records = []
+        if slab_size is not None and len(orientation_map) > 0:
+            raise ValueError('orientation_map is not supported when building '
+                             'the graph from slabs.')
+        if slab_size is not None and not _sums_voxel_caches(feature_manager):
+            raise ValueError('The caches of %s are not sums over voxels, so '
+                             'the graph cannot be built from slabs.'
+                             % type(feature_manager).__name__)
+        if slab_size is None and nprocessors != 1 and \
+                (len(orientation_map) > 0 or
+                 not _sums_voxel_caches(feature_manager)):
+            logging.warning('Building the graph in a single process, since '
+                            'slab graphs do not support its orientation map '
+                            'or feature manager.')
+            nprocessors = 1
+        if slab_size is None and nprocessors == 1:
+            self._set_volumes(watershed, probabilities, lowmem,
+                              normalize_probabilities, orientation_map,
+                              channel_is_oriented)
+            self.build_graph_from_watershed(allow_shared_boundaries,
+                                            nozerosfast=self.nozeros)
+            self.set_feature_manager(feature_manager)
+        else:
+            self.build_graph_from_slabs(watershed, probabilities,
+                    feature_manager, slab_size, allow_shared_boundaries,
+                    lowmem, normalize_probabilities, channel_is_oriented,
+                    nprocessors)
         self.set_ground_truth(gt_vol)
         self.set_exclusions(exclusions)
-        self.merge_queue = MergeQueue()
-        self.tree = tree.Ultrametric(self.nodes())
+        self._init_merge_state()
         self.frozen_nodes = set()
         if isfrozennode is not None:
             for node in self.nodes():
@@ -397,22 +676,200 @@ class Rag(Graph):
                 if isfrozenedge(self, n1, n2):
                     self.frozen_edges.add((n1,n2))
         for nodeid in self.nodes():
-            del self.node[nodeid]["extent"]
+            self.node[nodeid].pop('extent', None)
+
+
+    def _init_merge_state(self):
+        """Set up the merge queue and merge records of an unmerged graph."""
+        self.merge_queue = MergeQueue()
+        self.pending_priorities = OrderedDict()
+        self.tree = tree.Ultrametric(self.nodes())
+        self.sp2segment = UnionFind(max([0] + self.nodes()) + 1)
+        self.superpixels = np.array(sorted(n for n in self.nodes()
+                                           if n != self.boundary_body), int)
+
+
+    def save(self, fn):
+        """Save the graph to an HDF5 file, to be loaded with ``Rag.load``.
+
+        Only graphs in which no nodes have been merged can be saved.
+        The merge priority function and ground truth are not saved.
+
+        Parameters
+        ----------
+        fn : string
+            The output filename.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError
+            If some nodes have been merged, or if the feature caches are
+            not numeric arrays of fixed shape.
+
+        See Also
+        --------
+        ``ragio.write_rag``
+        """
+        ragio.write_rag(self, fn)
+
+
+    @classmethod
+    def load(cls, fn, merge_priority_function=boundary_mean, gt_vol=None,
+             feature_manager=None, show_progress=False, lowmem=False,
+             eager_ucm=False, mmap=False):
+        """Load a graph saved with ``Rag.save``.
+
+        Loading a graph skips building it from the volumes and computing
+        its feature caches, so it is typically an order of magnitude
+        faster than building it.
+
+        Parameters
+        ----------
+        fn : string
+            The saved graph file.
+        merge_priority_function, gt_vol, show_progress, lowmem, eager_ucm
+            See ``Rag.__init__``.
+        feature_manager : ``features.base.Null`` object, optional
+            The feature manager of the graph. It must be equivalent to
+            the one with which the graph was built, since the feature
+            caches are not recomputed. By default, it is recreated from
+            the description saved with the graph.
+        mmap : bool, optional
+            Memory-map the boundary voxels of the edges from `fn`
+            instead of reading them in. The file must then remain
+            unchanged while the graph is in use. Only graphs built with
+            ``compact=True`` benefit from this.
 
+        Returns
+        -------
+        g : Rag object
+            The loaded graph, ready to be agglomerated.
+        """
+        g = cls.__new__(cls)
+        super(Rag, g).__init__(weighted=False)
+        g.show_progress = show_progress
+        g.pbar = (ip.StandardProgressBar() if show_progress
+                  else ip.NoProgressBar())
+        g.merge_priority_function = merge_priority_function
+        g.max_merge_score = -inf
+        g.eager_ucm = eager_ucm
+        g.ucm_records = []
+        fm_description = ragio.read_rag(g, fn, lowmem, mmap)
+        if feature_manager is None:
+            feature_manager = ragio.create_feature_manager(fm_description)
+        g.feature_manager = feature_manager
+        g.set_ground_truth(gt_vol)
+        g._init_merge_state()
+        return g
+
+
+    _volume_attributes = frozenset(['watershed', 'watershed_r',
+        'pixel_neighbors', 'neighbor_idxs', 'probabilities',
+        'probabilities_r', 'orientation_map', 'orientation_map_r',
+        'channel_is_oriented', 'max_probabilities_r',
+        'oriented_probabilities_r', 'non_oriented_probabilities_r',
+        'ucm', 'ucm_r', 'ignored_boundary'])
+
+    def __getattr__(self, name):
+        """Load the volumes of a graph built from slabs on first use."""
+        if (name not in Rag._volume_attributes or
+                '_lazy_volumes' not in self.__dict__):
+            raise AttributeError(name)
+        self._load_volumes()
+        return getattr(self, name)
+
+
+    def _load_volumes(self):
+        """Read in the volumes deferred by ``build_graph_from_slabs``."""
+        lazy = self.__dict__.pop('_lazy_volumes', None)
+        if lazy is None:
+            return
+        watershed, probabilities, lowmem, normalize, channel_is_oriented, \
+                                                            ignored = lazy
+        if len(probabilities) > 0:
+            probabilities = probabilities[...]
+        self._set_volumes(watershed[...], probabilities, lowmem, normalize,
+                          array([]), channel_is_oriented)
+        if ignored is not None:
+            self.ignored_boundary = zeros(self.watershed.shape, bool)
+            self.ignored_boundary.ravel()[ignored] = True
+
+
+    def _set_volumes(self, watershed, probabilities, lowmem, normalize,
+                     orientation_map, channel_is_oriented):
+        """Set the padded per-voxel arrays and the UCM of the graph."""
+        self.set_watershed(watershed, lowmem, self.connectivity)
+        self.set_probabilities(probabilities, normalize)
+        self.set_orientations(orientation_map, channel_is_oriented)
+        if watershed is None or not self.eager_ucm:
+            self.ucm = None
+        else:
+            self.ucm = -inf*ones(self.watershed.shape, dtype=float)
+            self.ucm[self.watershed==0] = inf
+            self.ucm_r = self.ucm.ravel()
+
+
+    # attributes that are never modified after the graph is built, and
+    # are therefore shared by copies of the graph
+    _shared_attributes = (_volume_attributes - frozenset(['ucm', 'ucm_r'])) | \
+        frozenset(['gt', 'superpixels', 'feature_manager',
+                   'merge_priority_function'])
 
     def __copy__(self):
-        """Return a copy of the object and attributes.
+        """Return a copy of the graph, sharing its per-voxel arrays.
+
+        The volumes of the graph (`watershed`, `probabilities` and the
+        arrays derived from them) and the ground truth never change
+        after the graph is built, so the copy shares them, as well as
+        the feature manager and merge priority function. Everything
+        that merges modify is copied: the node and edge attributes, with
+        one ``copy`` call per attribute rather than a recursive deep
+        copy, and the merge queue, tree, records and contingency table.
+        Merging nodes in the copy thus leaves the original unchanged.
         """
-        pr_shape = self.probabilities_r.shape
-        g = super(Rag, self).copy()
-        g.watershed_r = g.watershed.ravel()
-        g.ucm_r = g.ucm.ravel()
-        g.probabilities_r = g.probabilities.reshape(pr_shape)
+        self._load_volumes()
+        g = self.__class__.__new__(self.__class__)
+        memo = {}
+        for name, value in self.__dict__.items():
+            if name in Rag._shared_attributes:
+                g.__dict__[name] = value
+            elif name not in ['node', 'adj', 'edge', 'rig', 'ucm_r',
+                              'ucm_records', 'pending_priorities']:
+                g.__dict__[name] = deepcopy(value, memo)
+        if 'pixel_neighbors' in self.__dict__:
+            g.neighbor_idxs = g.get_neighbor_idxs_fast
+        if g.ucm is not None:
+            g.ucm_r = g.ucm.ravel()
+        g.rig = self.rig.copy()
+        g.ucm_records = list(self.ucm_records)
+        g.pending_priorities = OrderedDict()
+        for qitem, features in self.pending_priorities.values():
+            qitem = deepcopy(qitem, memo)
+            g.pending_priorities[id(qitem)] = (qitem, features)
+        # insert the nodes and edges in the order in which ``deepcopy``
+        # would, since it determines the iteration order of the copy
+        g.node = {}
+        for n, attrs in self.node.iteritems():
+            g.node[n] = _copy_attributes(attrs, memo)
+        g.adj = g.edge = {}
+        edge_attrs = {}
+        for u, neighbors in self.adj.iteritems():
+            g.adj[u] = {}
+            for v, attrs in neighbors.iteritems():
+                if id(attrs) not in edge_attrs:
+                    edge_attrs[id(attrs)] = _copy_attributes(attrs, memo)
+                g.adj[u][v] = edge_attrs[id(attrs)]
         return g
 
 
     def copy(self):
-        """Return a copy of the object and attributes.
+        """Return a copy of the graph, sharing its per-voxel arrays.
+
+        See ``Rag.__copy__``.
         """
         return self.__copy__()
 
@@ -495,47 +952,12 @@ class Rag(Graph):
         -----
         Always allow shared boundaries in this code.
         """
-        if self.watershed.size == 0: return # stop processing for empty graphs
-        if idxs is None:
-            idxs = arange(self.watershed.size)
-            self.add_node(self.boundary_body,
-                    extent=set(flatnonzero(self.watershed==self.boundary_body)))
-        inner_idxs = idxs[self.watershed_r[idxs] != self.boundary_body]
-        for idx in inner_idxs:
-            ns = self.neighbor_idxs(idx)
-            adj_labels = self.watershed_r[ns]
-            nodeid = self.watershed_r[idx]
-            adj_labels = adj_labels[adj_labels != nodeid]
-            edges = None
-            if adj_labels.size > 0:
-                adj_labels = unique(adj_labels)
-                edges = zip(repeat(nodeid), adj_labels)
-            if not self.has_node(nodeid):
-                self.add_node(nodeid, extent=set())
-            if 'entrypoint' not in self.node[nodeid]:
-                entrypoint_tuple = np.unravel_index(idx, self.watershed.shape)
-                self.node[nodeid]['entrypoint'] = np.array(entrypoint_tuple)
-            if 'watershed_ids' not in self.node[nodeid]:
-                self.node[nodeid]['watershed_ids'] = [nodeid]
-            try:
-                self.node[nodeid]['extent'].add(idx)
-            except KeyError:
-                self.node[nodeid]['extent'] = set([idx])
-            try:
-                self.node[nodeid]['size'] += 1
-            except KeyError:
-                self.node[nodeid]['size'] = 1
-
-            if edges is not None:
-                for l1,l2 in edges:
-                    if self.has_edge(l1, l2):
-                        self[l1][l2]['boundary'].add(idx)
-                    else:
-                        self.add_edge(l1, l2, boundary=set([idx]))
+        self.build_graph_from_watershed(idxs=idxs, nozerosfast=True)
 
 
     def build_graph_from_watershed(self, allow_shared_boundaries=True,
-                                   idxs=None, nozerosfast=False):
+                                   idxs=None, nozerosfast=False,
+                                   chunk_size=2**16):
         """Build the graph object from the region labels.
 
         The region labels should have been set ahead of time using
@@ -553,61 +975,400 @@ class Rag(Graph):
             Assume that there are no zero (boundary) labels in the
             volume. By removing this check, graph build time is
             reduced.
+        chunk_size : int, optional
+            The number of voxels whose neighborhoods are examined at
+            once. Larger chunks are faster but use more memory.
 
         Returns
         -------
         None
-        """
-        if nozerosfast:
-            self.build_graph_from_watershed_nozerosfast(idxs)
-            return
 
+        Notes
+        -----
+        The graph is built in bulk: the neighbor labels of each chunk
+        of voxels are examined with array operations to find every
+        (label, neighbor label, voxel) triple, and the triples are then
+        grouped by sorting, so that each node and edge is added to the
+        graph exactly once.
+        """
         if self.watershed.size == 0: return # stop processing for empty graphs
-        if not allow_shared_boundaries:
+        if nozerosfast:
+            allow_shared_boundaries = True
+        elif not allow_shared_boundaries:
             self.ignored_boundary = zeros(self.watershed.shape, bool)
         if idxs is None:
             idxs = arange(self.watershed.size)
-            self.add_node(self.boundary_body,
-                    extent=set(flatnonzero(self.watershed==self.boundary_body)))
+            self.add_node(self.boundary_body, extent=self.index_set(
+                            flatnonzero(self.watershed==self.boundary_body)))
+        idxs = np.asarray(idxs)
         inner_idxs = idxs[self.watershed_r[idxs] != self.boundary_body]
-        for idx in ip.with_progress(inner_idxs, title='Graph ', pbar=self.pbar):
-            ns = self.neighbor_idxs(idx)
-            adj_labels = self.watershed_r[ns]
-            adj_labels = unique(adj_labels)
-            adj_labels = adj_labels[adj_labels.nonzero()]
-            nodeid = self.watershed_r[idx]
-            if nodeid != 0:
-                adj_labels = adj_labels[adj_labels != nodeid]
-                edges = zip(repeat(nodeid), adj_labels)
-                if not self.has_node(nodeid):
-                    self.add_node(nodeid, extent=set())
-                if 'entrypoint' not in self.node[nodeid]:
-                    entrypoint_tuple = np.unravel_index(idx, self.watershed.shape)
-                    self.node[nodeid]['entrypoint'] = np.array(entrypoint_tuple)
-                if 'watershed_ids' not in self.node[nodeid]:
-                    self.node[nodeid]['watershed_ids'] = [nodeid]
-                try:
-                    self.node[nodeid]['extent'].add(idx)
-                except KeyError:
-                    self.node[nodeid]['extent'] = set([idx])
-                try:
-                    self.node[nodeid]['size'] += 1
-                except KeyError:
-                    self.node[nodeid]['size'] = 1
+        self.add_nodes_from_voxels(inner_idxs, nozerosfast)
+        u, v, boundary_idxs = [], [], []
+        chunk_starts = range(0, len(inner_idxs), chunk_size)
+        for start in ip.with_progress(chunk_starts, title='Graph ',
+                                      pbar=self.pbar):
+            chunk = inner_idxs[start:start+chunk_size]
+            cu, cv, cidxs, ignored = self.voxel_edges(chunk,
+                                    allow_shared_boundaries, nozerosfast)
+            u.append(cu)
+            v.append(cv)
+            boundary_idxs.append(cidxs)
+            if len(ignored) > 0:
+                self.ignored_boundary.ravel()[ignored] = True
+        if len(u) > 0:
+            self.add_edges_from_voxels(np.concatenate(u), np.concatenate(v),
+                                       np.concatenate(boundary_idxs))
+
+
+    def build_graph_from_slabs(self, watershed, probabilities,
+                               feature_manager, slab_size=None,
+                               allow_shared_boundaries=True, lowmem=False,
+                               normalize_probabilities=False,
+                               channel_is_oriented=None, nprocessors=1):
+        """Build the graph and feature caches from slabs of the volumes.
+
+        The padded volume is processed `slab_size` planes (along axis 0)
+        at a time, together with one plane on either side so that every
+        voxel sees its full neighborhood. The nodes, edges and feature
+        caches of each slab are folded into the graph, and edges
+        spanning the seam between two slabs are stitched together.
+        Peak memory use therefore depends on the slab size rather than
+        on the volume size.
+
+        With `nprocessors` greater than 1, the slab graphs are built in
+        a pool of worker processes. The workers share the input volumes
+        rather than receiving copies: numpy arrays (including memory
+        maps) are inherited from the parent process, and ``h5py``
+        datasets are reopened read-only by file name.
+
+        The per-voxel attributes of the graph (``watershed``,
+        ``probabilities``, ``ucm``, and so on) are not set here: the
+        input volumes are read in full the first time one of them is
+        accessed, for example when computing a segmentation, so the
+        input volumes must remain readable for the lifetime of the
+        graph.
+
+        Parameters
+        ----------
+        watershed : array-like of int, shape (M, N, ..., P)
+            The superpixel map. Any object supporting numpy-style
+            slicing along the first axis, such as an ``h5py`` dataset.
+        probabilities : array-like of float, shape (M, N, ..., P[, Q])
+            The probability map, as for `watershed`. Channels, if any,
+            must be along the last axis.
+        feature_manager : ``features.base.Null`` object
+            The feature manager to be used by this RAG. Its caches must
+            be sums over voxels (see Notes).
+        slab_size : int, optional
+            The number of planes processed at a time. By default, the
+            volume is split into one slab per process.
+        allow_shared_boundaries, lowmem, normalize_probabilities : bool
+            See ``Rag.__init__``.
+        channel_is_oriented : array-like of bool, optional
+            See ``Rag.__init__``. Orientation maps are not supported.
+        nprocessors : int, optional
+            The number of processes building slab graphs.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError
+            If `slab_size` is not positive, or if the caches of
+            `feature_manager` are not sums over voxels.
+
+        Notes
+        -----
+        Node and edge caches are combined across slabs with the feature
+        manager's ``update_node_cache`` and ``update_edge_cache``. This
+        is exact for managers whose caches are sums of per-voxel values,
+        such as ``moments`` and ``histogram``, up to floating point
+        rounding, but not for managers that look beyond the voxels of
+        the slab, such as ``contact``, ``convex_hull`` or
+        ``orientation``, which are therefore rejected.
+        """
+        global _shared_volumes
+        if slab_size is not None and slab_size < 1:
+            raise ValueError('slab_size must be positive, got %i.' % slab_size)
+        if not _sums_voxel_caches(feature_manager):
+            raise ValueError('The caches of %s are not sums over voxels, so '
+                             'the graph cannot be built from slabs.'
+                             % type(feature_manager).__name__)
+        if np.prod(watershed.shape) == 0:
+            self._set_volumes(array([]), array([]), lowmem,
+                              normalize_probabilities, array([]),
+                              channel_is_oriented)
+            self.set_feature_manager(feature_manager)
+            return
+        normalize = normalize_probabilities and len(probabilities) > 1
+        ws_max, has_zeros, pmin, pmax = None, False, inf, -inf
+        step = slab_size or watershed.shape[0]
+        for z in range(0, watershed.shape[0], step):
+            ws = np.asarray(watershed[z:z+step])
+            ws_max = ws.max() if ws_max is None else max(ws_max, ws.max())
+            has_zeros = has_zeros or (ws == 0).any()
+            if normalize:
+                probs = np.asarray(probabilities[z:z+step], double)
+                pmin, pmax = min(pmin, probs.min()), max(pmax, probs.max())
+        self.boundary_body = ws_max + 1
+        self.volume_size = np.prod(watershed.shape)
+        self.has_zero_boundaries = has_zeros
+        self.pad_thickness = p = 2 if has_zeros else 1
+        spec = dict(boundary_body=self.boundary_body, pad_thickness=p,
+                    shape=tuple(np.array(watershed.shape) + 2 * p),
+                    normalize=(pmin, pmax - pmin) if normalize else None,
+                    feature_manager=feature_manager, compact=self.compact,
+                    nozeros=self.nozeros, connectivity=self.connectivity,
+                    allow_shared_boundaries=allow_shared_boundaries,
+                    channel_is_oriented=channel_is_oriented)
+        nplanes = spec['shape'][0]
+        if slab_size is None:
+            slab_size = -(-nplanes // nprocessors) # one slab per process
+        tasks = [(z0, min(z0 + slab_size, nplanes))
+                 for z0 in range(0, nplanes, slab_size)]
+        if nprocessors == 1:
+            slabs = (_slab_graph(watershed, probabilities, z0, z1, spec)
+                     for z0, z1 in tasks)
+        else:
+            _shared_volumes = tuple(map(_shared_volume,
+                                        [watershed, probabilities]))
+            pool = multiprocessing.Pool(nprocessors)
+            slabs = pool.imap(_shared_slab_graph,
+                              [(z0, z1, spec) for z0, z1 in tasks])
+        self.feature_manager = feature_manager
+        self.add_node(self.boundary_body)
+        edges = OrderedDict()
+        ignored = []
+        try:
+            for nodes, slab_edges, slab_ignored in ip.with_progress(slabs,
+                            length=len(tasks), title='Slabs ', pbar=self.pbar):
+                self._add_slab_graph(nodes, slab_edges, edges)
+                ignored.append(slab_ignored)
+        finally:
+            if nprocessors != 1:
+                pool.close()
+                pool.join()
+                _shared_volumes = None
+        for (u, v), attrs in edges.items():
+            self.add_edge(u, v, attrs)
+        if allow_shared_boundaries or self.nozeros:
+            ignored = None
+        else:
+            ignored = np.concatenate(ignored)
+        self._lazy_volumes = (watershed, probabilities, lowmem,
+                              normalize_probabilities, channel_is_oriented,
+                              ignored)
+
+
+    def _add_slab_graph(self, nodes, slab_edges, edges):
+        """Fold the nodes and edges of a slab graph into this graph.
+
+        Parameters
+        ----------
+        nodes : list of (int, dict)
+            The nodes of the slab and their attributes, as returned by
+            ``_slab_graph``.
+        slab_edges : list of (int, int, array of int, object)
+            The edges of the slab, with their boundaries and caches.
+        edges : OrderedDict
+            The attribute dictionaries of the edges found so far, keyed
+            by sorted node pairs. The edges are added to the graph once
+            all slabs have been seen, in order of first boundary voxel.
+
+        Returns
+        -------
+        None
+        """
+        fm = self.feature_manager
+        for n, attrs in nodes:
+            if 'feature-cache' not in self.node.get(n, {}):
+                self.add_node(n, attrs)
+                continue
+            node = self.node[n]
+            if 'size' in attrs:
+                node['size'] += attrs['size']
+            fm.update_node_cache(self, n, n, node['feature-cache'],
+                                 attrs['feature-cache'])
+        for u, v, boundary, cache in slab_edges:
+            e = (u, v)
+            if e not in edges:
+                edges[e] = {'boundary': self.index_set(boundary),
+                            'feature-cache': cache}
+                continue
+            edges[e]['boundary'].update(boundary if self.compact
+                                        else boundary.tolist())
+            fm.update_edge_cache(self, e, e, edges[e]['feature-cache'], cache)
+
+
+    def add_nodes_from_voxels(self, idxs, nozeros=False):
+        """Add or update the nodes labeling the given voxels.
+
+        Parameters
+        ----------
+        idxs : array of int
+            Linear indices into the padded watershed. The first voxel of
+            each label, in the order given, becomes its entrypoint.
+        nozeros : bool, optional
+            Treat 0 as a regular label rather than as a boundary.
+
+        Returns
+        -------
+        None
+        """
+        labels = self.watershed_r[idxs]
+        if not nozeros:
+            idxs, labels = idxs[labels != 0], labels[labels != 0]
+        if len(labels) == 0:
+            return
+        order = np.argsort(labels, kind='mergesort')
+        sorted_idxs = idxs[order]
+        nodes, starts = unique(labels[order], return_index=True)
+        sizes = np.diff(np.append(starts, len(labels)))
+        extents = np.split(sorted_idxs, starts[1:])
+        for i in np.argsort(order[starts], kind='mergesort'):
+            nodeid = nodes[i].item()
+            if not self.has_node(nodeid):
+                self.add_node(nodeid, extent=self.index_set())
+            attrs = self.node[nodeid]
+            if 'entrypoint' not in attrs:
+                attrs['entrypoint'] = np.array(
+                    unravel_index(sorted_idxs[starts[i]], self.watershed.shape))
+            if 'watershed_ids' not in attrs:
+                attrs['watershed_ids'] = ChainedList([nodeid])
+            if 'extent' not in attrs:
+                attrs['extent'] = self.index_set()
+            attrs['extent'].update(extents[i] if self.compact
+                                   else extents[i].tolist())
+            attrs['size'] = attrs.get('size', 0) + int(sizes[i])
+
+
+    def voxel_edges(self, idxs, allow_shared_boundaries=True, nozeros=False):
+        """Find the edges to whose boundary each of the given voxels belongs.
+
+        A labeled voxel belongs to the boundary between its label and
+        every other nonzero label in its neighborhood. A 0-labeled voxel
+        belongs to the boundaries between every pair of its nonzero
+        neighboring labels, or, if one of these is the boundary body,
+        only to the boundaries between the boundary body and the others.
+
+        Parameters
+        ----------
+        idxs : array of int
+            Linear indices into the padded watershed, none of which may
+            belong to the boundary body.
+        allow_shared_boundaries : bool, optional
+            If ``False``, voxels belonging to more than one boundary are
+            not added to any of them, and are returned as ignored.
+        nozeros : bool, optional
+            Treat 0 as a regular label rather than as a boundary.
+
+        Returns
+        -------
+        u, v : array of int
+            The labels at either end of each edge.
+        boundary_idxs : array of int
+            The boundary voxel contributed to each edge.
+        ignored : array of int
+            The voxels that were ignored because they were shared.
+        """
+        labels = self.watershed_r[idxs]
+        nbrs = self.watershed_r[self.neighbor_idxs(idxs)]
+        if nozeros:
+            fill = labels[:, newaxis]
+            invalid = (nbrs == fill)
+        else:
+            fill = 0
+            invalid = (nbrs == labels[:, newaxis]) | (nbrs == 0)
+        nbrs = np.where(invalid, fill, nbrs)
+        nbrs.sort(axis=1)
+        distinct = (nbrs != fill)
+        distinct[:, 1:] &= (nbrs[:, 1:] != nbrs[:, :-1])
+        rows, cols = distinct.nonzero() # sorted by voxel, then by label
+        adj = nbrs[rows, cols]
+        src = labels[rows]
+        if nozeros:
+            edge_rows, u, v = [rows], [src], [adj]
+        else:
+            in_region = (src != 0)
+            edge_rows, u, v = [rows[in_region]], [src[in_region]], \
+                                                            [adj[in_region]]
+            zrows, zadj = rows[~in_region], adj[~in_region]
+            touches_body = zeros(len(idxs), bool)
+            touches_body[zrows[zadj == self.boundary_body]] = True
+            for d in range(1, nbrs.shape[1]):
+                pair = (zrows[d:] == zrows[:-d]) & \
+                       (~touches_body[zrows[d:]] |
+                        (zadj[d:] == self.boundary_body))
+                edge_rows.append(zrows[d:][pair])
+                u.append(zadj[:-d][pair])
+                v.append(zadj[d:][pair])
+        edge_rows, u, v = map(np.concatenate, [edge_rows, u, v])
+        ignored = idxs[:0]
+        if not allow_shared_boundaries:
+            num_edges = bincount(edge_rows, minlength=len(idxs))
+            ignored = idxs[num_edges > 1]
+            single = num_edges[edge_rows] == 1
+            edge_rows, u, v = edge_rows[single], u[single], v[single]
+        return u, v, idxs[edge_rows], ignored
+
+
+    def add_edges_from_voxels(self, u, v, boundary_idxs):
+        """Add or update edges from a list of (label, label, voxel) triples.
+
+        Parameters
+        ----------
+        u, v : array of int
+            The labels at either end of each edge, in any order.
+        boundary_idxs : array of int
+            The boundary voxel contributed to each edge.
+
+        Returns
+        -------
+        None
+        """
+        if len(u) == 0:
+            return
+        u, v = np.minimum(u, v), np.maximum(u, v)
+        order = np.lexsort((boundary_idxs, v, u))
+        u, v, boundary_idxs = u[order], v[order], boundary_idxs[order]
+        new_edge = ones(len(u), bool)
+        new_edge[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        starts = flatnonzero(new_edge)
+        ends = np.append(starts[1:], len(u))
+        for i in np.argsort(boundary_idxs[starts], kind='mergesort'):
+            s, e = starts[i], ends[i]
+            l1, l2 = u[s].item(), v[s].item()
+            boundary = boundary_idxs[s:e]
+            if self.has_edge(l1, l2):
+                self[l1][l2]['boundary'].update(boundary if self.compact
+                                                else boundary.tolist())
+            elif self.compact: # the runs are sorted and unique already
+                self.add_edge(l1, l2, boundary=IndexSet.from_sorted(boundary))
             else:
-                if len(adj_labels) == 0: continue
-                if adj_labels[-1] != self.boundary_body:
-                    edges = list(combinations(adj_labels, 2))
-                else:
-                    edges = list(product([self.boundary_body], adj_labels[:-1]))
-            if allow_shared_boundaries or len(edges) == 1:
-                for l1,l2 in edges:
-                    if self.has_edge(l1, l2):
-                        self[l1][l2]['boundary'].add(idx)
-                    else:
-                        self.add_edge(l1, l2, boundary=set([idx]))
-            elif len(edges) > 1:
-                self.ignored_boundary.ravel()[idx] = True
+                self.add_edge(l1, l2, boundary=set(boundary.tolist()))
+
+
+    def index_set(self, idxs=()):
+        """Return a set of voxel indices in this graph's storage format.
+
+        Parameters
+        ----------
+        idxs : iterable of int, optional
+            The initial elements of the set.
+
+        Returns
+        -------
+        s : set or indexset.IndexSet
+            An ``IndexSet`` if the graph was built with `compact=True`,
+            or a Python ``set`` otherwise.
+        """
+        if self.compact:
+            return IndexSet(idxs)
+        if isinstance(idxs, np.ndarray):
+            idxs = idxs.tolist()
+        return set(idxs)
 
 
     def set_feature_manager(self, feature_manager):
@@ -626,25 +1387,47 @@ class Rag(Graph):
         self.compute_feature_caches()
 
 
-    def compute_feature_caches(self):
+    def compute_feature_caches(self, nodes=None, edges=None):
         """Use the feature manager to compute node and edge feature caches.
 
         Parameters
         ----------
-        None
+        nodes : list of int, optional
+            Compute the caches of only these nodes. (Default: all.)
+        edges : list of tuple of int, optional
+            Compute the caches of only these edges. (Default: all.)
 
         Returns
         -------
         None
         """
-        for n in ip.with_progress(
-                    self.nodes(), title='Node caches ', pbar=self.pbar):
-            self.node[n]['feature-cache'] = \
-                            self.feature_manager.create_node_cache(self, n)
-        for n1, n2 in ip.with_progress(
-                    self.edges(), title='Edge caches ', pbar=self.pbar):
-            self[n1][n2]['feature-cache'] = \
-                            self.feature_manager.create_edge_cache(self, n1, n2)
+        fm = self.feature_manager
+        if nodes is None:
+            nodes = self.nodes()
+        if edges is None:
+            edges = self.edges()
+        if hasattr(fm, 'create_all_node_caches') and len(nodes) > 0 and \
+                            all('extent' in self.node[n] for n in nodes):
+            idxs, labels = label_index_sets(
+                                    [self.node[n]['extent'] for n in nodes])
+            caches = fm.create_all_node_caches(self, nodes, idxs, labels)
+            for n, cache in izip(nodes, caches):
+                self.node[n]['feature-cache'] = cache
+        else:
+            for n in ip.with_progress(
+                        nodes, title='Node caches ', pbar=self.pbar):
+                self.node[n]['feature-cache'] = fm.create_node_cache(self, n)
+        if hasattr(fm, 'create_all_edge_caches') and len(edges) > 0:
+            idxs, labels = label_index_sets(
+                            [self[n1][n2]['boundary'] for n1, n2 in edges])
+            caches = fm.create_all_edge_caches(self, edges, idxs, labels)
+            for (n1, n2), cache in izip(edges, caches):
+                self[n1][n2]['feature-cache'] = cache
+        else:
+            for n1, n2 in ip.with_progress(
+                        edges, title='Edge caches ', pbar=self.pbar):
+                self[n1][n2]['feature-cache'] = \
+                                        fm.create_edge_cache(self, n1, n2)
 
 
     def get_neighbor_idxs_fast(self, idxs):
@@ -838,7 +1621,9 @@ class Rag(Graph):
         ----------
         gt : array of int
             A ground truth segmentation of the same volume passed to
-            ``set_watershed``.
+            ``set_watershed``. For a graph built from slabs, the
+            contingency table is computed one plane at a time, without
+            reading in the superpixel volume.
 
         Returns
         -------
@@ -848,19 +1633,24 @@ class Rag(Graph):
             gtm = gt.max()+1
             gt_ignore = [0, gtm] if (gt==0).any() else [gtm]
             seg_ignore = [0, self.boundary_body] if \
-                        (self.watershed==0).any() else [self.boundary_body]
-            self.gt = morpho.pad(gt, gt_ignore)
-            self.rig = contingency_table(self.watershed, self.gt,
-                                         ignore_seg=seg_ignore,
-                                         ignore_gt=gt_ignore)
+                        self.has_zero_boundaries else [self.boundary_body]
+            self.gt = morpho.pad(gt, [gtm] * self.pad_thickness)
+            if '_lazy_volumes' in self.__dict__:
+                self.rig = _planewise_contingency_table(
+                    self._lazy_volumes[0], gt, seg_ignore, gt_ignore)
+            else:
+                self.rig = contingency_table(self.watershed, self.gt,
+                                             ignore_seg=seg_ignore,
+                                             ignore_gt=gt_ignore)
+            self.init_split_vi()
         else:
             self.gt = None
             # null pattern to transparently allow merging of nodes.
             # Bonus feature: counts how many sp's went into a single node.
-            try:
-                self.rig = ones(2 * self.watershed.max() + 1)
-            except ValueError:
-                self.rig = ones(2 * self.number_of_nodes() + 1)
+            # the padded watershed's maximum is the boundary body
+            n = max(self.boundary_body + 1, self.number_of_nodes())
+            self.rig = ContingencyTable(csr_matrix(
+                (ones(n), zeros(n, int), arange(n + 1)), shape=(n, 1)))
 
 
     def set_exclusions(self, excl):
@@ -904,24 +1694,34 @@ class Rag(Graph):
         Returns
         -------
         mq : MergeQueue object
-            A MergeQueue is a Python ``deque`` with a specific element
-            structure: a list of length 4 containing:
+            A MergeQueue is an addressable binary heap with a specific
+            element structure: a list of length 4 containing:
                  - the merge priority (any ordered type)
                  - a 'valid' flag
                  - and the two nodes in arbitrary order
-            The valid flag allows one to "remove" elements from the
-            queue in O(1) time by setting the flag to ``False``. Then,
-            one checks the flag when popping elements and ignores those
-            marked as invalid.
+            The queue tracks the position of each item, so items can
+            be removed or have their priority changed in O(log n)
+            time. The valid flag is ``False`` for items that have been
+            popped or removed.
 
             One other specific feature is that there are back-links from
             edges to their corresponding queue items so that when nodes
-            are merged, affected edges can be invalidated and reinserted
-            in the queue with a new priority.
+            are merged, affected edges can be removed or updated in
+            place in the queue with a new priority.
+
+            If the merge priority function supports batched evaluation
+            (see ``classifier_probability``), all edges are scored in a
+            single call.
         """
         queue_items = []
-        for l1, l2 in self.real_edges_iter():
-            w = self.merge_priority_function(self,l1,l2)
+        edges = self.real_edges()
+        mpf = self.merge_priority_function
+        if hasattr(mpf, 'batch') and len(edges) > 0:
+            features = [mpf.features(self, l1, l2) for l1, l2 in edges]
+            weights = mpf.batch(self, edges, features)
+        else:
+            weights = [mpf(self, l1, l2) for l1, l2 in edges]
+        for (l1, l2), w in izip(edges, weights):
             qitem = [w, True, l1, l2]
             queue_items.append(qitem)
             self[l1][l2]['qlink'] = qitem
@@ -969,8 +1769,10 @@ class Rag(Graph):
         if self.merge_queue.is_empty():
             self.merge_queue = self.build_merge_queue()
         history, scores, evaluation = [], [], []
-        while len(self.merge_queue) > 0 and \
-                                        self.merge_queue.peek()[0] < threshold:
+        while True:
+            qitem = self.merge_queue.peek()
+            if qitem is None or qitem[0] >= threshold:
+                break
             merge_priority, _, n1, n2 = self.merge_queue.pop()
             self.update_frozen_sets(n1, n2)
             self.merge_nodes(n1, n2, merge_priority)
@@ -984,6 +1786,38 @@ class Rag(Graph):
             return history, scores, evaluation
 
 
+    def agglomerate_to_thresholds(self, thresholds, callback=None):
+        """Agglomerate once through several thresholds, in increasing order.
+
+        The merge queue is run a single time. When each threshold is
+        reached, a ``Snapshot`` of the segmentation is taken; snapshots
+        record only the map from superpixels to bodies, and compute or
+        write segmentation volumes on demand.
+
+        Parameters
+        ----------
+        thresholds : list of float
+            The thresholds at which to take snapshots.
+        callback : function, optional
+            A function called with each snapshot as soon as it is taken,
+            for example, to start writing it out in a background thread
+            (see ``Snapshot.write_segmentation``) while merging continues.
+
+        Returns
+        -------
+        snapshots : list of Snapshot
+            The snapshots, sorted by threshold.
+        """
+        snapshots = []
+        for threshold in sorted(thresholds):
+            self.agglomerate(threshold)
+            snapshot = self.snapshot(threshold)
+            if callback is not None:
+                callback(snapshot)
+            snapshots.append(snapshot)
+        return snapshots
+
+
     def agglomerate_count(self, stepsize=100, save_history=False):
         """Agglomerate until 'stepsize' merges have been made.
 
@@ -1022,7 +1856,7 @@ class Rag(Graph):
         history, evaluation = [], []
         i = 0
         for i in range(stepsize):
-            if len(self.merge_queue) == 0:
+            if self.merge_queue.peek() is None:
                 break
             merge_priority, _, n1, n2 = self.merge_queue.pop()
             i += 1
@@ -1069,7 +1903,10 @@ class Rag(Graph):
         self.merge_queue.finish()
         self.rebuild_merge_queue()
         max_score = max([qitem[0] for qitem in self.merge_queue.q])
-        self.ucm -= max_score
+        if self.eager_ucm and self.ucm is not None:
+            self.ucm -= max_score
+        self.ucm_records = [(boundary, height - max_score)
+                            for boundary, height in self.ucm_records]
         for n in self.tree.nodes():
             self.tree.node[n]['w'] -= max_score
 
@@ -1088,7 +1925,9 @@ class Rag(Graph):
                           max_num_samples=np.inf,
                           classifier='random forest',
                           active_function=classifier_probability,
-                          mpf=boundary_mean):
+                          mpf=boundary_mean,
+                          trainer=None,
+                          store=None):
         """Agglomerate while comparing to ground truth & classifying merges.
 
         Parameters
@@ -1132,11 +1971,12 @@ class Rag(Graph):
             Keep the training data from all epochs (rather than just
             the most recent one).
         unique : bool, optional
-            Remove duplicate feature vectors.
+            Remove duplicate feature vectors, keeping the first example
+            of each in the data of all epochs.
         random_state : int, optional
             If provided, this parameter is passed to `get_classifier`
             to set the random state and allow consistent results across
-            tests.
+            tests. Ignored if `trainer` is given.
         max_num_epochs : int, optional
             Do not train for longer than this (this argument *may*
             override the `min_num_samples` argument).
@@ -1146,13 +1986,25 @@ class Rag(Graph):
             Train for no more than this number of samples.
         classifier : string, optional
             Any valid classifier descriptor. See
-            ``gala.classify.get_classifier()``
+            ``gala.classify.get_classifier()``. Ignored if `trainer`
+            is given.
         active_function : function (feat. map, classifier) -> function, optional
             Use this to create the next priority function after an
             epoch.
         mpf : function (Rag, node, node) -> float
             A merge priority function to use when ``priority_mode`` is
             ``'custom'``.
+        trainer : classify.EpochTrainer, optional
+            Fits the classifier of each epoch, for example with several
+            processes or by warm-starting a forest, and records the fit
+            time and number of samples of each epoch in its
+            ``history``, which is reset first. By default, each epoch
+            fits a new `classifier` to all of the data.
+        store : classify.UniqueTrainingData, optional
+            With `memory` and `unique`, accumulate the data of all
+            epochs in this store, for example to keep it in an HDF5
+            file. Data already in the store is kept and returned. By
+            default, a new store is kept in memory.
 
         Returns
         -------
@@ -1176,6 +2028,13 @@ class Rag(Graph):
             - `labeling_mode`: ``'rand-sign'``
             - `memory`: ``False``
 
+        Each epoch draws one number from the global ``numpy.random``
+        state, and seeds ``random`` and ``numpy.random`` with it while
+        agglomerating, as ``learn_agglomerate_volumes`` does for each
+        volume. The global state is restored after the agglomeration,
+        so random priorities are reproducible by seeding
+        ``numpy.random`` before the call.
+
         References
         ----------
         .. [1] Nunez-Iglesias et al, Machine learning of hierarchical
@@ -1185,63 +2044,13 @@ class Rag(Graph):
 
         See Also
         --------
-        ``Rag.__init__``
+        ``Rag.__init__``, ``learn_agglomerate_volumes``
         """
-        learning_mode = learning_mode.lower()
-        labeling_mode = labeling_mode.lower()
-        priority_mode = priority_mode.lower()
-        if priority_mode == 'mean' and unique:
-            max_num_epochs = 2 if learn_flat else 1
-        if priority_mode in ['random', 'mean'] and not memory:
-            max_num_epochs = 1
-        label_type_keys = {'assignment':0, 'vi-sign':1, 'rand-sign':2}
-        if type(gts) != list:
-            gts = [gts] # allow using single ground truth as input
-        master_ctables = \
-                [contingency_table(self.get_segmentation(), gt) for gt in gts]
-        alldata = []
-        data = [[],[],[],[]]
-        for num_epochs in range(max_num_epochs):
-            ctables = deepcopy(master_ctables)
-            if len(data[0]) > min_num_samples and num_epochs >= min_num_epochs:
-                break
-            if learn_flat and num_epochs == 0:
-                alldata.append(self.learn_flat(gts, feature_map))
-                data = unique_learning_data_elements(alldata) if memory \
-                    else alldata[-1]
-                continue
-            g = self.copy()
-            if priority_mode == 'mean':
-                g.merge_priority_function = boundary_mean
-            elif num_epochs > 0 and priority_mode == 'active' or \
-                num_epochs % 2 == 1 and priority_mode == 'mixed':
-                if random_state == None:
-                    cl = get_classifier(classifier)
-                else:
-                    cl = get_classifier(classifier, random_state=random_state)
-                feat, lab = classify.sample_training_data(
-                    data[0], data[1][:, label_type_keys[labeling_mode]],
-                    max_num_samples)
-                cl = cl.fit(feat, lab)
-                g.merge_priority_function = active_function(feature_map, cl)
-            elif priority_mode == 'random' or \
-                (priority_mode == 'active' and num_epochs == 0):
-                g.merge_priority_function = random_priority
-            elif priority_mode == 'custom':
-                g.merge_priority_function = mpf
-            g.show_progress = False # bug in MergeQueue usage causes
-                                    # progressbar crash.
-            g.rebuild_merge_queue()
-            alldata.append(g._learn_agglomerate(ctables, feature_map,
-                                                learning_mode, labeling_mode))
-            if memory:
-                if unique:
-                    data = unique_learning_data_elements(alldata)
-                else:
-                    data = concatenate_data_elements(alldata)
-            else:
-                data = alldata[-1]
-            logging.debug('data size %d at epoch %d'%(len(data[0]), num_epochs))
+        data, alldata, _ = _learn_agglomerate_graphs([self], [gts],
+            feature_map, 1, min_num_samples, learn_flat, learning_mode,
+            labeling_mode, priority_mode, memory, unique, random_state,
+            max_num_epochs, min_num_epochs, max_num_samples, classifier,
+            active_function, mpf, trainer, store)
         return data, alldata
 
 
@@ -1277,10 +2086,67 @@ class Rag(Graph):
         if type(gts) != list:
             gts = [gts] # allow using single ground truth as input
         ctables = [contingency_table(self.get_segmentation(), gt) for gt in gts]
-        assignments = [(ct == ct.max(axis=1)[:,newaxis]) for ct in ctables]
-        return map(array, zip(*[
-                self.learn_edge(e, ctables, assignments, feature_map)
-                for e in self.real_edges()]))
+        return self.learn_edges(self.real_edges(), ctables, feature_map)
+
+
+    def learn_edges(self, edges, ctables, feature_map):
+        """Determine whether each of many edges should be merged.
+
+        This returns the same data as calling ``learn_edge`` on each
+        edge, but labels all edges at once: the features come from a
+        single ``compute_all_features`` call if `feature_map` supports
+        it, and the labels from the vectorized ``compute_true_deltas``.
+        The few edges whose label could be changed by the rounding of
+        the latter are labeled one by one, as ``learn_edge`` would.
+
+        Parameters
+        ----------
+        edges : list of (int, int) tuple
+            Edges in the graph.
+        ctables : list of ContingencyTable
+            See ``learn_edge``.
+        feature_map : function (Rag, node, node) -> array of float
+            The map from node pairs to a feature vector.
+
+        Returns
+        -------
+        data : list of array
+            The features, labels, weights, and edges, as returned by
+            ``learn_flat``.
+        """
+        if len(edges) == 0:
+            return []
+        n1s, n2s = np.array(edges).T
+        if hasattr(feature_map, 'compute_all_features'):
+            features = feature_map.compute_all_features(self, edges)
+        else:
+            features = array([feature_map(self, n1, n2).ravel()
+                              for n1, n2 in edges])
+        sizes = [self.node[n]['size'] for n in n1s], \
+                [self.node[n]['size'] for n in n2s]
+        s1, s2 = np.array(sizes, np.int64)
+        py1, py2 = s1.astype(double)/self.volume_size, \
+                   s2.astype(double)/self.volume_size
+        py = py1+py2
+        weights = np.transpose([
+            -(py1*log2(py1) + py2*log2(py2) - py*log2(py)),
+            (s1*s2).astype(double)/nchoosek(self.volume_size,2)])
+        same = [ct.assignment_ids(n1s) == ct.assignment_ids(n2s)
+                for ct in ctables]
+        deltas, errors = zip(*[compute_true_deltas(ct, n1s, n2s,
+                               self.volume_size) for ct in ctables])
+        deltas, errors = sum(deltas), sum(errors)
+        labels = sign(np.transpose([
+            mean(np.where(same, -1, 1), axis=0),
+            deltas[:, 0] / len(ctables),
+            -deltas[:, 1] / len(ctables)]))
+        for i in flatnonzero((abs(deltas) <= errors).any(axis=1)):
+            labels[i] = self._edge_labels(n1s[i], n2s[i], ctables)
+        frozen = [n1 in self.frozen_nodes or n2 in self.frozen_nodes or
+                  (n1, n2) in self.frozen_edges for n1, n2 in edges]
+        labels[(labels == 0) | np.isnan(labels)] = 1
+        labels[np.array(frozen)] = 1
+        return [features, labels, weights, array(edges)]
 
 
     def learn_edge(self, edge, ctables, assignments, feature_map):
@@ -1290,12 +2156,14 @@ class Rag(Graph):
         ----------
         edge : (int, int) tuple
             An edge in the graph.
-        ctables : list of array
+        ctables : list of ContingencyTable
             A list of contingency tables determining overlap between the
-            current segmentation and the ground truth.
-        assignments : list of array
-            Similar to the contingency tables, but each row is thresholded
-            so each segment corresponds to exactly one ground truth segment.
+            current segmentation and the ground truth. Each segment is
+            assigned to the ground truth segment(s) it overlaps most.
+        assignments : object
+            Ignored. Deprecated: the assignments of segments to ground
+            truth segments are now read from `ctables`, and this
+            parameter will be removed in a future version.
         feature_map : function (Rag, node, node) -> array of float
             The map from node pairs to a feature vector.
 
@@ -1321,15 +2189,7 @@ class Rag(Graph):
         weights = \
             compute_local_vi_change(s1, s2, self.volume_size), \
             compute_local_rand_change(s1, s2, self.volume_size)
-        # Get the fraction of times that n1 and n2 assigned to
-        # same segment in the ground truths
-        cont_labels = [
-            [(-1)**(a[n1,:]==a[n2,:]).all() for a in assignments],
-            [compute_true_delta_vi(ctable, n1, n2) for ctable in ctables],
-            [-compute_true_delta_rand(ctable, n1, n2, self.volume_size)
-                                                    for ctable in ctables]
-        ]
-        labels = [sign(mean(cont_label)) for cont_label in cont_labels]
+        labels = self._edge_labels(n1, n2, ctables)
         if any(map(isnan, labels)) or any([label == 0 for l in labels]):
             logging.debug('NaN or 0 labels found. ' +
                                     ' '.join(map(str, [labels, (n1, n2)])))
@@ -1339,15 +2199,29 @@ class Rag(Graph):
         return features, labels, weights, (n1, n2)
 
 
+    def _edge_labels(self, n1, n2, ctables):
+        """Return the three labels of an edge, before any overrides."""
+        # Get the fraction of times that n1 and n2 assigned to
+        # same segment in the ground truths
+        cont_labels = [
+            [(-1)**(ct.assignment(n1) == ct.assignment(n2))
+                                                    for ct in ctables],
+            [compute_true_delta_vi(ctable, n1, n2) for ctable in ctables],
+            [-compute_true_delta_rand(ctable, n1, n2, self.volume_size)
+                                                    for ctable in ctables]
+        ]
+        return [sign(mean(cont_label)) for cont_label in cont_labels]
+
+
     def _learn_agglomerate(self, ctables, feature_map, gt_dts,
                         learning_mode='strict', labeling_mode='assignment'):
         """Learn the agglomeration process using various strategies.
 
         Parameters
         ----------
-        ctables : array of float or list thereof
+        ctables : list of ContingencyTable
             One or more contingency tables between own segments and gold
-            standard segmentations
+            standard segmentations. They are updated as segments merge.
         feature_map : function (Rag, node, node) -> array of float
             The map from node pairs to a feature vector. This must
             consist either of uncached features or of the cache used
@@ -1372,24 +2246,17 @@ class Rag(Graph):
                 - the list of merged edges ``(n_edges, 2)``.
         """
         label_type_keys = {'assignment':0, 'vi-sign':1, 'rand-sign':2}
-        assignments = [(ct == ct.max(axis=1)[:,newaxis]) for ct in ctables]
         g = self
         data = []
-        while len(g.merge_queue) > 0:
+        while g.merge_queue.peek() is not None:
             merge_priority, valid, n1, n2 = g.merge_queue.pop()
-            dat = g.learn_edge((n1,n2), ctables, assignments, feature_map)
+            dat = g.learn_edge((n1,n2), ctables, None, feature_map)
             data.append(dat)
             label = dat[1][label_type_keys[labeling_mode]]
             if learning_mode != 'strict' or label < 0:
                 node_id = g.merge_nodes(n1, n2, merge_priority)
-                for ctable, assignment in zip(ctables, assignments):
-                    ctable[node_id] = ctable[n1] + ctable[n2]
-                    ctable[n1] = 0
-                    ctable[n2] = 0
-                    assignment[node_id] = (ctable[node_id] ==
-                                           ctable[node_id].max())
-                    assignment[n1] = 0
-                    assignment[n2] = 0
+                for ctable in ctables:
+                    ctable.merge(n1, n2, node_id)
         return map(array, zip(*data))
 
 
@@ -1463,7 +2330,10 @@ class Rag(Graph):
         except KeyError:
             return
         w = edge['weight'] if edge.has_key('weight') else -inf
-        if self.ucm is not None:
+        if not self.eager_ucm:
+            self.max_merge_score = max(self.max_merge_score, w)
+            self.record_ucm(edge['boundary'], self.max_merge_score)
+        elif self.ucm is not None:
             self.max_merge_score = max(self.max_merge_score, w)
             idxs = list(edge['boundary'])
             self.ucm_r[idxs] = self.max_merge_score
@@ -1482,10 +2352,37 @@ class Rag(Graph):
         None
         """
         edge = self[n1][n2]
-        if self.ucm is not None:
+        if not self.eager_ucm:
+            self.record_ucm(edge['boundary'], inf)
+        elif self.ucm is not None:
             self.ucm_r[list(edge['boundary'])] = inf
 
 
+    def record_ucm(self, boundary, height):
+        """Record that the UCM at `boundary` is set to `height`.
+
+        The records are kept in merge order, and later ones take
+        precedence where boundaries overlap.
+
+        Parameters
+        ----------
+        boundary : set or indexset.IndexSet of int
+            The padded linear indices of the boundary voxels. The
+            record keeps a copy, since the edge may be updated later.
+        height : float
+            The value of the UCM at `boundary`.
+
+        Returns
+        -------
+        None
+        """
+        if isinstance(boundary, IndexSet):
+            boundary = boundary.copy()
+        else:
+            boundary = np.fromiter(boundary, np.intp, len(boundary))
+        self.ucm_records.append((boundary, height))
+
+
     def rename_node(self, old, new):
         """Rename node `old` to `new`, updating edges and weights.
 
@@ -1496,17 +2393,22 @@ class Rag(Graph):
         new : int
             The new node id.
         """
-        self.add_node(new, attr_dict=self.node[old])
-        self.add_edges_from(
-            [(new, v, self[old][v]) for v in self.neighbors(old)])
-        for v in self.neighbors(new):
-            qitem = self[new][v].get('qlink', None)
+        self.node[new] = self.node[old]
+        self.adj[new] = nbrs = self.adj[old]
+        del self.node[old], self.adj[old]
+        for v, data in nbrs.iteritems():
+            # move the edge in place: its attributes are not copied
+            v_nbrs = self.adj[v]
+            v_nbrs[new] = data
+            del v_nbrs[old]
+            qitem = data.get('qlink', None)
             if qitem is not None:
                 if qitem[2] == old:
                     qitem[2] = new
                 else:
                     qitem[3] = new
-        self.remove_node(old)
+                if qitem in self.merge_queue:
+                    self.merge_queue.update(qitem)
 
 
     def merge_nodes(self, n1, n2, merge_priority=0.0):
@@ -1539,7 +2441,7 @@ class Rag(Graph):
         else:
             self.node[n1]['exclusions'].update(self.node[n2]['exclusions'])
         self.update_ucm(n1, n2)
-        w = self[n1][n2].get('weight', merge_priority)
+        w = self.adj[n1].get(n2, {}).get('weight', merge_priority)
         self.node[n1]['size'] += self.node[n2]['size']
         self.node[n1]['watershed_ids'] += self.node[n2]['watershed_ids']
 
@@ -1551,18 +2453,20 @@ class Rag(Graph):
             self.merge_edge_properties((n2, n), (n1, n))
         # this if statement enables merging of non-adjacent nodes
         if self.has_edge(n1,n2) and self.has_zero_boundaries:
-            sp2segment = self.tree.get_map(w)
-            self.refine_post_merge_boundaries(n1, n2, sp2segment)
+            self.refine_post_merge_boundaries(n1, n2, self.sp2segment)
         try:
             self.merge_queue.invalidate(self[n1][n2]['qlink'])
         except KeyError:
             pass
         node_id = self.tree.merge(n1, n2, w)
+        self.sp2segment.union(n1, n2, node_id)
         self.remove_node(n2)
         self.rename_node(n1, node_id)
-        self.rig[node_id] = self.rig[n1] + self.rig[n2]
-        self.rig[n1] = 0
-        self.rig[n2] = 0
+        row1, row2 = self.rig.row(n1), self.rig.row(n2)
+        self.rig.merge(n1, n2, node_id)
+        if self.gt is not None:
+            self.update_split_vi(row1, row2, self.rig.row(node_id))
+        self.flush_merge_queue()
         return node_id
 
 
@@ -1573,8 +2477,8 @@ class Rag(Graph):
         ----------
         n1, n2 : int
             Nodes determining the edge for which to update the UCM.
-        sp2segment : array of int
-            The most recent map from superpixels to segments.
+        sp2segment : array of int or UnionFind
+            The current map from superpixels to segments.
         """
         boundary = array(list(self[n1][n2]['boundary']))
         boundary_neighbor_pixels = sp2segment[self.watershed_r[
@@ -1585,16 +2489,24 @@ class Rag(Graph):
         check = True - add
         self.feature_manager.pixelwise_update_node_cache(self, n1,
                         self.node[n1]['feature-cache'], boundary[add])
+        # find the segments, other than n1, next to each checked pixel
+        pixels = boundary[check]
+        labels = boundary_neighbor_pixels[check]
+        rows = np.repeat(np.arange(len(pixels)), labels.shape[1])
+        labels = labels.ravel()
+        keep = ((labels != 0) & (labels != n1) &
+                (labels != self.boundary_body))
+        rows, labels = rows[keep], labels[keep]
+        base = labels.max() + 1 if len(labels) > 0 else 1
+        pairs = np.unique(rows * base + labels)
+        rows, labels = pairs // base, pairs % base
+        # group the pixels by segment, in order of first appearance
+        order = np.argsort(labels, kind='mergesort')
+        segments, starts = np.unique(labels[order], return_index=True)
+        groups = np.split(pixels[rows[order]], starts[1:])
         boundaries_to_edit = {}
-        for px in boundary[check]:
-            px_neighbors = self.neighbor_idxs(px)
-            labels = np.unique(sp2segment[self.watershed_r[px_neighbors]])
-            for lb in labels:
-                if lb not in [0, n1, self.boundary_body]:
-                    try:
-                        boundaries_to_edit[(n1,lb)].append(px)
-                    except KeyError:
-                        boundaries_to_edit[(n1,lb)] = [px]
+        for i in np.argsort(rows[order][starts], kind='mergesort'):
+            boundaries_to_edit[(n1, segments[i])] = groups[i].tolist()
         for u, v in boundaries_to_edit.keys():
             idxs = set(boundaries_to_edit[(u,v)])
             if self.has_edge(u, v):
@@ -1603,7 +2515,7 @@ class Rag(Graph):
                 self.feature_manager.pixelwise_update_edge_cache(self, u, v,
                                     self[u][v]['feature-cache'], list(idxs))
             else:
-                self.add_edge(u, v, boundary=set(idxs))
+                self.add_edge(u, v, boundary=self.index_set(idxs))
                 self[u][v]['feature-cache'] = \
                     self.feature_manager.create_edge_cache(self, u, v)
             self.update_merge_queue(u, v)
@@ -1633,7 +2545,7 @@ class Rag(Graph):
             # dfs_preorder_nodes returns iter, convert to list
             source_node, other_nodes = node_dfs[0], node_dfs[1:]
             for current_node in other_nodes:
-                self.merge_nodes(source_node, current_node)
+                source_node = self.merge_nodes(source_node, current_node)
 
 
     def split_node(self, u, n=2, **kwargs):
@@ -1662,6 +2574,7 @@ class Rag(Graph):
         if labels[0] == 0:
             labels = labels[1:]
         self.remove_node(u)
+        self.sp2segment.reset(labels)
         self.build_graph_from_watershed(
             idxs=array(list(set().union(node_extent, node_borders)))
         )
@@ -1683,7 +2596,8 @@ class Rag(Graph):
         u, v = dst
         w, x = src
         if not self.has_edge(u,v):
-            self.add_edge(u, v, attr_dict=self[w][x])
+            # share, rather than copy, the attributes of the removed edge
+            self.adj[u][v] = self.adj[v][u] = self[w][x]
         else:
             self[u][v]['boundary'].update(self[w][x]['boundary'])
             self.feature_manager.update_edge_cache(self, (u, v), (w, x),
@@ -1706,19 +2620,70 @@ class Rag(Graph):
         Returns
         -------
         None
+
+        Notes
+        -----
+        If the merge priority function supports batched evaluation, the
+        features of the edge are computed immediately, but scoring is
+        deferred until the next call to ``flush_merge_queue``, which
+        ``merge_nodes`` makes after each merge.
         """
         if self.boundary_body in [u, v]:
             return
-        if self[u][v].has_key('qlink'):
-            self.merge_queue.invalidate(self[u][v]['qlink'])
-        if not self.merge_queue.is_null_queue:
-            w = self.merge_priority_function(self,u,v)
+        qitem = self[u][v].get('qlink', None)
+        if self.merge_queue.is_null_queue:
+            if qitem is not None:
+                self.merge_queue.invalidate(qitem)
+            return
+        mpf = self.merge_priority_function
+        if hasattr(mpf, 'batch'):
+            pending = self.pending_priorities
+            if qitem is None or not (qitem in self.merge_queue or
+                                     (id(qitem) in pending and qitem[1])):
+                qitem = [inf, True, u, v]
+                self[u][v]['qlink'] = qitem
+            qitem[2], qitem[3] = u, v
+            if qitem in self.merge_queue:
+                self.merge_queue.update(qitem)
+            pending[id(qitem)] = (qitem, mpf.features(self, u, v))
+            return
+        w = mpf(self, u, v)
+        self[u][v]['weight'] = w
+        if qitem is not None and qitem in self.merge_queue:
+            qitem[0], qitem[2], qitem[3] = w, u, v
+            self.merge_queue.update(qitem)
+        else:
             new_qitem = [w, True, u, v]
             self[u][v]['qlink'] = new_qitem
-            self[u][v]['weight'] = w
             self.merge_queue.push(new_qitem)
 
 
+    def flush_merge_queue(self):
+        """Score the edges deferred by ``update_merge_queue`` in one batch.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        pending = [(qitem, features) for qitem, features in
+                   self.pending_priorities.values()
+                   if qitem[1] and self.has_edge(qitem[2], qitem[3])]
+        self.pending_priorities.clear()
+        if len(pending) == 0:
+            return
+        qitems, features = zip(*pending)
+        edges = [(qitem[2], qitem[3]) for qitem in qitems]
+        weights = self.merge_priority_function.batch(self, edges, features)
+        for qitem, (u, v), w in izip(qitems, edges, weights):
+            qitem[0] = w
+            self[u][v]['weight'] = w
+            self.merge_queue.push(qitem)
+
+
     def get_segmentation(self):
         """Return the unpadded segmentation represented by the graph.
 
@@ -1740,14 +2705,60 @@ class Rag(Graph):
         --------
         ``agglo.Rag.get_ucm``
         """
-        m = self.tree.get_map()
-        seg = m[self.watershed]
-        if self.pad_thickness > 1: # volume has zero-boundaries
-            seg = morpho.remove_merged_boundaries(seg, self.connectivity)
-        return morpho.juicy_center(seg, self.pad_thickness)
+        return self.snapshot().get_segmentation()
+
+
+    def write_segmentation(self, fn, chunk_shape=None, **kwargs):
+        """Write the segmentation represented by the graph to disk.
+
+        HDF5 output is computed and written chunk by chunk, so that
+        memory use does not grow with the size of the volume.
+
+        Parameters
+        ----------
+        fn : string or h5py.Dataset
+            The output filename, or an HDF5 dataset of the unpadded
+            volume shape.
+        chunk_shape : tuple of int, optional
+            The shape of the chunks to compute and write at a time.
+        **kwargs : dict
+            Keyword arguments passed through to
+            ``Snapshot.write_segmentation``.
+
+        Returns
+        -------
+        None
+
+        See Also
+        --------
+        ``agglo.Rag.get_segmentation``
+        """
+        self.snapshot().write_segmentation(fn, chunk_shape=chunk_shape,
+                                           **kwargs)
+
 
+    def snapshot(self, threshold=None):
+        """Return a snapshot of the segmentation represented by the graph.
 
-    def get_ucm(self):
+        Parameters
+        ----------
+        threshold : float, optional
+            The agglomeration threshold to record in the snapshot.
+
+        Returns
+        -------
+        snapshot : Snapshot
+            A record of the current superpixel to body map, which is
+            unaffected by further merges.
+
+        See Also
+        --------
+        ``agglo.Rag.agglomerate_to_thresholds``
+        """
+        return Snapshot(self, threshold)
+
+
+    def get_ucm(self, out=None, block_size=None):
         """Return the current, unpadded ultrametric contour map.
 
         The contour map is an approximation, because in the absence of
@@ -1759,9 +2770,20 @@ class Rag(Graph):
         In the case of "thick" boundaries where segments don't have
         very thin regions, this is a valid approximation.
 
+        Unless the graph was built with `eager_ucm`, the map is built
+        here, in one pass, from the boundaries and heights of the
+        merges recorded by ``record_ucm``.
+
         Parameters
         ----------
-        None
+        out : array-like of float, optional
+            Write the map to this array (for example, an ``h5py``
+            dataset), `block_size` planes at a time, so that the full
+            map is never in memory.
+        block_size : int, optional
+            The number of planes (along axis 0) written to `out` at a
+            time. By default, the size of the chunks of `out` along
+            axis 0, if any, or 1.
 
         Returns
         -------
@@ -1769,13 +2791,90 @@ class Rag(Graph):
             The map of boundary values between segments implied by the
             hierarchical agglomeration process.
         """
+        if self.eager_ucm:
+            idxs, heights = zeros(0, np.intp), zeros(0)
+            background = lambda planes: self.ucm[planes].copy()
+        else:
+            idxs, labels = label_index_sets([b for b, h in self.ucm_records])
+            heights = array([h for b, h in self.ucm_records], double)
+            idxs, heights = _last_values(idxs, heights[labels])
+            background = lambda planes: where(self.watershed[planes] == 0,
+                                              inf, -inf)
+        def paint(z0, z1):
+            return self._paint_planes(z0, z1, idxs, heights, background,
+                                      self.max_merge_score)
+        def relabel(ucm, levels):
+            umin, umax = levels[([1, -2],)]
+            ucm[ucm==-inf] = umin-1
+            ucm[ucm==inf] = umax+1
+            return ucm
+        if out is None:
+            ucm = paint(0, self.watershed.shape[0] - 2 * self.pad_thickness)
+            return relabel(ucm, unique(ucm))
+        blocks = self._plane_blocks(out, block_size)
+        levels = unique(np.concatenate([unique(paint(z0, z1))
+                                        for z0, z1 in blocks]))
+        for z0, z1 in blocks:
+            out[z0:z1] = relabel(paint(z0, z1), levels)
+        return out
+
+
+    def _plane_blocks(self, out, block_size=None):
+        """Return the ranges of unpadded planes in which to write `out`.
+
+        Parameters
+        ----------
+        out : array-like
+            The output array, of the unpadded volume shape.
+        block_size : int, optional
+            The number of planes in each range. By default, the size of
+            the chunks of `out` along axis 0, if any, or 1.
+
+        Returns
+        -------
+        blocks : list of (int, int)
+            The start and stop planes of each block.
+        """
+        if block_size is None:
+            chunks = getattr(out, 'chunks', None)
+            block_size = chunks[0] if chunks else 1
+        nplanes = len(out)
+        return [(z0, min(z0 + block_size, nplanes))
+                for z0 in range(0, nplanes, block_size)]
+
+
+    def _paint_planes(self, z0, z1, idxs, values, background, ignored_value):
+        """Return planes of an unpadded map with values at some voxels.
+
+        Parameters
+        ----------
+        z0, z1 : int
+            The start and stop planes (along axis 0) of the unpadded
+            volume to return.
+        idxs : array of int
+            Sorted, unique, padded linear indices of voxels to set.
+        values : array of float
+            The value at each of `idxs`.
+        background : function (slice) -> array of float
+            Return a new array of the padded volume's planes in the
+            given slice, before `values` are set.
+        ignored_value : float
+            The value of voxels in ``ignored_boundary``, if any.
+
+        Returns
+        -------
+        planes : array of float
+            The map at planes `z0` to `z1`.
+        """
+        p = self.pad_thickness
+        planes = slice(z0 + p, z1 + p)
+        m = background(planes)
+        start, stop = array([planes.start, planes.stop]) * m[0].size
+        lo, hi = np.searchsorted(idxs, [start, stop])
+        m.ravel()[idxs[lo:hi] - start] = values[lo:hi]
         if hasattr(self, 'ignored_boundary'):
-            self.ucm[self.ignored_boundary] = self.max_merge_score
-        ucm = morpho.juicy_center(self.ucm, self.pad_thickness)
-        umin, umax = unique(ucm)[([1, -2],)]
-        ucm[ucm==-inf] = umin-1
-        ucm[ucm==inf] = umax+1
-        return ucm
+            m[self.ignored_boundary[planes]] = ignored_value
+        return m[(slice(None),) + (slice(p, -p),) * (m.ndim - 1)]
 
 
     def build_volume(self, nbunch=None):
@@ -1807,7 +2906,7 @@ class Rag(Graph):
         return morpho.juicy_center(v,self.pad_thickness)
 
 
-    def build_boundary_map(self, ebunch=None):
+    def build_boundary_map(self, ebunch=None, out=None, block_size=None):
         """Return a map of the current merge priority.
 
         Parameters
@@ -1815,6 +2914,11 @@ class Rag(Graph):
         ebunch : iterable of (int, int), optional
             The list of edges for which to build a map. Use all edges
             if not provided.
+        out : array-like of float, optional
+            Write the map to this array, `block_size` planes at a time,
+            as in ``get_ucm``.
+        block_size : int, optional
+            The number of planes written to `out` at a time.
 
         Returns
         -------
@@ -1823,17 +2927,23 @@ class Rag(Graph):
         """
         if len(self.merge_queue) == 0:
             self.rebuild_merge_queue()
-        m = zeros(self.watershed.shape, double)
-        mr = m.ravel()
         if ebunch is None:
             ebunch = self.real_edges_iter()
         ebunch = sorted([(self[u][v]['weight'], u, v) for u, v in ebunch])
-        for w, u, v in ebunch:
-            b = list(self[u][v]['boundary'])
-            mr[b] = w
-        if hasattr(self, 'ignored_boundary'):
-            m[self.ignored_boundary] = inf
-        return morpho.juicy_center(m, self.pad_thickness)
+        idxs, labels = label_index_sets([self[u][v]['boundary']
+                                         for w, u, v in ebunch])
+        weights = array([w for w, u, v in ebunch], double)
+        # where boundaries overlap, the highest weight wins
+        idxs, weights = _last_values(idxs, weights[labels])
+        background = lambda planes: zeros(self.watershed[planes].shape,
+                                          double)
+        def paint(z0, z1):
+            return self._paint_planes(z0, z1, idxs, weights, background, inf)
+        if out is None:
+            return paint(0, self.watershed.shape[0] - 2 * self.pad_thickness)
+        for z0, z1 in self._plane_blocks(out, block_size):
+            out[z0:z1] = paint(z0, z1)
+        return out
 
 
     def remove_obvious_inclusions(self):
@@ -1971,7 +3081,7 @@ class Rag(Graph):
 
 
     def should_merge(self, n1, n2):
-        return self.rig[n1].argmax() == self.rig[n2].argmax()
+        return self.rig.argmax(n1) == self.rig.argmax(n2)
 
 
     def get_pixel_label(self, n1, n2):
@@ -1993,13 +3103,76 @@ class Rag(Graph):
         return ar.reshape(self.watershed.shape)
 
 
+    def init_split_vi(self):
+        """Compute the entropy sums from which the split VI is tracked.
+
+        With `N` the number of voxels in the contingency table ``rig``,
+        ``c`` its entries, ``cx`` its row sums and ``cy`` its column
+        sums, the split VI is ``(sum(cx log cx) - sum(c log c)) / N``
+        and ``(sum(cy log cy) - sum(c log c)) / N``. Only the first two
+        sums change when two rows are merged (see ``update_split_vi``).
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        rig = self.rig.tocsr()
+        self.vi_total = self.rig.total
+        self.vi_sums = array([xlogx(rig.data).sum(),
+                              xlogx(np.asarray(rig.sum(axis=1))).sum(),
+                              xlogx(np.asarray(rig.sum(axis=0))).sum()])
+
+
+    def update_split_vi(self, row1, row2, row12):
+        """Update the split VI sums for the merge of two segments.
+
+        This takes time proportional to the number of nonzero entries in
+        the rows, using the same algebra as ``compute_true_delta_vi``.
+
+        Parameters
+        ----------
+        row1, row2, row12 : tuple of (array of int, array of float)
+            The rows of ``rig`` of the segments being merged and of the
+            merged segment, as returned by ``ContingencyTable.row``.
+
+        Returns
+        -------
+        None
+        """
+        c1, c2, c12 = row1[1], row2[1], row12[1]
+        self.vi_sums[0] += xlogx(c12).sum() - xlogx(c1).sum() - \
+                                                        xlogx(c2).sum()
+        s12, s1, s2 = xlogx(array([c12.sum(), c1.sum(), c2.sum()]))
+        self.vi_sums[1] += s12 - s1 - s2
+
+
     def split_vi(self, gt=None):
+        """Return the split VI of the current segmentation.
+
+        Parameters
+        ----------
+        gt : array of int, optional
+            A ground truth segmentation. If the graph was built with a
+            ground truth, this is ignored, and the split VI, tracked
+            through every merge, is returned in constant time.
+
+        Returns
+        -------
+        sv : array of float, shape (2,)
+            The undersegmentation and oversegmentation components of the
+            VI, as in ``evaluate.split_vi``.
+        """
         if self.gt is None and gt is None:
             return array([0,0])
         elif self.gt is not None:
-            return split_vi(None, None, self.rig)
+            sxy, sx, sy = self.vi_sums
+            return array([sx - sxy, sy - sxy]) / self.vi_total
         else:
-            return split_vi(self.get_segmentation(), gt, None, [0], [0])
+            return split_vi(self.get_segmentation(), gt, [0], [0])
 
 
     def boundary_indices(self, n1, n2):
@@ -2123,6 +3296,162 @@ class Rag(Graph):
                 self.frozen_edges.add((x, n1))
 
 
+def _slab_graph(watershed, probabilities, z0, z1, spec):
+    """Build the graph of planes `z0` to `z1` of the padded volume.
+
+    See ``Rag.build_graph_from_slabs``, which computes `spec`.
+
+    Returns
+    -------
+    nodes : list of (int, dict)
+        The nodes having voxels in the slab, boundary body first and
+        then in order of first voxel, with their attributes.
+    edges : list of (int, int, array of int, object)
+        The edges having boundary voxels in the slab, in order of first
+        boundary voxel, with their sorted boundary voxels (as indices
+        into the full padded volume) and their feature caches.
+    ignored : array of int
+        The shared boundary voxels ignored in the slab.
+    """
+    bb, p, shape = spec['boundary_body'], spec['pad_thickness'], spec['shape']
+    fm = spec['feature_manager']
+    lo, hi = max(z0 - 1, 0), min(z1 + 1, shape[0])
+    plane_size = np.prod(shape[1:])
+    g = Rag(lowmem=True, compact=spec['compact'], nozeros=spec['nozeros'],
+            connectivity=spec['connectivity'])
+    g.boundary_body = bb
+    g.pad_thickness = p
+    g.has_zero_boundaries = (p == 2)
+    g.watershed = _padded_planes(watershed, lo, hi, p,
+                                 [0, bb] if p == 2 else bb)
+    g.watershed_r = g.watershed.ravel()
+    g.neighbor_idxs = functools.partial(g.get_neighbor_idxs_lean,
+                                        connectivity=spec['connectivity'])
+    if len(probabilities) > 0:
+        g.probabilities = _padded_planes(probabilities, lo, hi, p,
+                                [inf] + (p - 1) * [0], range(len(shape)),
+                                double, spec['normalize'])
+        g.probabilities_r = g.probabilities.reshape((g.watershed.size, -1))
+    else:
+        g.probabilities = zeros_like(g.watershed)
+        g.probabilities_r = g.probabilities.ravel()
+    g.set_orientations(array([]), spec['channel_is_oriented'])
+    offset = lo * plane_size
+    owned = arange((z0 - lo) * plane_size, (z1 - lo) * plane_size)
+    g.build_graph_from_watershed(spec['allow_shared_boundaries'], idxs=owned,
+                                 nozerosfast=spec['nozeros'])
+    first_voxel = lambda n: np.ravel_multi_index(g.node[n]['entrypoint'],
+                                                 g.watershed.shape)
+    nodes = sorted((n for n in g.nodes() if 'entrypoint' in g.node[n]),
+                   key=first_voxel)
+    nodes.insert(0, bb)
+    g.add_node(bb, extent=g.index_set(owned[g.watershed_r[owned] == bb]))
+    for n in g.nodes():
+        g.node[n].setdefault('extent', g.index_set())
+    boundaries = {}
+    for u, v in g.edges_iter():
+        boundaries[min(u, v), max(u, v)] = \
+                np.sort(np.fromiter(g[u][v]['boundary'], int)) + offset
+    edges = sorted(boundaries, key=lambda e: boundaries[e][0])
+    g.feature_manager = fm
+    g.compute_feature_caches(nodes, edges)
+    for n in nodes:
+        del g.node[n]['extent']
+        if 'entrypoint' in g.node[n]:
+            g.node[n]['entrypoint'][0] += lo
+    ignored = (flatnonzero(g.ignored_boundary) + offset
+               if hasattr(g, 'ignored_boundary') else array([], int))
+    return ([(n, g.node[n]) for n in nodes],
+            [(u, v, boundaries[u, v], g[u][v]['feature-cache'])
+             for u, v in edges], ignored)
+
+
+def _sums_voxel_caches(feature_manager):
+    """Return whether the caches of `feature_manager` add up over voxels.
+
+    Only the caches of these managers are combined exactly across the
+    slabs of ``Rag.build_graph_from_slabs``.
+    """
+    if isinstance(feature_manager, features.base.Composite):
+        return all(map(_sums_voxel_caches, feature_manager.children))
+    return type(feature_manager) in _voxel_sum_managers
+
+
+# managers whose caches are sums over voxels, or who keep no caches
+_voxel_sum_managers = (features.base.Null, features.moments.Manager,
+                       features.histogram.Manager, features.graph.Manager,
+                       features.inclusion.Manager)
+
+
+# the input volumes of the slab graphs being built by worker processes
+_shared_volumes = None
+
+
+def _shared_volume(ar):
+    """Return a reference to `ar` that can be shared with worker processes.
+
+    ``h5py`` datasets are referred to by file and dataset name, and
+    arrays are inherited by forked workers as they are.
+    """
+    if hasattr(ar, 'file') and hasattr(ar, 'name'):
+        return (ar.file.filename, ar.name)
+    return ar
+
+
+def _shared_slab_graph(args):
+    """Call ``_slab_graph`` on the volumes shared by the parent process."""
+    volumes, files = [], []
+    for ar in _shared_volumes:
+        if isinstance(ar, tuple):
+            import h5py
+            filename, name = ar
+            files.append(h5py.File(filename, 'r'))
+            ar = files[-1][name]
+        volumes.append(ar)
+    try:
+        return _slab_graph(*(volumes + list(args)))
+    finally:
+        for f in files:
+            f.close()
+
+
+def _padded_planes(ar, lo, hi, thickness, vals, axes=None, dtype=None,
+                   normalize=None):
+    """Return planes `lo` to `hi` of ``morpho.pad(ar, vals, axes)``.
+
+    Only the planes of `ar` that are needed are read.
+
+    Parameters
+    ----------
+    ar : array-like
+        The unpadded volume. Any object supporting numpy-style slicing
+        along the first axis, such as an ``h5py`` dataset.
+    lo, hi : int
+        The range of planes of the padded volume to return.
+    thickness : int
+        The padding thickness, ``len(vals)``.
+    vals, axes : see ``morpho.pad``
+    dtype : numpy dtype, optional
+        Convert the planes read to this type before padding.
+    normalize : tuple of float, optional
+        If given, an offset and a scale: the planes read are shifted by
+        the first and divided by the second before padding.
+
+    Returns
+    -------
+    padded : array
+        The planes `lo` to `hi` of the padded volume.
+    """
+    # always read at least one plane, since morpho.pad ignores empty arrays
+    start = min(max(lo - thickness, 0), ar.shape[0] - 1)
+    stop = max(min(hi - thickness, ar.shape[0]), start + 1)
+    planes = np.array(ar[start:stop], dtype)
+    if normalize is not None:
+        planes -= normalize[0]
+        planes /= normalize[1]
+    return morpho.pad(planes, vals, axes)[lo - start:hi - start]
+
+
 def get_edge_coordinates(g, n1, n2, arbitrary=False):
     """Find where in the segmentation the edge (n1, n2) is most visible."""
     boundary = g[n1][n2]['boundary']
@@ -2149,12 +3478,317 @@ def is_mito(g, n, channel=2, threshold=0.5):
 def best_possible_segmentation(ws, gt):
     """Build the best possible segmentation given a superpixel map."""
     cnt = contingency_table(ws, gt)
-    assignment = cnt == cnt.max(axis=1)[:,newaxis]
-    hard_assignment = where(assignment.sum(axis=1) > 1)[0]
-    # currently ignoring hard assignment nodes
-    assignment[hard_assignment,:] = 0
+    assignment = defaultdict(list)
+    for sp in range(ws.max() + 1):
+        gt_nodes = cnt.assignment(sp)
+        # currently ignoring hard assignment nodes
+        if gt_nodes is not None and len(gt_nodes) == 1:
+            assignment[gt_nodes[0]].append(sp)
     ws = Rag(ws)
-    for gt_node in range(1,cnt.shape[1]):
-        ws.merge_subgraph(where(assignment[:,gt_node])[0])
+    for gt_node in range(1, cnt.ncols):
+        ws.merge_subgraph(assignment[gt_node])
     return ws.get_segmentation()
 
+
+
+# arguments to ``Rag`` that are passed on to ``Rag.load``, and that do not
+# change the graph that is built, respectively
+_LOAD_ARGUMENTS = frozenset(['gt_vol', 'feature_manager', 'show_progress',
+                             'lowmem', 'eager_ucm'])
+_UNKEYED_ARGUMENTS = frozenset(['watershed', 'probabilities',
+    'merge_priority_function', 'gt_vol', 'show_progress', 'lowmem',
+    'eager_ucm', 'slab_size', 'nprocessors'])
+
+def cached_rag(cache_dir, watershed, probabilities=array([]),
+               merge_priority_function=boundary_mean, **kwargs):
+    """Build a graph, or load it from a cache of previously built graphs.
+
+    Graphs are saved in `cache_dir` with ``Rag.save``, under a hash of
+    the input volumes, the feature manager description and the other
+    arguments that affect the built graph. Functions passed as
+    arguments, such as `isfrozennode`, are identified by their name
+    (and, for ``functools.partial`` objects, their arguments), so a
+    changed function with an unchanged name must not be used with an
+    existing cache. Graphs whose feature caches cannot be saved, as
+    they are not numeric arrays, are built every time.
+
+    Parameters
+    ----------
+    cache_dir : string or None
+        The cache directory. If ``None``, the graph is always built.
+    watershed, probabilities, merge_priority_function, **kwargs
+        The arguments to ``Rag``.
+
+    Returns
+    -------
+    g : Rag object
+        The graph.
+    """
+    if cache_dir is None:
+        return Rag(watershed, probabilities, merge_priority_function,
+                   **kwargs)
+    spec = inspect.getargspec(Rag.__init__)
+    keyed = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+    keyed.update(kwargs)
+    for name in _UNKEYED_ARGUMENTS:
+        keyed.pop(name, None)
+    fn = os.path.join(cache_dir,
+                      ragio.cache_key(watershed, probabilities, **keyed) + '.h5')
+    if os.path.exists(fn):
+        load_kwargs = dict((k, v) for k, v in kwargs.items()
+                           if k in _LOAD_ARGUMENTS)
+        return Rag.load(fn, merge_priority_function, **load_kwargs)
+    g = Rag(watershed, probabilities, merge_priority_function, **kwargs)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    handle, tmp = tempfile.mkstemp(suffix='.h5', dir=cache_dir)
+    os.close(handle)
+    try:
+        g.save(tmp)
+        os.rename(tmp, fn) # never leave a partially written graph behind
+    except ValueError as e:
+        os.remove(tmp)
+        logging.warning('Not caching the graph: %s' % e)
+    except:
+        os.remove(tmp)
+        raise
+    return g
+
+
+# the graphs, ground truths, contingency tables and feature maps of the
+# volumes learned by worker processes, and the current priority function
+_training_volumes = None
+_epoch_priority_function = None
+
+
+def _epoch_priority(data, new_data, num_epochs, feature_map, labeling_mode,
+                    priority_mode, max_num_samples, trainer, active_function,
+                    mpf):
+    """Return the merge priority function of a learning epoch.
+
+    See ``Rag.learn_agglomerate`` for the parameters. `new_data` is the
+    data of the previous epoch only, used to warm start the classifier.
+    ``None`` means that the graphs keep their own priority function.
+    """
+    label_type_keys = {'assignment':0, 'vi-sign':1, 'rand-sign':2}
+    label_type = label_type_keys[labeling_mode]
+    if priority_mode == 'mean':
+        return boundary_mean
+    elif num_epochs > 0 and priority_mode == 'active' or \
+        num_epochs % 2 == 1 and priority_mode == 'mixed':
+        feat, lab = classify.sample_training_data(
+            data[0], data[1][:, label_type], max_num_samples)
+        new_feat = new_lab = None
+        if len(new_data) > 0:
+            new_feat, new_lab = classify.sample_training_data(
+                new_data[0], new_data[1][:, label_type], max_num_samples)
+        cl = trainer.fit(feat, lab, new_feat, new_lab)
+        return active_function(feature_map, cl)
+    elif priority_mode == 'random' or \
+        (priority_mode == 'active' and num_epochs == 0):
+        return random_priority
+    elif priority_mode == 'custom':
+        return mpf
+    return None
+
+
+def _learn_volume(i, seed, merge_priority_function, flat, learning_mode,
+                  labeling_mode):
+    """Run one learning epoch on training volume `i`.
+
+    The random number generators are first seeded with `seed`, so that
+    random priorities do not depend on the process running the epoch,
+    nor on the volumes it ran before.
+
+    Returns
+    -------
+    data : list of array
+        The learning data of the epoch, as returned by ``learn_flat``.
+    elapsed : float
+        The time taken, in seconds.
+    """
+    g, gts, ctables, feature_map = _training_volumes[i]
+    random.seed(seed)
+    np.random.seed(seed)
+    start = time.time()
+    if flat:
+        data = g.learn_flat(gts, feature_map)
+    else:
+        g = g.copy()
+        if merge_priority_function is not None:
+            g.merge_priority_function = merge_priority_function
+        g.show_progress = False # bug in MergeQueue usage causes
+                                # progressbar crash.
+        g.rebuild_merge_queue()
+        data = g._learn_agglomerate([ctable.copy() for ctable in ctables],
+                                    feature_map, learning_mode, labeling_mode)
+    return data, time.time() - start
+
+
+def _set_epoch_priority(merge_priority_function):
+    """Store the priority function of the epoch in a worker process."""
+    global _epoch_priority_function
+    _epoch_priority_function = merge_priority_function
+
+
+def _learn_shared_volume(args):
+    """Call ``_learn_volume`` with the priority function of the worker."""
+    i, seed = args[:2]
+    return _learn_volume(i, seed, _epoch_priority_function, *args[2:])
+
+
+def _learn_agglomerate_graphs(graphs, gts, feature_map, nprocessors=1,
+                              min_num_samples=1, learn_flat=True,
+                              learning_mode='strict',
+                              labeling_mode='assignment',
+                              priority_mode='active', memory=True,
+                              unique=True, random_state=None,
+                              max_num_epochs=10, min_num_epochs=2,
+                              max_num_samples=np.inf,
+                              classifier='random forest',
+                              active_function=classifier_probability,
+                              mpf=boundary_mean, trainer=None,
+                              store=None):
+    """Learn the agglomeration of several graphs, pooling their data.
+
+    See ``learn_agglomerate_volumes`` for the parameters, which takes
+    the already built `graphs` and the ground truth(s) of each.
+
+    Returns
+    -------
+    data, alldata
+        As returned by ``Rag.learn_agglomerate``.
+    times : list of list of float
+        The time taken by each graph, in each epoch.
+    """
+    global _training_volumes
+    learning_mode = learning_mode.lower()
+    labeling_mode = labeling_mode.lower()
+    priority_mode = priority_mode.lower()
+    if priority_mode == 'mean' and unique:
+        max_num_epochs = 2 if learn_flat else 1
+    if priority_mode in ['random', 'mean'] and not memory:
+        max_num_epochs = 1
+    if trainer is None:
+        trainer = classify.EpochTrainer(classifier, random_state=random_state)
+    trainer.reset()
+    if store is None:
+        store = classify.UniqueTrainingData()
+    volumes = []
+    for g, vgts in zip(graphs, gts):
+        if type(vgts) != list:
+            vgts = [vgts] # allow using single ground truth as input
+        ctables = [contingency_table(g.get_segmentation(), gt) for gt in vgts]
+        volumes.append((g, vgts, ctables, feature_map))
+    alldata, times = [], []
+    data = [[],[],[],[]]
+    for num_epochs in range(max_num_epochs):
+        if len(data[0]) > min_num_samples and num_epochs >= min_num_epochs:
+            break
+        flat = learn_flat and num_epochs == 0
+        priority = None if flat else _epoch_priority(data,
+                        alldata[-1] if alldata else [], num_epochs,
+                        feature_map, labeling_mode, priority_mode,
+                        max_num_samples, trainer, active_function, mpf)
+        _training_volumes = volumes
+        seeds = [np.random.randint(2**31) for i in range(len(volumes))]
+        try:
+            if nprocessors == 1 or len(volumes) == 1:
+                # restore the random state that _learn_volume reseeds,
+                # as the pool leaves that of this process untouched
+                state = random.getstate(), np.random.get_state()
+                try:
+                    results = [_learn_volume(i, seeds[i], priority, flat,
+                                             learning_mode, labeling_mode)
+                               for i in range(len(volumes))]
+                finally:
+                    random.setstate(state[0])
+                    np.random.set_state(state[1])
+            else:
+                # forked workers inherit the graphs, and each receives
+                # the priority function, and thus the classifier, once
+                pool = multiprocessing.Pool(nprocessors,
+                                            initializer=_set_epoch_priority,
+                                            initargs=(priority,))
+                try:
+                    results = pool.map(_learn_shared_volume,
+                        [(i, seeds[i], flat, learning_mode, labeling_mode)
+                         for i in range(len(volumes))],
+                        chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            _training_volumes = None
+        epoch_data, epoch_times = zip(*results)
+        for i, t in enumerate(epoch_times):
+            logging.info('volume %d: %d samples in %.2fs at epoch %d' %
+                         (i, len(epoch_data[i][0]) if epoch_data[i] else 0,
+                          t, num_epochs))
+        times.append(list(epoch_times))
+        nonempty = [d for d in epoch_data if len(d) > 0]
+        if len(nonempty) > 1:
+            alldata.append(concatenate_data_elements(nonempty))
+        else:
+            alldata.append((nonempty or epoch_data)[0])
+        if memory and unique:
+            store.add(alldata[-1])
+            data = store.get_data()
+        elif memory and flat:
+            data = unique_learning_data_elements(alldata)
+        elif memory:
+            data = concatenate_data_elements(alldata)
+        else:
+            data = alldata[-1]
+        if not flat:
+            logging.debug('data size %d at epoch %d' %
+                          (len(data[0]), num_epochs))
+    return data, alldata, times
+
+
+def learn_agglomerate_volumes(volumes, feature_map, nprocessors=1,
+                              build_rag=None, **kwargs):
+    """Learn the agglomeration of several training volumes at once.
+
+    Each epoch, the graphs of all volumes are agglomerated with the
+    same priority function, and their learning data are pooled to fit
+    the classifier of the next epoch, as ``Rag.learn_agglomerate``
+    does for a single volume.
+
+    Parameters
+    ----------
+    volumes : list of tuple
+        The ``(watershed, probabilities, ground truth)`` volumes. The
+        ground truth can also be a list of ground truth volumes. More
+        generally, all but the last element of each tuple are the
+        arguments to `build_rag`.
+    feature_map : function (Rag, node, node) -> array of float
+        The map from node pairs to a feature vector.
+    nprocessors : int, optional
+        The number of worker processes agglomerating the volumes. The
+        graphs are built in this process, and inherited by the forked
+        workers, which each receive the classifier once per epoch.
+        Each volume's epoch is seeded from the ``numpy.random`` state
+        of this process, so the result does not depend on
+        `nprocessors`, even with random priorities.
+    build_rag : function (array, array, ...) -> Rag, optional
+        The function building the graph of a watershed and probability
+        map. By default, a ``Rag`` using `feature_map` as its feature
+        manager.
+    **kwargs : dict
+        The keyword arguments to ``Rag.learn_agglomerate``.
+
+    Returns
+    -------
+    data, alldata
+        As returned by ``Rag.learn_agglomerate``, with the data of all
+        volumes concatenated in each epoch.
+    times : list of list of float
+        The time taken by each volume, in seconds, in each epoch.
+    """
+    if build_rag is None:
+        build_rag = functools.partial(Rag, feature_manager=feature_map)
+    graphs = [build_rag(*volume[:-1]) for volume in volumes]
+    gts = [volume[-1] for volume in volumes]
+    return _learn_agglomerate_graphs(graphs, gts, feature_map, nprocessors,
+                                     **kwargs)
@@ -0,0 +1,91 @@
+import numpy as np
+
+
+class ChainedList(object):
+    """A list of ints that can be appended to another in O(1) time.
+
+    The elements are stored in a singly linked chain of Python lists.
+    ``a += b`` links the chain of `b` to the end of the chain of `a`
+    without copying any elements, so `b` must not be modified
+    afterwards. This is how ``agglo.Rag`` combines the superpixel ids
+    of merged nodes, which would otherwise take quadratic time overall
+    when large nodes are merged into small ones.
+
+    Parameters
+    ----------
+    items : iterable of int, optional
+        The initial elements of the list.
+
+    Examples
+    --------
+    >>> a, b = ChainedList([1, 2]), ChainedList([3])
+    >>> a += b
+    >>> len(a), a[2], list(a)
+    (3, 3, [1, 2, 3])
+    >>> np.array(a)
+    array([1, 2, 3])
+    """
+    __slots__ = ('_head', '_tail', '_len')
+    __hash__ = None
+
+    def __init__(self, items=()):
+        self._head = self._tail = [list(items), None] # [elements, next]
+        self._len = len(self._head[0])
+
+    def __iadd__(self, other):
+        if not isinstance(other, ChainedList):
+            other = ChainedList(other)
+        self._tail[1] = other._head
+        self._tail = other._tail
+        self._len += other._len
+        return self
+
+    def __len__(self):
+        return self._len
+
+    def _chunks(self):
+        chunk = self._head
+        while chunk is not None:
+            yield chunk[0]
+            chunk = chunk[1]
+
+    def __iter__(self):
+        for elements in self._chunks():
+            for x in elements:
+                yield x
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.tolist()[i]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('ChainedList index out of range')
+        for elements in self._chunks():
+            if i < len(elements):
+                return elements[i]
+            i -= len(elements)
+
+    def __eq__(self, other):
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __array__(self, dtype=None):
+        return np.fromiter(self, dtype or np.int64, self._len)
+
+    def __reduce__(self):
+        # flatten, rather than recursing down the chain when pickling
+        return (ChainedList, (self.tolist(),))
+
+    def __repr__(self):
+        return 'ChainedList(%r)' % self.tolist()
+
+    def copy(self):
+        """Return a copy of the list, which does not share its chain."""
+        return ChainedList(self)
+
+    def tolist(self):
+        """Return the elements as a Python list."""
+        return list(self)
@@ -3,7 +3,9 @@
 # system modules
 import os
 import logging
+import hashlib
 import random
+import time
 import cPickle as pck
 
 # libraries
@@ -15,6 +17,7 @@ try:
     from sklearn.svm import SVC
     from sklearn.linear_model import LogisticRegression, LinearRegression
     from sklearn.ensemble import RandomForestClassifier
+    from sklearn.ensemble.forest import ForestClassifier
     from sklearn.externals import joblib
 except ImportError:
     logging.warning('scikit-learn not found.')
@@ -34,6 +37,11 @@ else:
 # local imports
 import iterprogress as ip
 from .adaboost import AdaBoost
+from .decision_tree import concatenate_trees
+from . import optimized as opt
+
+
+FLAT_CLASSIFIER_FORMAT = 1
 
 
 def h5py_stack(fn):
@@ -44,14 +52,14 @@ def h5py_stack(fn):
         raise
     return a
 
-def default_classifier_extension(cl, use_joblib=True):
+def default_classifier_extension(cl, use_joblib=True, flat=False):
     """
     Return the default classifier file extension for the given classifier cl.
 
     Returns:
         String of file extension
     """
-    if isinstance(cl, VigraRandomForest):
+    if isinstance(cl, VigraRandomForest) or flat:
         return ".classifier.h5"
     elif use_joblib and sklearn_available:
         return ".classifier.joblib"
@@ -63,6 +71,7 @@ def load_classifier(fn):
     """Load a classifier previously saved to disk, given a filename.
     
     Supported classifier types are:
+    - tree ensembles saved flat, loaded as a memory-mapped ``FlatForest``
     - scikit-learn classifiers saved using either pickle or joblib persistence
     - vigra random forest classifiers saved in HDF5 format
 
@@ -79,11 +88,16 @@ def load_classifier(fn):
     """
     if not os.path.exists(fn):
         raise IOError("No such file or directory: '%s'" % fn)
+    if h5py.is_hdf5(fn):
+        with h5py.File(fn, 'r') as f:
+            flat = 'gala_classifier' in f.attrs
+        if flat:
+            return FlatForest.load(fn)
     try:
         with open(fn, 'r') as f:
             cl = pck.load(f)
         return cl
-    except pck.UnpicklingError:
+    except (pck.UnpicklingError, EOFError):  # eg. joblib files
         pass
     if sklearn_available:
         try:
@@ -103,7 +117,7 @@ def load_classifier(fn):
     raise IOError("File '%s' does not appear to be a valid classifier file"
         % fn)
 
-def save_classifier(cl, fn, use_joblib=True, **kwargs):
+def save_classifier(cl, fn, use_joblib=True, flat=False, **kwargs):
     """Save a classifier to disk.
 
     Parameters
@@ -114,6 +128,11 @@ def save_classifier(cl, fn, use_joblib=True, **kwargs):
         Writeable path/filename.
     use_joblib : bool, optional
         Whether to prefer joblib persistence to pickle.
+    flat : bool, optional
+        Save only the trees of a tree ensemble supported by
+        ``FlatForest``, in an HDF5 file that `load_classifier`
+        memory-maps. Processes loading the same file then share its
+        pages. The loaded classifier predicts, but cannot be refit.
     kwargs : keyword arguments
         Keyword arguments to be passed on to either `pck.dump` or 
         `joblib.dump`.
@@ -126,7 +145,13 @@ def save_classifier(cl, fn, use_joblib=True, **kwargs):
     -----
     For joblib persistence, `compress=3` is the default.
     """
-    if isinstance(cl, VigraRandomForest):
+    if flat:
+        flat_cl = flatten_classifier(cl)
+        if not isinstance(flat_cl, FlatForest):
+            raise ValueError('Only fitted tree ensembles can be saved flat, '
+                             'got %s.' % type(cl).__name__)
+        flat_cl.save(fn)
+    elif isinstance(cl, VigraRandomForest):
         cl.save_to_disk(fn)
     elif use_joblib and sklearn_available:
         if not kwargs.has_key('compress'):
@@ -150,10 +175,11 @@ def get_classifier(name='random forest', *args, **kwargs):
 
 class DefaultRandomForest(RandomForestClassifier):
     def __init__(self, n_estimators=100, criterion='entropy', max_depth=20,
-            bootstrap=False, random_state=None):
+            bootstrap=False, random_state=None, n_jobs=1, warm_start=False):
         super(DefaultRandomForest, self).__init__(
             n_estimators=n_estimators, criterion=criterion,
-            max_depth=max_depth, bootstrap=bootstrap, random_state=random_state)
+            max_depth=max_depth, bootstrap=bootstrap, random_state=random_state,
+            n_jobs=n_jobs, warm_start=warm_start)
 
 
 class VigraRandomForest(object):
@@ -217,6 +243,321 @@ class VigraRandomForest(object):
             setattr(self, attr, f[rfgroupname].attrs[attr])
 
 
+def _flatten_sklearn_tree(tree, n_classes):
+    """Return the node arrays and normalized leaf values of a sklearn tree.
+
+    sklearn sends a row left when its feature value is at most the
+    threshold, which, for the finite inputs sklearn accepts, is the
+    same as not sending it right when the value is greater.
+    """
+    t = tree.tree_
+    values = t.value[:, 0, :n_classes].copy()
+    normalizer = values.sum(axis=1)[:, np.newaxis]
+    normalizer[normalizer == 0.0] = 1.0
+    values /= normalizer
+    return (t.feature, t.threshold, t.children_left, t.children_right,
+            values)
+
+
+class FlatForest(object):
+    """Fast inference for a fitted tree ensemble.
+
+    The trees of the ensemble are flattened into contiguous node
+    arrays, which ``optimized.predict_tree_ensemble`` traverses in
+    compiled code. Predicting single rows or small batches thus avoids
+    the per-tree overhead of the original classifier, while giving the
+    same probabilities.
+
+    Supported classifiers are scikit-learn forests, such as
+    ``DefaultRandomForest``, and ``AdaBoost`` ensembles of
+    ``DecisionTree``s. The trees are flattened again whenever the
+    classifier has been refit.
+
+    The flattened trees can be saved with ``save`` and memory-mapped
+    back with ``load``, without the original classifier.
+
+    Parameters
+    ----------
+    classifier : ForestClassifier or AdaBoost
+        A fitted classifier.
+
+    See Also
+    --------
+    flatten_classifier
+    """
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self._flatten()
+
+    @staticmethod
+    def supports(classifier):
+        """Return whether `classifier` is a fitted, supported ensemble."""
+        if isinstance(classifier, AdaBoost):
+            return hasattr(classifier, 'weak_classifier_ensemble')
+        return (sklearn_available and
+                isinstance(classifier, ForestClassifier) and
+                getattr(classifier, 'n_outputs_', None) == 1)
+
+    def _trees(self):
+        if isinstance(self.classifier, AdaBoost):
+            return self.classifier.weak_classifier_ensemble
+        return self.classifier.estimators_
+
+    def _flatten(self):
+        cl = self.classifier
+        trees = self._trees()
+        if isinstance(cl, AdaBoost):
+            arrays = [t.flatten() for t in trees]
+            self.weights = np.array(cl.alpha[:len(trees)], np.double)
+            self.dtype = np.double
+        else:
+            arrays = [_flatten_sklearn_tree(t, cl.n_classes_) for t in trees]
+            self.weights = np.ones(len(trees))
+            self.dtype = np.float32  # sklearn predicts on float32 features
+        (self.roots, self.feature, self.threshold, self.left, self.right,
+         self.values) = concatenate_trees(arrays)
+        self.n_features = self.feature[self.left != -1].max() + 1 \
+                          if (self.left != -1).any() else 0
+        self.adaboost = isinstance(cl, AdaBoost)
+        self._state = (trees, len(trees))
+
+    def _check_flattened(self):
+        if self.classifier is None:  # loaded from disk
+            return
+        trees = self._trees()
+        if trees is not self._state[0] or len(trees) != self._state[1]:
+            self._flatten()
+
+    def predict_score(self, features):
+        """Return the weighted sum of the leaf values of each row.
+
+        Parameters
+        ----------
+        features : array of float, shape (N, M) or (M,)
+            The rows to evaluate.
+
+        Returns
+        -------
+        scores : array of float, shape (N, C)
+            For a forest, the sum of the class probabilities of each
+            tree; for ``AdaBoost``, in a single column, the score of
+            ``AdaBoost.predict_score``.
+        """
+        self._check_flattened()
+        X = np.array(features, dtype=self.dtype, ndmin=2, copy=False)
+        X = np.ascontiguousarray(X, dtype=np.double)
+        if X.ndim != 2 or X.shape[1] < self.n_features:
+            raise ValueError('Expected %i features, got array of shape %s.'
+                             % (self.n_features, X.shape))
+        return opt.predict_tree_ensemble(X, self.roots, self.feature,
+                        self.threshold, self.left, self.right, self.weights,
+                        self.values)
+
+    def predict_proba(self, features):
+        """Return the class probabilities of each row.
+
+        These match ``self.classifier.predict_proba(features)``.
+        """
+        scores = self.predict_score(features)
+        if self.adaboost:
+            p = 1.0/(1.0 + np.exp(-2.0*scores[:, 0]))
+            return np.concatenate((np.array([1.0-p]), np.array([p])),
+                                  axis=0).T
+        scores /= len(self.roots)
+        return scores
+
+    def save(self, fn):
+        """Save the flattened trees to an HDF5 file.
+
+        The node arrays are stored contiguously and uncompressed, so that
+        ``load`` can memory-map them.
+
+        Parameters
+        ----------
+        fn : string
+            The file to write.
+        """
+        self._check_flattened()
+        description = getattr(self.classifier, 'feature_description',
+                              getattr(self, 'feature_description', None))
+        with h5py.File(fn, 'w') as f:
+            f.attrs['gala_classifier'] = FLAT_CLASSIFIER_FORMAT
+            f.attrs['kind'] = 'adaboost' if self.adaboost else 'forest'
+            f.attrs['dtype'] = np.dtype(self.dtype).name
+            f.attrs['n_features'] = self.n_features
+            if description is not None:
+                f.attrs['feature_description'] = description
+            for name in _FLAT_ARRAYS:
+                f.create_dataset(name, data=getattr(self, name))
+
+    @classmethod
+    def load(cls, fn):
+        """Load the flattened trees saved by ``save``, memory-mapped.
+
+        Parameters
+        ----------
+        fn : string
+            The file to read.
+
+        Returns
+        -------
+        flat : FlatForest
+            The flattened trees, with no ``classifier``. The node arrays
+            are read-only views of the file, so that the processes
+            loading it share the same memory.
+        """
+        with h5py.File(fn, 'r') as f:
+            if f.attrs.get('gala_classifier') != FLAT_CLASSIFIER_FORMAT:
+                raise ValueError('%s is not a flat classifier of format '
+                                 'version %i.' % (fn, FLAT_CLASSIFIER_FORMAT))
+            flat = cls.__new__(cls)
+            flat.classifier = None
+            flat.adaboost = f.attrs['kind'] == 'adaboost'
+            flat.dtype = np.dtype(str(f.attrs['dtype'])).type
+            flat.n_features = int(f.attrs['n_features'])
+            if 'feature_description' in f.attrs:
+                flat.feature_description = f.attrs['feature_description']
+            for name in _FLAT_ARRAYS:
+                setattr(flat, name, _read_mmap(f[name]))
+        return flat
+
+
+_FLAT_ARRAYS = ['roots', 'feature', 'threshold', 'left', 'right', 'weights',
+                'values']
+
+
+def _read_mmap(dataset):
+    """Return an HDF5 dataset, memory-mapped read-only if possible."""
+    offset = dataset.id.get_offset()
+    if offset is None:  # empty, or not stored contiguously
+        return dataset[...]
+    return np.asarray(np.memmap(dataset.file.filename, dataset.dtype, 'r',
+                                offset, dataset.shape))
+
+
+def flatten_classifier(classifier):
+    """Return a ``FlatForest`` of `classifier` if supported, or itself.
+
+    Parameters
+    ----------
+    classifier : classifier object
+        Any classifier.
+
+    Returns
+    -------
+    cl : FlatForest or classifier object
+        A ``FlatForest`` wrapping `classifier` if it is a fitted tree
+        ensemble that ``FlatForest`` supports, or `classifier` itself.
+    """
+    if isinstance(classifier, FlatForest) or \
+            not FlatForest.supports(classifier):
+        return classifier
+    return FlatForest(classifier)
+
+
+class EpochTrainer(object):
+    """Fit the classifier of each epoch of ``Rag.learn_agglomerate``.
+
+    By default, each epoch fits a new classifier on all the training
+    data gathered so far. With `warm_start`, a scikit-learn forest is
+    instead grown by adding trees fitted only to the data of the
+    latest epoch, keeping the trees of the previous epochs.
+
+    Parameters
+    ----------
+    classifier : string, optional
+        Any valid classifier descriptor. See ``get_classifier``.
+    warm_start : bool, optional
+        Add trees to the forest of the previous epoch, rather than
+        fitting a new classifier. Other classifiers, and epochs
+        lacking a class of the labels, are always fit from scratch.
+    n_jobs : int, optional
+        The number of processes fitting scikit-learn forests, with -1
+        meaning one per core.
+    new_trees : int, optional
+        The number of trees added by each warm start. By default, the
+        number of trees of the first forest.
+    random_state : int, optional
+        Passed on to ``get_classifier``.
+
+    Attributes
+    ----------
+    classifier_ : classifier object
+        The classifier fitted by the latest epoch, or ``None``.
+    history : list of dict
+        For each fit, the number of ``'samples'`` it was fitted to,
+        the total number of samples (``'total_samples'``), whether it
+        was a ``'warm_start'``, and the ``'fit_time'`` in seconds.
+    """
+    def __init__(self, classifier='random forest', warm_start=False,
+                 n_jobs=1, new_trees=None, random_state=None):
+        self.classifier = classifier
+        self.warm_start = warm_start
+        self.n_jobs = n_jobs
+        self.new_trees = new_trees
+        self.random_state = random_state
+        self.reset()
+
+    def reset(self):
+        """Forget the fitted classifier and the history."""
+        self.classifier_ = None
+        self.history = []
+
+    def _new_classifier(self):
+        if self.random_state is None:
+            cl = get_classifier(self.classifier)
+        else:
+            cl = get_classifier(self.classifier,
+                                random_state=self.random_state)
+        if sklearn_available and isinstance(cl, ForestClassifier):
+            cl.set_params(n_jobs=self.n_jobs)
+        return cl
+
+    def fit(self, features, labels, new_features=None, new_labels=None):
+        """Fit the classifier of an epoch.
+
+        Parameters
+        ----------
+        features : array of float, shape (N, M)
+            All the training feature vectors.
+        labels : array of int, shape (N,)
+            Their labels.
+        new_features : array of float, shape (P, M), optional
+            The feature vectors of the latest epoch, used to warm start.
+        new_labels : array of int, shape (P,), optional
+            Their labels.
+
+        Returns
+        -------
+        cl : classifier object
+            The fitted classifier.
+        """
+        cl = self.classifier_
+        warm = (self.warm_start and new_features is not None and
+                sklearn_available and isinstance(cl, ForestClassifier) and
+                np.array_equal(np.unique(new_labels), cl.classes_))
+        start = time.time()
+        if warm:
+            new_trees = self.new_trees or self.history[0]['trees']
+            cl.set_params(warm_start=True,
+                          n_estimators=len(cl.estimators_) + new_trees)
+            cl = cl.fit(new_features, new_labels)
+            num_samples = len(new_features)
+        else:
+            cl = self._new_classifier().fit(features, labels)
+            num_samples = len(features)
+        elapsed = time.time() - start
+        self.classifier_ = cl
+        self.history.append({'samples': num_samples,
+                             'total_samples': len(features),
+                             'trees': len(getattr(cl, 'estimators_', [])),
+                             'warm_start': warm, 'fit_time': elapsed})
+        logging.info('fit classifier to %d of %d samples in %.2fs%s' %
+                     (num_samples, len(features), elapsed,
+                      ' (warm start)' if warm else ''))
+        return cl
+
+
 def read_rf_info(fn):
     f = h5py.File(fn)
     return map(np.array, [f['oob'], f['feature_importance']])
@@ -242,18 +583,214 @@ def unique_learning_data_elements(alldata):
     def get_uniques(ar): return ar[uids]
     return map(get_uniques, [f, l, w, h])
 
-def sample_training_data(features, labels, num_samples=None):
+class UniqueTrainingData(object):
+    """An append-only learning set without repeated feature vectors.
+
+    Each feature vector added is hashed, and kept, with its label,
+    weight and history rows, only if no identical feature vector was
+    added before. Unlike ``unique_learning_data_elements``, adding data
+    therefore takes time proportional to the new data only, and the
+    rows are kept in the order in which they were first added.
+
+    Parameters
+    ----------
+    fn : string, optional
+        Keep the data in this HDF5 file, in chunked, resizable datasets
+        laid out as by ``save_training_data_to_disk``, rather than in
+        memory. Data already in the file is kept and indexed.
+    chunk_size : int, optional
+        The number of rows of each chunk of the HDF5 datasets.
+    names : list of string, optional
+        The names of the datasets in the HDF5 file.
+    info : string, optional
+        The ``info`` attribute of the HDF5 file.
+
+    Notes
+    -----
+    Feature vectors are compared through the SHA-1 digests of their
+    bytes, so, like ``unique_learning_data_elements``, vectors are only
+    repeats if they are bitwise identical.
+    """
+    def __init__(self, fn=None, chunk_size=4096, names=None, info='N/A'):
+        if names is None:
+            names = ['features', 'labels', 'weights', 'history']
+        self.names = names
+        self.chunk_size = chunk_size
+        self.digests = set()
+        self.size = 0
+        self._arrays = None
+        self.file = None
+        if fn is not None:
+            self.file = h5py.File(fn, 'a')
+            if 'info' not in self.file.attrs:
+                self.file.attrs['info'] = info
+            if names[0] in self.file:
+                self._arrays = [self._resizable(name) for name in names]
+                features = self._arrays[0]
+                for start in range(0, len(features), chunk_size):
+                    chunk = features[start:start + chunk_size]
+                    self.digests.update(self._index(chunk)[1])
+                self.size = len(features)
+
+    def __len__(self):
+        return self.size
+
+    def _index(self, features):
+        """Return the rows of `features` that are new, and their digests.
+
+        The store is left unchanged: the digests are only indexed once
+        the rows have been written.
+        """
+        features = np.ascontiguousarray(features)
+        keep, digests = [], set()
+        for i in range(len(features)):
+            digest = hashlib.sha1(features[i]).digest()
+            if digest not in self.digests and digest not in digests:
+                digests.add(digest)
+                keep.append(i)
+        return keep, digests
+
+    def _create_dataset(self, name, shape, dtype):
+        return self.file.create_dataset(name, shape=shape,
+                        maxshape=(None,) + shape[1:],
+                        chunks=(self.chunk_size,) + shape[1:], dtype=dtype)
+
+    def _resizable(self, name):
+        """Return dataset `name` of the file, rewritten if not resizable."""
+        dataset = self.file[name]
+        if dataset.maxshape[0] is None:
+            return dataset
+        data = np.array(dataset)
+        del self.file[name]
+        dataset = self._create_dataset(name, data.shape, data.dtype)
+        dataset[:] = data
+        return dataset
+
+    def _allocate(self, data):
+        if self.file is not None:
+            self._arrays = [self._create_dataset(name, (0,) + d.shape[1:],
+                                                 d.dtype)
+                            for name, d in zip(self.names, data)]
+        else:
+            self._arrays = [np.empty((self.chunk_size,) + d.shape[1:], d.dtype)
+                            for d in data]
+
+    def add(self, data):
+        """Add the rows of a learning set whose feature vectors are new.
+
+        Parameters
+        ----------
+        data : list of array
+            The features, labels, weights and history of a learning
+            set, as returned by ``Rag.learn_flat``. Empty lists are
+            ignored.
+
+        Returns
+        -------
+        num_added : int
+            The number of rows added.
+        """
+        if len(data) == 0 or len(data[0]) == 0:
+            return 0
+        data = map(np.asarray, data)
+        keep, digests = self._index(data[0])
+        logging.debug('%d of %d feature vectors are repeats.' %
+                      (len(data[0]) - len(keep), len(data[0])))
+        if len(keep) == 0:
+            return 0
+        if self._arrays is None:
+            self._allocate(data)
+        start, stop = self.size, self.size + len(keep)
+        for i, (ar, d) in enumerate(zip(self._arrays, data)):
+            if self.file is not None:
+                ar.resize(stop, axis=0)
+            elif len(ar) < stop:
+                grown = np.empty((max(stop, 2*len(ar)),) + ar.shape[1:],
+                                 ar.dtype)
+                grown[:start] = ar[:start]
+                ar = self._arrays[i] = grown
+            ar[start:stop] = d[keep]
+        # count the rows only once all of them have been written
+        self.digests.update(digests)
+        self.size = stop
+        return len(keep)
+
+    def get_data(self):
+        """Return the features, labels, weights and history arrays.
+
+        Returns
+        -------
+        data : list of array
+            The rows added so far, read into memory from the HDF5 file
+            if there is one. Otherwise, they are views of the store,
+            which must not be modified, but which later additions leave
+            unchanged.
+        """
+        if self._arrays is None:
+            return [np.zeros(0) for name in self.names]
+        if self.file is not None:
+            return [np.array(ar) for ar in self._arrays]
+        return [ar[:self.size] for ar in self._arrays]
+
+    def close(self):
+        """Close the HDF5 file, if any."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def stratified_sample(labels, num_samples):
+    """Return the indices of a random sample stratified by label.
+
+    Each label is sampled in proportion to its frequency, rounding the
+    number of samples of each label to the nearest integers adding up
+    to `num_samples`.
+
+    Parameters
+    ----------
+    labels : np.ndarray [M] or [M x 1]
+        The label of each sample.
+    num_samples : int
+        The number of samples to draw, at most M.
+
+    Returns
+    -------
+    idxs : np.ndarray [num_samples]
+        The indices of the samples, in increasing order.
+    """
+    labels = np.ravel(labels)
+    classes, inverse = np.unique(labels, return_inverse=True)
+    counts = np.bincount(inverse)
+    quotas = counts * float(num_samples) / len(labels)
+    sizes = np.floor(quotas).astype(int)
+    remainders = np.argsort(sizes - quotas, kind='mergesort')
+    sizes[remainders[:num_samples - sizes.sum()]] += 1
+    order = np.argsort(inverse, kind='mergesort')
+    starts = np.concatenate(([0], np.cumsum(counts)))
+    idxs = [order[starts[i] + np.array(random.sample(range(counts[i]),
+                                                     sizes[i]), int)]
+            for i in range(len(classes))]
+    return np.sort(np.concatenate(idxs))
+
+def sample_training_data(features, labels, num_samples=None,
+                         stratified=False):
     """Get a random sample from a classification training dataset.
 
     Parameters
     ----------
     features: np.ndarray [M x N]
         The M (number of samples) by N (number of features) feature matrix.
+        Any array-like supporting ``len`` and indexing by a list of
+        indices, such as a memory-mapped array, also works; only the
+        sampled rows are then read.
     labels: np.ndarray [M] or [M x 1]
         The training label for each feature vector.
     num_samples: int, optional
         The size of the training sample to draw. Return full dataset if `None`
         or if num_samples >= M.
+    stratified: bool, optional
+        Sample each label in proportion to its frequency (see
+        ``stratified_sample``), rather than uniformly.
 
     Returns
     -------
@@ -265,7 +802,10 @@ def sample_training_data(features, labels, num_samples=None):
     m = len(features)
     if num_samples is None or num_samples >= m:
         return features, labels
-    idxs = random.sample(range(m), num_samples)
+    if stratified:
+        idxs = stratified_sample(labels, num_samples)
+    else:
+        idxs = random.sample(range(m), num_samples)
     return features[idxs], labels[idxs]
 
 def save_training_data_to_disk(data, fn, names=None, info='N/A'):
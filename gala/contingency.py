@@ -0,0 +1,208 @@
+import numpy as np
+from scipy import sparse
+
+
+_EMPTY_ROW = (np.zeros(0, np.int64), np.zeros(0, np.double))
+
+
+def add_rows(row1, row2):
+    """Return the sum of two sparse rows.
+
+    Parameters
+    ----------
+    row1, row2 : tuple of (array of int, array of float)
+        The sorted column indices and the values of each row.
+
+    Returns
+    -------
+    row : tuple of (array of int, array of float)
+        The sorted column indices and values of the sum.
+    """
+    cols = np.concatenate((row1[0], row2[0]))
+    if len(cols) == 0:
+        return _EMPTY_ROW
+    vals = np.concatenate((row1[1], row2[1]))
+    cols, idxs = np.unique(cols, return_inverse=True)
+    return cols, np.bincount(idxs, vals, len(cols))
+
+
+class ContingencyTable(object):
+    """A sparse contingency table whose rows can be merged in place.
+
+    The table stores the rows of the initial segmentation in CSR form,
+    and every row created or changed by a merge as a pair of sorted
+    column and value arrays. Merging two rows thus takes time
+    proportional to their number of nonzero entries, and the memory
+    used grows with the number of nonzero entries rather than with
+    the product of the number of segments in each segmentation.
+
+    Rows are never modified in place, so copies of the table share
+    all of its arrays and only copy the dictionary of merged rows.
+
+    Parameters
+    ----------
+    table : scipy.sparse matrix
+        The initial contingency table, with unnormalized counts.
+
+    Attributes
+    ----------
+    total : float
+        The sum of all entries in the table. Merging rows preserves it.
+    ncols : int
+        The number of columns of the table.
+
+    Examples
+    --------
+    >>> ct = ContingencyTable(sparse.csr_matrix([[0, 2, 1], [0, 0, 3]]))
+    >>> ct.merge(0, 1, 2)
+    >>> ct.row(2)
+    (array([1, 2]), array([ 2.,  4.]))
+    >>> ct.argmax(2), ct.row_sum(2), ct.row_sum(0)
+    (2, 6.0, 0.0)
+    """
+    def __init__(self, table):
+        table = sparse.csr_matrix(table, dtype=np.double)
+        table.sum_duplicates()
+        table.sort_indices()
+        self.indptr = table.indptr
+        self.indices = table.indices.astype(np.int64)
+        self.data = table.data
+        self.ncols = table.shape[1]
+        self.total = float(self.data.sum())
+        self.rows = {}
+
+    def __copy__(self):
+        ct = ContingencyTable.__new__(ContingencyTable)
+        ct.__dict__.update(self.__dict__)
+        ct.rows = self.rows.copy()
+        return ct
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def copy(self):
+        """Return a copy of the table, sharing its rows."""
+        return self.__copy__()
+
+    def row(self, i):
+        """Return the nonzero column indices and values of row `i`.
+
+        The returned arrays must not be modified.
+        """
+        try:
+            return self.rows[i]
+        except KeyError:
+            if i >= len(self.indptr) - 1:
+                return _EMPTY_ROW
+            start, stop = self.indptr[i], self.indptr[i + 1]
+            return self.indices[start:stop], self.data[start:stop]
+
+    def merge(self, i, j, k):
+        """Replace rows `i` and `j` by their sum in row `k`.
+
+        Rows `i` and `j` are left empty, unless one of them is `k`.
+        """
+        merged = add_rows(self.row(i), self.row(j))
+        self.rows[i] = self.rows[j] = _EMPTY_ROW
+        self.rows[k] = merged
+
+    def row_sum(self, i):
+        """Return the sum of row `i`."""
+        return self.row(i)[1].sum()
+
+    def argmax(self, i):
+        """Return the column of the largest entry of row `i`.
+
+        Like ``numpy.argmax``, ties go to the lowest column, and an
+        empty row returns 0.
+        """
+        cols, vals = self.row(i)
+        if len(vals) == 0:
+            return 0
+        return cols[vals.argmax()]
+
+    def assignment(self, i):
+        """Return the columns sharing the largest entry of row `i`.
+
+        Returns
+        -------
+        cols : tuple of int, or None
+            The columns, in increasing order, or ``None`` if the row is
+            empty, in which case it is equally assigned to every column.
+        """
+        cols, vals = self.row(i)
+        if len(vals) == 0:
+            return None
+        return tuple(cols[vals == vals.max()])
+
+    def assignment_ids(self, ids):
+        """Return a number for the assignment of each of rows `ids`.
+
+        Two rows get the same number exactly when ``assignment`` returns
+        the same value for both: rows assigned to a single column get
+        that column, empty rows get -1, and each distinct tie between
+        several columns gets a number from `ncols` up.
+
+        Parameters
+        ----------
+        ids : array of int
+            The rows of the table.
+
+        Returns
+        -------
+        numbers : array of int
+            The number of each row.
+        """
+        table = self.take(ids)
+        lengths = np.diff(table.indptr)
+        numbers = np.full(len(lengths), -1, np.int64)
+        nonempty = np.flatnonzero(lengths)
+        if len(nonempty) == 0:
+            return numbers
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        maxes = np.zeros(len(lengths))
+        maxes[nonempty] = np.maximum.reduceat(table.data,
+                                              table.indptr[nonempty])
+        tied = table.data == maxes[rows]
+        rows, cols = rows[tied], table.indices[tied]
+        counts = np.bincount(rows, minlength=len(lengths))
+        single = counts[rows] == 1
+        numbers[rows[single]] = cols[single]
+        ties = {}
+        for i in np.flatnonzero(counts > 1):
+            start = np.searchsorted(rows, i)
+            key = tuple(cols[start:start + counts[i]])
+            numbers[i] = ties.setdefault(key, self.ncols + len(ties))
+        return numbers
+
+    def take(self, ids):
+        """Return rows `ids` of the table as a ``scipy.sparse.csr_matrix``.
+
+        Row `i` of the result is row ``ids[i]`` of the table, with its
+        columns in increasing order.
+        """
+        ids = np.asarray(ids, np.int64)
+        table = self.tocsr()
+        extra = ids.max() + 1 - table.shape[0] if len(ids) > 0 else 0
+        if extra > 0:
+            indptr = np.concatenate((table.indptr,
+                                     np.repeat(table.indptr[-1], extra)))
+            table = sparse.csr_matrix((table.data, table.indices, indptr),
+                                      shape=(len(indptr) - 1, self.ncols))
+        table = table[ids]
+        table.sort_indices()
+        return table
+
+    def tocsr(self):
+        """Return the table as a ``scipy.sparse.csr_matrix``."""
+        nrows = len(self.indptr) - 1
+        if not self.rows:
+            return sparse.csr_matrix((self.data, self.indices, self.indptr),
+                                     shape=(nrows, self.ncols))
+        nrows = max(nrows, max(self.rows) + 1)
+        rows = [self.row(i) for i in range(nrows)]
+        indptr = np.concatenate(([0], np.cumsum([len(c) for c, v in rows])))
+        indices = np.concatenate([c for c, v in rows] + [_EMPTY_ROW[0]])
+        data = np.concatenate([v for c, v in rows] + [_EMPTY_ROW[1]])
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=(nrows, self.ncols))
@@ -1,62 +1,203 @@
-from numpy import inf, unique, array, zeros
-from decision_stump import DecisionStump
+from numpy import inf, unique, array, zeros, argsort, arange, cumsum, where, \
+    argmax, sign, concatenate, repeat, intp, double, uint8, ascontiguousarray
+from decision_stump import DecisionStump, Stump
+from . import optimized as opt
 
 class DecisionTree():
     """ Class for a decision tree.
         The trees are grown until completion or up to a specified maximum depth.
         The splits are based on the imlementation of DecisionStump, which currently
             splits on weighted classification error.
-    """    
-    def fit(self, X, Y, w, depth=inf, curr_depth=0, curr_node=None):
 
-        self.head = self.build_tree(X.copy(),Y.copy(),w.copy(),depth,curr_depth)
+        Each feature is sorted only once, before growing the tree, and the
+        samples of each node are given by their indices, so that the sorted
+        order of the samples of a node is a subsequence of that of its parent.
+        Samples whose feature values are distinct give the same splits as
+        ``DecisionStump.fit`` on the samples of each node.
+    """
+    def fit(self, X, Y, w, depth=inf, curr_depth=0, curr_node=None,
+            order=None):
+        """ Grow the tree on samples X, labels Y (1 or -1) and weights w.
+            `order` is the argsort of each column of X, which can be
+            given to reuse it across trees.
+        """
+        if order is None:
+            order = presort(X)
+        rows = arange(len(X))
+        self.head = self.build_tree(X, Y, w, depth, curr_depth, rows, order.T)
         self.weights = w.copy()
+        self._flat = None
         return self
 
-    def build_tree(self, X, Y, w, depth, curr_depth):
+    def build_tree(self, X, Y, w, depth, curr_depth, rows, sorted_rows):
+        """ Grow the subtree of samples `rows`, in increasing order.
+            Row j of `sorted_rows` holds the same samples, sorted by feature j.
+        """
         # See if we can do any splitting at all
         tree = Node()
-        yw = Y*w
-        if len(X)<2 or len(unique(Y)) < 2 or curr_depth >= depth:
-            tree.stump = 1.0 if abs(sum(yw[yw>=0]))>abs(sum(yw[yw<0])) else -1.0
+        yw = Y[rows]*w[rows]
+        if len(rows)<2 or len(unique(Y[rows])) < 2 or curr_depth >= depth:
+            tree.stump = 1.0 if abs(_sum(yw[yw>=0]))>abs(_sum(yw[yw<0])) else -1.0
             return tree
         # TODO: check for inconsistent data
 
         # Learn the decision stump
-        stump = DecisionStump().fit(X,Y,w)
-        side1 = stump.predict(X)>=0
-        side2 = stump.predict(X)<0
+        stump = best_stump(X, Y, w, sorted_rows)
+        x = X[rows, stump.feature_index]
+        pred = stump.stump.s*(2.0*(x>stump.stump.threshold).astype(uint8)-1)
+        side1 = pred>=0
+        side2 = pred<0
+        in_side1 = zeros(len(X), bool)
+        in_side1[rows[side1]] = True
+        in_side2 = zeros(len(X), bool)
+        in_side2[rows[side2]] = True
 
         tree.stump = stump
-        tree.left = self.build_tree(X[side1], Y[side1], w[side1], depth, curr_depth+1)
-        tree.right = self.build_tree(X[side2], Y[side2], w[side2], depth, curr_depth+1)
-        
+        tree.left = self.build_tree(X, Y, w, depth, curr_depth+1, rows[side1],
+                        _subsequences(sorted_rows, in_side1, side1.sum()))
+        tree.right = self.build_tree(X, Y, w, depth, curr_depth+1, rows[side2],
+                        _subsequences(sorted_rows, in_side2, side2.sum()))
+
         return tree
 
     def predict(self, X, curr_node=None):
         if len(X.shape)==1:
             X = array([X])
-        
-        if curr_node is None:
-            curr_node = self.head
 
+        if curr_node is not None:
+            return self._predict_node(X, curr_node)
+        if getattr(self, '_flat', None) is None:
+            self._flat = concatenate_trees([self.flatten()])
+        roots, feature, threshold, left, right, values = self._flat
+        return opt.predict_tree_ensemble(ascontiguousarray(X, double),
+                    roots, feature, threshold, left, right, array([1.0]),
+                    values)[:, 0]
+
+    def _predict_node(self, X, curr_node):
         pred = zeros(len(X))
         if not isinstance(curr_node.stump, DecisionStump):
             return curr_node.stump
 
         side1 = curr_node.stump.predict(X)>=0
         side2 = curr_node.stump.predict(X)<0
-        
+
         if sum(side1)>0:
-            pred[side1] = self.predict(X[side1], curr_node.left)
+            pred[side1] = self._predict_node(X[side1], curr_node.left)
         if sum(side2)>0:
-            pred[side2] = self.predict(X[side2], curr_node.right)
+            pred[side2] = self._predict_node(X[side2], curr_node.right)
 
         return pred
 
+    def flatten(self):
+        """ Return the tree as node arrays of optimized.predict_tree_ensemble:
+            feature, threshold, left, right and (leaf) values.
+
+            A DecisionStump with direction s sends a row left when
+            s * (2 * (x > threshold) - 1) >= 0. Going right when
+            x > threshold thus means swapping the children when s > 0,
+            and never going right when s == 0.
+        """
+        nodes = [self.head]
+        feature, threshold, left, right, values = [], [], [], [], []
+        i = 0
+        while i < len(nodes):
+            node = nodes[i]
+            if not isinstance(node.stump, DecisionStump):
+                feature.append(0)
+                threshold.append(0.0)
+                left.append(-1)
+                right.append(-1)
+                values.append([node.stump])
+            else:
+                children = [node.left, node.right]
+                s = node.stump.stump.s
+                if s > 0:
+                    children.reverse()
+                feature.append(node.stump.feature_index)
+                threshold.append(node.stump.stump.threshold if s != 0 else inf)
+                left.append(len(nodes))
+                right.append(len(nodes) + 1)
+                values.append([0.0])
+                nodes.extend(children)
+            i += 1
+        return (array(feature), array(threshold, double), array(left),
+                array(right), array(values, double))
+
 
 class Node():
     def __init__(self):
         self.left = None
         self.right = None
         self.stump = None
+
+
+def presort(X):
+    """ Return the order of the samples X sorted by each feature. """
+    return argsort(X, axis=0, kind='mergesort')
+
+
+def best_stump(X, Y, w, sorted_rows):
+    """ Return the best DecisionStump on the samples in `sorted_rows`.
+
+        This scores the splits of all features at once, as
+        build_stump_1d and train_decision_stump do one feature at a time:
+        row j of `sorted_rows` holds the samples sorted by feature j.
+    """
+    nfeatures, n = sorted_rows.shape
+    xsorted = X.T[arange(nfeatures)[:, None], sorted_rows]
+    wy = Y[sorted_rows]*w[sorted_rows]
+    wy_pos = wy.clip(0, inf)
+    wy_neg = wy.clip(-inf, 0)
+    score_left_pos = cumsum(wy_pos, axis=1)
+    score_right_pos = cumsum(wy_pos[:, ::-1], axis=1)
+    score_left_neg = cumsum(wy_neg, axis=1)
+    score_right_neg = cumsum(wy_neg[:, ::-1], axis=1)
+
+    score1 = -score_left_pos[:, 0:-1:1] + score_right_neg[:, -2::-1]
+    score2 = -score_left_neg[:, 0:-1:1] + score_right_pos[:, -2::-1]
+    score = where(abs(score1)>abs(score2), score1, score2)
+    # never split between samples with identical feature values
+    abs_score = where(xsorted[:, :-1] < xsorted[:, 1:], abs(score), -inf)
+    ind = argmax(abs_score, axis=1)
+    maxscores = abs_score[arange(nfeatures), ind]
+    feature_index = argmax(maxscores)
+    stump = DecisionStump()
+    stump.feature_index = feature_index
+    if maxscores[feature_index] == -inf:
+        stump.stump = Stump(-inf, 0, 0)
+    else:
+        ind = ind[feature_index]
+        x = xsorted[feature_index]
+        stump.stump = Stump(maxscores[feature_index], (x[ind] + x[ind+1])/2.0,
+                            sign(score[feature_index, ind]))
+    return stump
+
+
+def concatenate_trees(trees):
+    """ Concatenate the node arrays of several trees, as returned by
+        DecisionTree.flatten, into the roots, feature, threshold, left,
+        right and values arrays of optimized.predict_tree_ensemble.
+    """
+    sizes = [len(t[0]) for t in trees]
+    roots = cumsum([0] + sizes[:-1]).astype(intp)
+    if len(trees) == 0:
+        trees = [(zeros(0), zeros(0), zeros(0), zeros(0), zeros((0, 1)))]
+    feature, left, right = [concatenate([t[j] for t in trees]).astype(intp)
+                            for j in [0, 2, 3]]
+    node_offsets = repeat(roots, sizes)
+    for children in [left, right]:
+        children += node_offsets * (children != -1)
+    threshold = concatenate([t[1] for t in trees]).astype(double)
+    values = ascontiguousarray(concatenate([t[4] for t in trees]), double)
+    return roots[:len(sizes)], feature, threshold, left, right, values
+
+
+def _sum(a):
+    """ Add up `a` in order, as the builtin sum does. """
+    return cumsum(a)[-1] if len(a) > 0 else 0
+
+
+def _subsequences(sorted_rows, selected, n):
+    """ Keep the `n` samples marked in `selected` in each row of `sorted_rows`.
+    """
+    return sorted_rows[selected[sorted_rows]].reshape((len(sorted_rows), n))
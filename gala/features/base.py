@@ -1,5 +1,9 @@
 import numpy as np
 
+def _stack(rows):
+    """Stack feature vectors, possibly empty, as the rows of an array."""
+    return np.array(rows).reshape((len(rows), -1))
+
 class Null(object):
     def __init__(self, *args, **kwargs):
         self.default_cache = 'feature-cache'
@@ -24,10 +28,71 @@ class Null(object):
             self.compute_edge_features(g, n1, n2, ce),
             self.compute_difference_features(g, n1, n2, c1, c2)
         ))
+    def compute_all_features(self, g, edges):
+        """Return the feature vectors of all `edges`, one per row.
+
+        Row `i` is identical to ``self(g, *edges[i])``, but the features
+        of each node are computed only once, and each kind of feature
+        is computed for all nodes or edges in one call, which managers
+        can override to work in bulk.
+        """
+        if len(edges) == 0:
+            return np.zeros((0, 0))
+        edges = [(n1, n2) if g.node[n1]['size'] <= g.node[n2]['size'] else
+                 (n2, n1) for n1, n2 in edges] # smaller node first
+        nodes = sorted(set([n for e in edges for n in e]))
+        index = dict(zip(nodes, range(len(nodes))))
+        c1, c2, ce = [[g.node[n1][self.default_cache] for n1, n2 in edges],
+                      [g.node[n2][self.default_cache] for n1, n2 in edges],
+                      [g[n1][n2][self.default_cache] for n1, n2 in edges]]
+        node_features = self.compute_all_node_features(g, nodes,
+                            [g.node[n][self.default_cache] for n in nodes])
+        i1, i2 = np.array([[index[n1], index[n2]] for n1, n2 in edges]).T
+        return np.concatenate((
+            node_features[i1],
+            node_features[i2],
+            self.compute_all_edge_features(g, edges, ce),
+            self.compute_all_difference_features(g, edges, c1, c2)
+        ), axis=1)
+    def compute_all_node_features(self, g, nodes, caches):
+        """Return the features of all `nodes`, given their caches.
+
+        Row `i` is ``self.compute_node_features(g, nodes[i], caches[i])``.
+        """
+        return _stack([self.compute_node_features(g, n, c)
+                       for n, c in zip(nodes, caches)])
+    def compute_all_edge_features(self, g, edges, caches):
+        """Return the features of all `edges`, given their caches."""
+        return _stack([self.compute_edge_features(g, n1, n2, c)
+                       for (n1, n2), c in zip(edges, caches)])
+    def compute_all_difference_features(self, g, edges, caches1, caches2):
+        """Return the difference features of all `edges`.
+
+        `caches1` and `caches2` are the caches of the first and second
+        node of each edge.
+        """
+        return _stack([self.compute_difference_features(g, n1, n2, c1, c2)
+                       for (n1, n2), c1, c2 in zip(edges, caches1, caches2)])
     def create_node_cache(self, *args, **kwargs):
         return np.array([])
     def create_edge_cache(self, *args, **kwargs):
         return np.array([])
+    def create_all_node_caches(self, g, nodes, idxs, labels):
+        """Return the caches of all `nodes` at once.
+
+        `idxs` are the voxels of the nodes, and `labels[i]` is the
+        position in `nodes` of the node containing voxel `idxs[i]`.
+        Managers can override this to compute every cache in bulk; by
+        default, each cache is created individually.
+        """
+        return [self.create_node_cache(g, n) for n in nodes]
+    def create_all_edge_caches(self, g, edges, idxs, labels):
+        """Return the caches of all `edges` at once.
+
+        See ``create_all_node_caches``. A voxel appears once for each
+        edge it borders.
+        """
+        return [self.create_edge_cache(g, n1, n2) for n1, n2 in edges]
     def update_node_cache(self, *args, **kwargs):
         pass
     def update_edge_cache(self, *args, **kwargs):
@@ -59,6 +124,16 @@ class Composite(Null):
 
     def create_edge_cache(self, *args, **kwargs):
         return [c.create_edge_cache(*args, **kwargs) for c in self.children]
+
+    def create_all_node_caches(self, g, nodes, idxs, labels):
+        caches = [c.create_all_node_caches(g, nodes, idxs, labels)
+                  for c in self.children]
+        return [[cache[i] for cache in caches] for i in range(len(nodes))]
+
+    def create_all_edge_caches(self, g, edges, idxs, labels):
+        caches = [c.create_all_edge_caches(g, edges, idxs, labels)
+                  for c in self.children]
+        return [[cache[i] for cache in caches] for i in range(len(edges))]
     
     def update_node_cache(self, g, n1, n2, dst, src):
         for i, child in enumerate(self.children):
@@ -98,4 +173,23 @@ class Composite(Null):
             features.append(child.compute_difference_features(
                                             g, n1, n2, cache1[i], cache2[i]))
         return np.concatenate(features)
+
+    def compute_all_node_features(self, g, nodes, caches):
+        return np.concatenate([child.compute_all_node_features(
+                                    g, nodes, [cache[i] for cache in caches])
+                               for i, child in enumerate(self.children)],
+                              axis=1)
+
+    def compute_all_edge_features(self, g, edges, caches):
+        return np.concatenate([child.compute_all_edge_features(
+                                    g, edges, [cache[i] for cache in caches])
+                               for i, child in enumerate(self.children)],
+                              axis=1)
+
+    def compute_all_difference_features(self, g, edges, caches1, caches2):
+        return np.concatenate([child.compute_all_difference_features(
+                                    g, edges, [cache[i] for cache in caches1],
+                                    [cache[i] for cache in caches2])
+                               for i, child in enumerate(self.children)],
+                              axis=1)
     
@@ -64,6 +64,55 @@ class Manager(base.Null):
                 'either a 1-d or 2-d np.array of probabilities. '+
                 'Got %i-d np.array.'% vals.ndim)
 
+    def bin_indices(self, vals):
+        """Return the histogram bin of each of `vals`, or -1 if outside.
+
+        The bins are assigned exactly as in ``numpy.histogram``.
+        """
+        mn, mx = self.minval + 0.0, self.maxval + 0.0
+        if mn == mx:
+            mn -= 0.5
+            mx += 0.5
+        keep = (vals >= mn)
+        keep &= (vals <= mx)
+        data = vals[keep].astype(float)
+        bin_edges = np.linspace(mn, mx, self.nbins + 1, endpoint=True)
+        indices = ((data - mn) * (self.nbins / (mx - mn))).astype(np.intp)
+        indices[indices == self.nbins] -= 1
+        indices[data < bin_edges[indices]] -= 1
+        indices[(data >= bin_edges[indices + 1]) &
+                (indices != self.nbins - 1)] += 1
+        out = -np.ones(len(vals), np.intp)
+        out[keep] = indices
+        return out
+
+    def histograms(self, vals, labels, n):
+        """Compute the histograms of the values of each of `n` labels.
+
+        Parameters
+        ----------
+        vals : array of float, shape (M, C)
+            The values, in `C` channels.
+        labels : array of int, shape (M,)
+            The label, in ``range(n)``, of each row of `vals`.
+        n : int
+            The number of labels.
+
+        Returns
+        -------
+        hists : list of array of float, shape (C, nbins)
+            The histogram of each label, as ``histogram`` would compute
+            it from the values of that label.
+        """
+        hists = np.zeros((n, vals.shape[1], self.nbins), np.double)
+        for c in range(vals.shape[1]):
+            bins = self.bin_indices(vals[:, c])
+            keep = bins >= 0
+            counts = np.bincount(labels[keep] * self.nbins + bins[keep],
+                                 minlength=n * self.nbins)
+            hists[:, c, :] = counts.reshape((n, self.nbins))
+        return list(hists)
+
     def percentiles_py(self, h, desired_percentiles):
         if h.ndim == 1 or any([i==1 for i in h.shape]): h = h.reshape((1,-1))
         h = h.T
@@ -118,6 +167,20 @@ class Manager(base.Null):
 
         return self.histogram(ar[edge_idxs,:])
 
+    def create_all_node_caches(self, g, nodes, idxs, labels):
+        if self.oriented:
+            ar = g.max_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        return self.histograms(ar[idxs,:], labels, len(nodes))
+
+    def create_all_edge_caches(self, g, edges, idxs, labels):
+        if self.oriented:
+            ar = g.oriented_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        return self.histograms(ar[idxs,:], labels, len(edges))
+
     def update_node_cache(self, g, n1, n2, dst, src):
         dst += src
 
@@ -149,6 +212,8 @@ class Manager(base.Null):
         return (self.KL_divergence(p, m) + self.KL_divergence(q, m))/2
     def KL_divergence(self, p, q):
         """Return the Kullback-Leibler Divergence between two histograms."""
+        if p.ndim > 2:
+            return self._stacked_KL_divergence(p, q)
         kl = []
         if p.ndim == 1: 
             p = p[np.newaxis,:]
@@ -162,6 +227,25 @@ class Manager(base.Null):
             kl.append(k)
         return np.array(kl)
 
+    def _stacked_KL_divergence(self, p, q):
+        """Compute ``KL_divergence`` for each of a stack of histograms.
+
+        The entries of each histogram are summed in the same order, and
+        rows with as many nonzero entries are summed together, so the
+        results are identical.
+        """
+        shape = p.shape[:-1]
+        p, q = p.reshape((-1, p.shape[-1])), q.reshape((-1, q.shape[-1]))
+        nonzero = p*q != 0
+        counts = nonzero.sum(axis=1)
+        kl = np.ones(len(p))
+        for n in np.unique(counts[counts > 0]):
+            rows = counts == n
+            ind = nonzero[rows]
+            pn, qn = [a[rows][ind].reshape((-1, n)) for a in [p, q]]
+            kl[rows] = (pn * np.log(pn/qn)).sum(axis=1)
+        return kl.reshape(shape)
+
     def compute_node_features(self, g, n, cache=None):
         if not self.compute_histogram:
             return np.array([])
@@ -202,6 +286,42 @@ class Manager(base.Null):
         else:
             return self.JS_divergence(h1, h2)
 
+    def normalized_histograms_from_caches(self, caches):
+        """Normalize each of a stack of caches, as a histogram per channel.
+
+        The histograms are identical to those returned by
+        ``normalized_histogram_from_cache`` for each cache.
+        """
+        caches = np.array(caches, dtype=np.double)
+        s = caches.sum(axis=2)[..., np.newaxis]
+        s[s==0] = 1
+        return caches/s
+
+    def _all_histogram_features(self, caches):
+        if not self.compute_histogram or self.use_neuroproof:
+            return np.zeros((len(caches), 0))
+        h = self.normalized_histograms_from_caches(caches)
+        return h.reshape((len(h), -1))
+
+    def compute_all_node_features(self, g, nodes, caches):
+        if self.compute_histogram and len(self.compute_percentiles) > 0:
+            return super(Manager, self).compute_all_node_features(
+                                                            g, nodes, caches)
+        return self._all_histogram_features(caches)
+
+    def compute_all_edge_features(self, g, edges, caches):
+        if self.compute_histogram and len(self.compute_percentiles) > 0:
+            return super(Manager, self).compute_all_edge_features(
+                                                            g, edges, caches)
+        return self._all_histogram_features(caches)
+
+    def compute_all_difference_features(self, g, edges, caches1, caches2):
+        if self.use_neuroproof:
+            return np.zeros((len(edges), 0))
+        h1 = self.normalized_histograms_from_caches(caches1)
+        h2 = self.normalized_histograms_from_caches(caches2)
+        return self.JS_divergence(h1, h2)
+
 cdef _percentiles(double[:,:] h, double[:] desired_percentiles,
                   double minval, double maxval, int nbins):
     cdef double p, slope, prev_h, delta, estim, step_size, prev_b
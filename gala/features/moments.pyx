@@ -51,6 +51,45 @@ class Manager(base.Null):
             ar = g.non_oriented_probabilities_r
         return self.compute_moment_sums(ar, edge_idxs)
 
+    def compute_all_moment_sums(self, ar, idxs, labels, n):
+        """Compute the moment sums of the voxels of each of `n` labels.
+
+        The sums are accumulated in the order of `idxs`, as in
+        ``compute_moment_sums``, so the results are identical.
+        """
+        sums = np.zeros((n, self.nmoments+1, ar.shape[1]), np.double)
+        for c in range(ar.shape[1]):
+            values = ar[idxs, c]
+            for i in range(self.nmoments+1):
+                if i == 0: # x ** 0 == 1, so the sum is the voxel count
+                    weights = None
+                elif i == 1:
+                    weights = values
+                else:
+                    weights = np.power(values, np.double(i))
+                sums[:, i, c] = np.bincount(labels, weights, minlength=n)
+        return list(sums)
+
+    def create_all_node_caches(self, g, nodes, idxs, labels):
+        if self.oriented:
+            ar = g.max_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        if ar.dtype != np.double or ar.ndim != 2:
+            return super(Manager, self).create_all_node_caches(
+                                                    g, nodes, idxs, labels)
+        return self.compute_all_moment_sums(ar, idxs, labels, len(nodes))
+
+    def create_all_edge_caches(self, g, edges, idxs, labels):
+        if self.oriented:
+            ar = g.oriented_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        if ar.dtype != np.double or ar.ndim != 2:
+            return super(Manager, self).create_all_edge_caches(
+                                                    g, edges, idxs, labels)
+        return self.compute_all_moment_sums(ar, idxs, labels, len(edges))
+
     def update_node_cache(self, g, n1, n2, dst, src):
         dst += src
 
@@ -111,6 +150,35 @@ class Manager(base.Null):
         n = feat.ravel()[0]
         return np.concatenate(([n], feat[1:].T.ravel()))
 
+    def _all_moment_features(self, caches):
+        feat = central_moments_from_noncentral_sums_stacked(caches)
+        if self.normalize:
+            feat = ith_root_stacked(feat)
+        return _stacked_features(feat)
+
+    def compute_all_node_features(self, g, nodes, caches):
+        return self._all_moment_features(caches)
+
+    def compute_all_edge_features(self, g, edges, caches):
+        return self._all_moment_features(caches)
+
+    def compute_all_difference_features(self, g, edges, caches1, caches2,
+                                                            nthroot=False):
+        if not self.use_diff_features:
+            return np.zeros((len(edges), 0))
+        m1 = central_moments_from_noncentral_sums_stacked(caches1)
+        m2 = central_moments_from_noncentral_sums_stacked(caches2)
+        if nthroot or self.normalize:
+            m1, m2 = map(ith_root_stacked, [m1, m2])
+        return _stacked_features(abs(m1-m2))
+
+
+def _stacked_features(feat):
+    """Arrange stacked moments as the features of each, one per row."""
+    n = feat[:, :1, 0]
+    return np.concatenate((n, feat[:, 1:].transpose((0, 2, 1)).reshape(
+                                                    (len(feat), -1))), axis=1)
+
 
 def central_moments_from_noncentral_sums(a):
     return _central_moments_from_noncentral_sums(a.astype(np.double))
@@ -178,6 +246,38 @@ def central_moments_from_noncentral_sums_py(a):
     ac[1] = mu
     return ac
 
+def central_moments_from_noncentral_sums_stacked(a):
+    """Compute ``central_moments_from_noncentral_sums`` of a stack of sums.
+
+    The moments are computed with the same operations, in the same
+    order, as for a single array of sums, so the results are identical.
+    """
+    a = np.array(a, dtype=np.double)
+    if a.shape[1] == 1:
+        return a
+    N = a[:, 0].copy()
+    a /= N[:, np.newaxis]
+    mu = a[:, 1]
+    ac = np.zeros_like(a)
+    for n in range(2, a.shape[1]):
+        total = np.zeros_like(mu)
+        for jj in range(n+1):
+            total += (_nchoosek(n,jj) * (-1)**(n-jj) * a[:, jj] *
+                      np.power(mu, np.double(n-jj)))
+        ac[:, n] = total
+    ac[:, 0] = N
+    ac[:, 1] = mu
+    return ac
+
+def ith_root_stacked(ar):
+    """Apply ``ith_root`` to each of a stack of arrays."""
+    if ar.shape[1] < 2:
+        return ar
+    ar = ar.copy()
+    ar[:, 2:] = np.sign(ar[:, 2:]) * \
+        (abs(ar[:, 2:]) ** (1.0/np.arange(2, ar.shape[1]))[:, np.newaxis])
+    return ar
+
 def ith_root(ar):
     """Get the ith root of the array values at ar[i] for i > 1."""
     if len(ar) < 2:
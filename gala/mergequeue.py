@@ -1,25 +1,82 @@
-
-from heapq import heapify, heappush, heappop
+from copy import deepcopy
+from heapq import heapify
 from iterprogress import NoProgressBar, StandardProgressBar
 
 class MergeQueue(object):
-    def __init__(self, items=[], length=None, with_progress=False, 
+    """An addressable priority queue of merges.
+
+    The queue is a binary heap of items, lists of the form
+    ``[priority, valid, node1, node2]``, that also tracks the position
+    of each item in the heap. Items can therefore be removed
+    (``invalidate``) or given a new priority (``update``) in place, in
+    O(log n) time, and the heap only ever holds live items.
+
+    Items whose valid flag is set to ``False`` outside of the queue
+    are discarded when they reach the top of the heap. Until then, they
+    are counted by ``len``, so use ``peek`` to check whether the queue
+    holds any valid item.
+
+    Attributes
+    ----------
+    num_pushes : int
+        The number of items pushed onto the queue.
+    num_updates : int
+        The number of in-place priority updates.
+    num_removals : int
+        The number of items removed from the queue by ``invalidate``.
+    num_stale_pops : int
+        The number of invalid items discarded from the top of the heap.
+    """
+    def __init__(self, items=None, length=None, with_progress=False,
                                             prog_title='Agglomerating... '):
+        if items is None:
+            items = []
+        self.q = [item for item in items if item[1]]
+        heapify(self.q)
+        self.index = dict((id(item), i) for i, item in enumerate(self.q))
         if length is None:
-            self.num_valid_items = len(items)
+            self.original_length = len(self.q)
         else:
-            self.num_valid_items = length
-        self.original_length = self.num_valid_items
-        self.q = items
-        heapify(self.q)
+            self.original_length = length
         self.is_null_queue = len(items) == 0
+        self.num_pushes = 0
+        self.num_updates = 0
+        self.num_removals = 0
+        self.num_stale_pops = 0
         if with_progress:
             self.pbar = StandardProgressBar(prog_title)
         else:
             self.pbar = NoProgressBar()
 
+    def __deepcopy__(self, memo):
+        """Copy the queue and its items, and index the copied items.
+
+        Items are copied through `memo`, so that other references to an
+        item copied in the same ``deepcopy`` call, such as the ``qlink``
+        of a ``Rag`` edge, refer to its copy in the queue.
+        """
+        q = MergeQueue.__new__(MergeQueue)
+        memo[id(self)] = q
+        q.__dict__.update(self.__dict__)
+        q.q = [deepcopy(item, memo) for item in self.q]
+        q.index = dict((id(item), i) for i, item in enumerate(q.q))
+        q.pbar = deepcopy(self.pbar, memo)
+        if 'pop' in self.__dict__: # the queue has been started
+            q.pop = q.pop_no_start
+        if 'push' in self.__dict__:
+            q.push = q.push_next
+        return q
+
     def __len__(self):
-        return self.num_valid_items
+        """Return the number of items in the heap.
+
+        This includes items marked invalid outside of the queue that
+        have not yet been discarded.
+        """
+        return len(self.q)
+
+    def __contains__(self, item):
+        return id(item) in self.index
 
     def finish(self):
         self.pbar.finish()
@@ -28,8 +85,16 @@ class MergeQueue(object):
         return len(self.q) == 0
 
     def peek(self):
-        while not self.q[0][1]:
-            heappop(self.q)
+        """Return the valid item of lowest priority, leaving it queued.
+
+        Returns
+        -------
+        item : list or None
+            The item, or ``None`` if the queue holds no valid items.
+        """
+        self._discard_stale()
+        if len(self.q) == 0:
+            return None
         return self.q[0]
 
     def pop(self):
@@ -38,14 +103,12 @@ class MergeQueue(object):
         return self.pop_no_start()
 
     def pop_no_start(self):
-        try:
-            while not self.q[0][1]:
-                _ = heappop(self.q)
-        except IndexError:
+        self._discard_stale()
+        if len(self.q) == 0:
             raise IndexError('pop from empty merge queue')
-        item = heappop(self.q)
-        self.invalidate(item)
-        self.pbar.update_i(self.original_length - self.num_valid_items)
+        item = self._remove(0)
+        item[1] = False
+        self.pbar.update_i(self.original_length - len(self.q))
         return item
 
     def push(self, item):
@@ -54,13 +117,99 @@ class MergeQueue(object):
         self.push_next(item)
 
     def push_next(self, item):
-        heappush(self.q, item)
-        self.num_valid_items += 1
+        if item in self:
+            self.update(item)
+            return
+        item[1] = True
+        self.q.append(item)
+        self.index[id(item)] = len(self.q) - 1
+        self._sift_up(len(self.q) - 1)
+        self.num_pushes += 1
+
+    def update(self, item, priority=None):
+        """Restore the heap order after the priority of `item` changed.
+
+        Parameters
+        ----------
+        item : list
+            A queue item. Its priority (``item[0]``) or nodes may have
+            been modified in place.
+        priority : float, optional
+            If given, set the priority of `item` to this value first.
+
+        Raises
+        ------
+        KeyError
+            If `item` is not in the queue.
+        """
+        if priority is not None:
+            item[0] = priority
+        i = self.index[id(item)]
+        if i > 0 and item < self.q[(i - 1) >> 1]:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+        self.num_updates += 1
 
     def invalidate(self, item):
-        if item[1]:
-            self.num_valid_items -= 1
+        """Remove `item` from the queue, if present, and mark it invalid."""
+        i = self.index.get(id(item), None)
+        if i is not None:
+            self._remove(i)
+            self.num_removals += 1
         item[1] = False
 
     def _total_len(self):
         return len(self.q)
+
+    def _discard_stale(self):
+        while len(self.q) > 0 and not self.q[0][1]:
+            self._remove(0)
+            self.num_stale_pops += 1
+
+    def _remove(self, i):
+        q, index = self.q, self.index
+        item = q[i]
+        del index[id(item)]
+        last = q.pop()
+        if i < len(q):
+            q[i] = last
+            index[id(last)] = i
+            if i > 0 and last < q[(i - 1) >> 1]:
+                self._sift_up(i)
+            else:
+                self._sift_down(i)
+        return item
+
+    def _sift_up(self, i):
+        q, index = self.q, self.index
+        item = q[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            parent_item = q[parent]
+            if not item < parent_item:
+                break
+            q[i] = parent_item
+            index[id(parent_item)] = i
+            i = parent
+        q[i] = item
+        index[id(item)] = i
+
+    def _sift_down(self, i):
+        q, index = self.q, self.index
+        n = len(q)
+        item = q[i]
+        child = 2 * i + 1
+        while child < n:
+            child_item = q[child]
+            if child + 1 < n and q[child + 1] < child_item:
+                child += 1
+                child_item = q[child]
+            if not child_item < item:
+                break
+            q[i] = child_item
+            index[id(child_item)] = i
+            i = child
+            child = 2 * i + 1
+        q[i] = item
+        index[id(item)] = i
@@ -1,5 +1,6 @@
 import numpy as np
 cimport numpy as np
+cimport cython
 
 def despeckle_watershed(ws, in_place=True):
     """ Function to clean up dots in an initial oversegmentation. 
@@ -252,3 +253,54 @@ cdef np.ndarray[np.int_t, ndim=2] _adjacent_points(long[:] point, long[:,:] limi
                 adjacent[v,ii] = point[ii]
             adjacent[v, d] = new
     return adjacent
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def predict_tree_ensemble(const double[:, :] X, const np.intp_t[:] roots,
+                          const np.intp_t[:] feature,
+                          const double[:] threshold,
+                          const np.intp_t[:] left, const np.intp_t[:] right,
+                          const double[:] weights,
+                          const double[:, :] values):
+    """Sum the weighted leaf values reached by each row in a tree ensemble.
+
+    The trees are stored as flat node arrays: at node ``i``, a row goes
+    to node ``right[i]`` if its value for feature ``feature[i]`` is
+    greater than ``threshold[i]``, and to node ``left[i]`` otherwise,
+    until it reaches a leaf, marked by ``left[i] == -1``.
+
+    Parameters
+    ----------
+    X : 2D array of float, shape (N, M)
+        The rows to evaluate. Every row must have more than
+        ``feature.max()`` columns.
+    roots : 1D array of int, shape (T,)
+        The root node of each tree.
+    feature, threshold, left, right : 1D arrays, shape (K,)
+        The split of each node, as described above.
+    weights : 1D array of float, shape (T,)
+        The weight of each tree.
+    values : 2D array of float, shape (K, C)
+        The value of each leaf node.
+
+    Returns
+    -------
+    out : 2D array of float, shape (N, C)
+        The sum over trees, in order, of the tree weight times the value
+        of the leaf reached by each row.
+    """
+    cdef Py_ssize_t i, t, k, node
+    out = np.zeros((X.shape[0], values.shape[1]))
+    cdef double[:, :] out_view = out
+    for i in range(X.shape[0]):
+        for t in range(roots.shape[0]):
+            node = roots[t]
+            while left[node] != -1:
+                if X[i, feature[node]] > threshold[node]:
+                    node = right[node]
+                else:
+                    node = left[node]
+            for k in range(values.shape[1]):
+                out_view[i, k] += weights[t] * values[node, k]
+    return out
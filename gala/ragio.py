@@ -0,0 +1,381 @@
+"""Save region adjacency graphs to disk and load them back.
+
+Building a ``Rag`` means examining the neighborhood of every voxel and
+computing the feature caches of every node and edge, which can take
+far longer than agglomerating it. This module stores a freshly built
+graph in a single HDF5 file, from which it can be loaded without
+repeating that work:
+
+- the (unpadded) superpixel, probability and orientation volumes;
+- the node ids, sizes, entrypoints and exclusions, as flat arrays;
+- the edge list, with the boundary voxels of all edges concatenated
+  into one array of sorted runs, plus the offset of each run;
+- the node and edge feature caches, stacked into one array per cache
+  component (graphs whose caches are not numeric arrays of fixed shape
+  cannot be saved);
+- the frozen nodes and edges, and the feature manager description
+  returned by its ``write_fm`` method.
+
+The boundary array is stored contiguously, so that a loaded graph can
+memory-map it rather than read it in.
+"""
+
+import json
+import hashlib
+import functools
+
+import numpy as np
+import h5py
+
+from . import features
+from .indexset import IndexSet
+from .chainedlist import ChainedList
+
+
+FORMAT_VERSION = 2
+
+
+def describe_feature_manager(fm):
+    """Return a JSON description of a feature manager.
+
+    Parameters
+    ----------
+    fm : ``features.base.Null`` object
+        The feature manager.
+
+    Returns
+    -------
+    description : string
+        The class of the manager and the output of its ``write_fm``.
+    """
+    return json.dumps([type(fm).__module__ + '.' + type(fm).__name__,
+                       fm.write_fm({})], sort_keys=True)
+
+
+def create_feature_manager(description):
+    """Create a feature manager from ``describe_feature_manager`` output.
+
+    Only managers supported by ``features.io.create_fm``, and the
+    ``Null`` manager, can be recreated.
+    """
+    name, fm_info = json.loads(description)
+    if name == 'gala.features.base.Null':
+        return features.base.Null()
+    return features.io.create_fm(fm_info)
+
+
+def _describe(value):
+    """Return a representation of `value` that identifies functions.
+
+    Functions are identified by their module and name, and
+    ``functools.partial`` objects by their function and arguments.
+    """
+    if isinstance(value, functools.partial):
+        return ('partial', _describe(value.func),
+                tuple(_describe(a) for a in value.args),
+                sorted((k, _describe(v))
+                       for k, v in (value.keywords or {}).items()))
+    if callable(value) and hasattr(value, '__name__'):
+        return '%s.%s' % (value.__module__, value.__name__)
+    return value
+
+
+def _update_hash(h, value, nbytes=2**24):
+    """Update hash `h` with the contents of `value`.
+
+    Arrays, including array-likes such as ``h5py`` datasets, are read
+    `nbytes` at a time, feature managers are described by
+    ``describe_feature_manager``, and other values by their ``repr``.
+    """
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        h.update(repr((str(value.dtype), value.shape)))
+        if len(value.shape) == 0:
+            h.update(np.ascontiguousarray(value[()]))
+            return
+        plane = max(1, value.dtype.itemsize * int(np.prod(value.shape[1:])))
+        step = max(1, nbytes // plane)
+        for start in range(0, value.shape[0], step):
+            h.update(np.ascontiguousarray(value[start:start+step]))
+    elif hasattr(value, 'write_fm'):
+        h.update(describe_feature_manager(value))
+    else:
+        h.update(repr(_describe(value)))
+
+
+def cache_key(watershed, probabilities, **kwargs):
+    """Return a hash of the inputs from which a graph is built.
+
+    Parameters
+    ----------
+    watershed, probabilities : array-like
+        The superpixel and probability volumes, as given to
+        ``agglo.Rag``.
+    **kwargs : dict
+        Other arguments to ``agglo.Rag`` that affect the built graph.
+
+    Returns
+    -------
+    key : string
+        A hexadecimal SHA-1 digest.
+    """
+    h = hashlib.sha1('gala.ragio format %i' % FORMAT_VERSION)
+    _update_hash(h, watershed)
+    _update_hash(h, probabilities)
+    for name in sorted(kwargs):
+        h.update(name)
+        _update_hash(h, kwargs[name])
+    return h.hexdigest()
+
+
+def _flatten(cache, leaves):
+    """Append the arrays of a (nested list) cache to `leaves`.
+
+    Returns the structure of the cache, in which each array is
+    replaced by its position in `leaves`.
+    """
+    if isinstance(cache, list):
+        return [_flatten(c, leaves) for c in cache]
+    leaves.append(cache)
+    return len(leaves) - 1
+
+
+def _unflatten(structure, leaves):
+    """Rebuild a cache from its structure and arrays. See ``_flatten``."""
+    if isinstance(structure, list):
+        return [_unflatten(s, leaves) for s in structure]
+    return leaves[structure]
+
+
+def _write_caches(group, caches):
+    """Write a list of feature caches to an HDF5 group.
+
+    Each cache array component is stacked over all caches.
+
+    Raises
+    ------
+    ValueError
+        If the caches do not all have the same structure of numeric
+        arrays (or numbers) of fixed shape.
+    """
+    structure, stacked = None, []
+    for cache in caches:
+        leaves = []
+        s = _flatten(cache, leaves)
+        if structure is None:
+            structure = s
+            stacked = [[] for _ in leaves]
+        leaves = map(np.asarray, leaves)
+        if (s != structure or
+                any(leaf.dtype.kind not in 'biuf' or
+                    (stack and leaf.shape != stack[0].shape)
+                    for leaf, stack in zip(leaves, stacked))):
+            raise ValueError('The feature caches cannot be stored as '
+                             'numeric arrays.')
+        for leaf, stack in zip(leaves, stacked):
+            stack.append(leaf)
+    group.attrs['structure'] = json.dumps(structure)
+    for i, stack in enumerate(stacked):
+        group.create_dataset(str(i), data=np.array(stack))
+
+
+def _read_caches(group):
+    """Read the list of feature caches written by ``_write_caches``."""
+    structure = json.loads(group.attrs['structure'])
+    if structure is None:
+        return []
+    stacked = [list(group[str(i)][...]) for i in range(len(group))]
+    if structure == range(len(stacked)): # a flat list, as for ``Composite``
+        return map(list, zip(*stacked))
+    return [_unflatten(structure, leaves) for leaves in zip(*stacked)]
+
+
+def _write_ragged(group, name, arrays, dtype=np.int64):
+    """Write a list of 1D arrays as one concatenated array and offsets."""
+    lengths = [len(a) for a in arrays]
+    group.create_dataset(name + '-indptr',
+                         data=np.concatenate(([0], np.cumsum(lengths))))
+    if sum(lengths) > 0:
+        data = np.concatenate([np.asarray(a, dtype) for a in arrays])
+    else:
+        data = np.zeros(0, dtype)
+    group.create_dataset(name, data=data)
+
+
+def _read_ragged(group, name, mmap=False):
+    """Return the concatenated array and offsets of ``_write_ragged``.
+
+    If `mmap` is ``True`` and the array is stored contiguously, it is
+    memory-mapped instead of read.
+    """
+    indptr = group[name + '-indptr'][...]
+    dataset = group[name]
+    offset = dataset.id.get_offset()
+    if mmap and offset is not None:
+        data = np.asarray(np.memmap(dataset.file.filename, dataset.dtype, 'r',
+                                    offset, dataset.shape))
+    else:
+        data = dataset[...]
+    return data, indptr
+
+
+def write_rag(g, fn):
+    """Save an unmerged region adjacency graph to an HDF5 file.
+
+    Parameters
+    ----------
+    g : agglo.Rag
+        The graph. It must not have been agglomerated, even partially.
+    fn : string
+        The output filename.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    ValueError
+        If some nodes of the graph have been merged, or if its feature
+        caches are not numeric arrays of fixed shape.
+    """
+    if g.tree.number_of_edges() > 0:
+        raise ValueError('Only graphs without merges can be saved.')
+    g._load_volumes()
+    p = g.pad_thickness
+    inner = (slice(p, -p),) * g.watershed.ndim
+    # Save nodes and edges in the order in which
+    # ``Rag.build_graph_from_watershed`` adds them: the iteration order of
+    # the loaded graph, which decides between merges of equal priority,
+    # is then the same as that of a newly built graph.
+    def first_voxel(n):
+        if n == g.boundary_body:
+            return -1
+        return np.ravel_multi_index(g.node[n]['entrypoint'], g.watershed.shape)
+    nodes = sorted(g.nodes(), key=first_voxel)
+    boundaries = {}
+    for u, v in g.edges_iter():
+        b = g[u][v]['boundary']
+        boundaries[min(u, v), max(u, v)] = np.asarray(
+                                    b if g.compact else sorted(b), np.int64)
+    edges = sorted(boundaries, key=lambda e: (boundaries[e][0], e))
+    with h5py.File(fn, 'w') as f:
+        f.attrs['format'] = FORMAT_VERSION
+        f.attrs['connectivity'] = g.connectivity
+        f.attrs['compact'] = g.compact
+        f.attrs['nozeros'] = g.nozeros
+        f.attrs['feature_manager'] = describe_feature_manager(
+                                                        g.feature_manager)
+        if g.watershed.size > 0:
+            f.create_dataset('watershed', data=g.watershed[inner])
+        if g.probabilities.dtype == np.double: # else, none were given
+            f.create_dataset('probabilities', data=g.probabilities[inner])
+        if g.orientation_map.size > 0:
+            f.create_dataset('orientation_map', data=g.orientation_map[inner])
+        if np.any(g.channel_is_oriented):
+            f.create_dataset('channel_is_oriented', data=g.channel_is_oriented)
+        if 'ignored_boundary' in g.__dict__:
+            f.create_dataset('ignored_boundary',
+                             data=np.flatnonzero(g.ignored_boundary))
+        node_group = f.create_group('nodes')
+        node_group.create_dataset('ids', data=np.array(nodes, np.int64))
+        inner_nodes = [n for n in nodes if n != g.boundary_body]
+        node_group.create_dataset('sizes', data=np.array(
+                    [g.node[n]['size'] for n in inner_nodes], np.int64))
+        node_group.create_dataset('entrypoints', data=np.array(
+                    [g.node[n]['entrypoint'] for n in inner_nodes], np.int64))
+        _write_ragged(node_group, 'exclusions',
+                      [sorted(g.node[n]['exclusions']) for n in nodes])
+        _write_caches(node_group.create_group('feature-cache'),
+                      [g.node[n]['feature-cache'] for n in nodes])
+        node_group.create_dataset('frozen',
+                                  data=np.array(sorted(g.frozen_nodes), np.int64))
+        edge_group = f.create_group('edges')
+        edge_group.create_dataset('pairs',
+                                  data=np.array(edges, np.int64).reshape(-1, 2))
+        _write_ragged(edge_group, 'boundaries', [boundaries[e] for e in edges])
+        _write_caches(edge_group.create_group('feature-cache'),
+                      [g[u][v]['feature-cache'] for u, v in edges])
+        edge_group.create_dataset('frozen', data=np.array(
+                    sorted(g.frozen_edges), np.int64).reshape(-1, 2))
+
+
+def read_rag(g, fn, lowmem=False, mmap=False):
+    """Fill an empty region adjacency graph from an HDF5 file.
+
+    This sets the volumes, nodes, edges, feature caches, exclusions and
+    frozen nodes and edges of the graph. The feature manager and the
+    agglomeration state are left to the caller; see ``agglo.Rag.load``.
+
+    Parameters
+    ----------
+    g : agglo.Rag
+        A graph with no nodes, and the attributes set by ``Rag.__init__``
+        before building the graph.
+    fn : string
+        A file written by ``write_rag``.
+    lowmem : bool, optional
+        See ``agglo.Rag.__init__``.
+    mmap : bool, optional
+        Memory-map the boundary voxels of the edges, which are only
+        read from disk when used, rather than reading them in.
+
+    Returns
+    -------
+    fm_description : string
+        The description of the feature manager with which the feature
+        caches were computed. See ``describe_feature_manager``.
+    """
+    with h5py.File(fn, 'r') as f:
+        if f.attrs.get('format') != FORMAT_VERSION:
+            raise ValueError('%s is not a saved graph of format version %i.'
+                             % (fn, FORMAT_VERSION))
+        g.connectivity = int(f.attrs['connectivity'])
+        g.compact = bool(f.attrs['compact'])
+        g.nozeros = bool(f.attrs['nozeros'])
+        empty = np.array([])
+        volumes = [f[name][...] if name in f else empty for name in
+                   ['watershed', 'probabilities', 'orientation_map']]
+        channel_is_oriented = (f['channel_is_oriented'][...]
+                               if 'channel_is_oriented' in f else None)
+        g._set_volumes(volumes[0], volumes[1], lowmem, False, volumes[2],
+                       channel_is_oriented)
+        if 'ignored_boundary' in f:
+            g.ignored_boundary = np.zeros(g.watershed.shape, bool)
+            g.ignored_boundary.ravel()[f['ignored_boundary'][...]] = True
+
+        node_group = f['nodes']
+        nodes = node_group['ids'][...].tolist()
+        sizes = node_group['sizes'][...].tolist()
+        entrypoints = node_group['entrypoints'][...]
+        exclusions, excl_ptr = _read_ragged(node_group, 'exclusions')
+        caches = _read_caches(node_group['feature-cache'])
+        inner = 0
+        exclusions = np.split(exclusions, excl_ptr[1:-1])
+        for i, n in enumerate(nodes):
+            attrs = {'feature-cache': caches[i],
+                     'exclusions': (set(exclusions[i].tolist())
+                                    if len(exclusions[i]) > 0 else set())}
+            if n != g.boundary_body:
+                attrs['size'] = sizes[inner]
+                attrs['entrypoint'] = entrypoints[inner]
+                attrs['watershed_ids'] = ChainedList([n])
+                inner += 1
+            g.add_node(n, attrs)
+        g.frozen_nodes = set(node_group['frozen'][...].tolist())
+
+        edge_group = f['edges']
+        pairs = edge_group['pairs'][...].tolist()
+        boundaries, indptr = _read_ragged(edge_group, 'boundaries', mmap)
+        caches = _read_caches(edge_group['feature-cache'])
+        if g.compact:
+            boundaries = map(IndexSet.from_sorted,
+                             np.split(boundaries, indptr[1:-1]))
+        else:
+            boundaries = [set(b.tolist())
+                          for b in np.split(boundaries, indptr[1:-1])]
+        adj = g.adj # fill in the adjacency directly, as ``add_edge`` would
+        for (u, v), boundary, cache in zip(pairs, boundaries, caches):
+            adj[u][v] = adj[v][u] = {'boundary': boundary,
+                                     'feature-cache': cache}
+        g.frozen_edges = set(map(tuple, edge_group['frozen'][...].tolist()))
+        return f.attrs['feature_manager']
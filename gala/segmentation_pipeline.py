@@ -18,6 +18,7 @@ import hashlib
 
 from . import imio, agglo, morpho, classify, app_logger, \
     session_manager, pixel, features
+from .snapshot import join_writers, take_snapshot
 
 try:
     from gala import stack_np
@@ -155,6 +156,7 @@ def agglomeration(options, agglom_stack, supervoxels, prediction,
         image_stack, session_location, sp_outs, master_logger):
     
     seg_thresholds = sorted(options.segmentation_thresholds)
+    writers = []
     for threshold in seg_thresholds:
         if threshold != 0 or not options.use_neuroproof:
             master_logger.info("Starting agglomeration to threshold " + str(threshold)
@@ -166,16 +168,18 @@ def agglomeration(options, agglom_stack, supervoxels, prediction,
             if options.inclusion_removal:
                 inclusion_removal(agglom_stack, master_logger)
 
-        segmentation = agglom_stack.get_segmentation()     
+        snapshot = take_snapshot(agglom_stack, supervoxels, threshold)
 
         if options.h5_output:
-            imio.write_image_stack(segmentation,
-                session_location+"/agglom-"+str(threshold)+".lzf.h5", compression='lzf')
+            # write in the background while agglomeration continues
+            writers.append(snapshot.write_segmentation(
+                session_location+"/agglom-"+str(threshold)+".lzf.h5",
+                background=True, compression='lzf'))
           
         
         md5hex = hashlib.md5(' '.join(sys.argv)).hexdigest()
         file_base = os.path.abspath(session_location)+"/seg_data/seg-"+str(threshold) + "-" + md5hex + "-"
-        transforms = imio.compute_sp_to_body_map(supervoxels, segmentation)
+        transforms = snapshot.sp_to_body_map()
         seg_loc = file_base +"v1.h5"
         if not os.path.exists(session_location+"/seg_data"):
             os.makedirs(session_location+"/seg_data")
@@ -245,6 +249,8 @@ def agglomeration(options, agglom_stack, supervoxels, prediction,
         #                session_location + "/raveler-export/agglom-"+str(threshold)+"/annotations-synapse.json") 
         #    master_logger.info("Finished writing graph.json")
 
+    join_writers(writers)
+
 
 def inclusion_removal(agglom_stack, master_logger):
     master_logger.info("Starting inclusion removal with " + str(agglom_stack.number_of_nodes()) + " nodes")
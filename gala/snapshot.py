@@ -0,0 +1,331 @@
+import os
+import sys
+import threading
+import itertools as it
+
+import numpy as np
+import h5py
+
+from . import imio
+from . import morpho
+
+
+class Snapshot(object):
+    """The segmentation represented by a ``Rag`` at one point in time.
+
+    A snapshot stores only a map from superpixels to bodies, so it is
+    cheap to take and does not change as the graph is agglomerated
+    further. The segmented volume is computed only when requested.
+
+    Parameters
+    ----------
+    g : agglo.Rag
+        The graph whose current segmentation to record.
+    threshold : float, optional
+        The agglomeration threshold at which the snapshot was taken.
+
+    Attributes
+    ----------
+    threshold : float or None
+        The agglomeration threshold at which the snapshot was taken.
+    sp2body : array of int
+        The body of every superpixel label.
+    superpixels : array of int
+        The superpixel labels of the graph, excluding 0.
+    """
+    def __init__(self, g, threshold=None):
+        self.threshold = threshold
+        self.sp2body = g.sp2segment.map()
+        self.superpixels = g.superpixels
+        self.watershed = g.watershed
+        self.pad_thickness = g.pad_thickness
+        self.has_zero_boundaries = g.has_zero_boundaries
+        self.connectivity = g.connectivity
+
+    def sp_to_body_map(self):
+        """Return the map from superpixels to bodies as (sp, body) rows.
+
+        Returns
+        -------
+        sp_to_body : array of uint64, shape (NUM_SPS, 2)
+            The superpixel to body map, in the format of
+            ``imio.compute_sp_to_body_map``. If the superpixels are
+            separated by 0-labeled boundaries, a (0, 0) row is included.
+        """
+        sps = self.superpixels
+        if self.has_zero_boundaries:
+            sps = np.concatenate(([0], sps))
+        sp_to_body = np.column_stack((sps, self.sp2body[sps]))
+        return sp_to_body.astype(np.uint64)
+
+    def get_superpixels(self):
+        """Return the unpadded superpixel map."""
+        return morpho.juicy_center(self.watershed, self.pad_thickness)
+
+    @property
+    def shape(self):
+        """The shape of the unpadded volume."""
+        return tuple(np.subtract(self.watershed.shape, 2 * self.pad_thickness))
+
+    def get_segmentation(self):
+        """Return the unpadded segmentation recorded by the snapshot.
+
+        This matches the output of ``agglo.Rag.get_segmentation`` at
+        the time the snapshot was taken.
+        """
+        seg = np.empty(self.shape, self.sp2body.dtype)
+        self.fill_segmentation(seg)
+        return seg
+
+    def segmentation_chunk(self, chunk):
+        """Return the segmentation in one chunk of the unpadded volume.
+
+        If the superpixels are separated by 0-labeled boundaries, the
+        boundaries inside merged bodies are removed using a one-voxel
+        halo around the chunk, so the result matches the corresponding
+        part of ``get_segmentation``.
+
+        Parameters
+        ----------
+        chunk : tuple of slice
+            The extent of the chunk along each axis, with explicit
+            start and stop values.
+
+        Returns
+        -------
+        seg : array of int
+            The segmentation of the chunk.
+        """
+        p = self.pad_thickness
+        halo = 1 if p > 1 else 0 # p > 1 if the volume has zero-boundaries
+        padded = tuple(slice(c.start + p - halo, c.stop + p + halo)
+                       for c in chunk)
+        seg = self.sp2body[self.watershed[padded]]
+        if halo:
+            seg = morpho.remove_merged_boundaries(seg, self.connectivity)
+            seg = seg[(slice(1, -1),) * seg.ndim]
+        return seg
+
+    def fill_segmentation(self, out, chunk_shape=None):
+        """Write the segmentation into an array, one chunk at a time.
+
+        Parameters
+        ----------
+        out : array-like of int
+            An array (for example, an ``h5py`` dataset) with the
+            unpadded volume shape.
+        chunk_shape : tuple of int, optional
+            The shape of the chunks in which to compute and write the
+            segmentation. By default, at most 64 voxels along each
+            axis.
+
+        Returns
+        -------
+        None
+        """
+        if chunk_shape is None:
+            chunk_shape = tuple(max(1, min(64, s)) for s in self.shape)
+        starts = [range(0, s, c) for s, c in zip(self.shape, chunk_shape)]
+        for start in it.product(*starts):
+            chunk = tuple(slice(a, min(a + c, s)) for a, c, s in
+                          zip(start, chunk_shape, self.shape))
+            out[chunk] = self.segmentation_chunk(chunk)
+
+    def write_segmentation(self, fn, background=False, chunk_shape=None,
+                           **kwargs):
+        """Write the segmentation volume to disk.
+
+        HDF5 output is computed and written one chunk at a time, in the
+        smallest integer type that holds the body labels, so the whole
+        segmentation is never in memory.
+
+        Parameters
+        ----------
+        fn : string or h5py.Dataset
+            The output filename, or an HDF5 dataset of the unpadded
+            volume shape. See ``imio.write_image_stack`` for the
+            supported formats.
+        background : bool, optional
+            If ``True``, compute and write the volume in a new thread.
+        chunk_shape : tuple of int, optional
+            For HDF5 output, the shape of the chunks to write at a time,
+            and of the chunks of a newly created dataset. See
+            ``fill_segmentation``.
+        **kwargs : dict
+            Keyword arguments passed through to ``imio.write_image_stack``.
+            For HDF5 files, these are `group`, `compression` and
+            `shuffle`, as in ``imio.write_h5_stack``.
+
+        Returns
+        -------
+        thread : threading.Thread or None
+            The started thread, if `background` is ``True``. Wait for
+            it with ``join_writers``, which raises any error of the
+            write.
+        """
+        def write():
+            if isinstance(fn, h5py.Dataset):
+                self.fill_segmentation(fn, chunk_shape)
+            elif fn.endswith('.h5'):
+                self._write_h5(fn, chunk_shape, **kwargs)
+            else:
+                imio.write_image_stack(self.get_segmentation(), fn, **kwargs)
+        return _run(write, background)
+
+    def _write_h5(self, fn, chunk_shape=None, group='stack',
+                  compression=None, shuffle=None):
+        """Write the segmentation to a new dataset in an HDF5 file."""
+        if chunk_shape is None:
+            chunk_shape = tuple(max(1, min(64, s)) for s in self.shape)
+        dtype = self._label_dtype()
+        with h5py.File(os.path.expanduser(fn), 'a') as f:
+            if group in f:
+                del f[group]
+            dataset = f.create_dataset(group, self.shape, dtype,
+                                       chunks=chunk_shape,
+                                       compression=compression,
+                                       shuffle=shuffle)
+            self.fill_segmentation(dataset, chunk_shape)
+
+    def _label_dtype(self):
+        """Return the smallest integer type holding the body labels."""
+        return morpho.smallest_int_dtype(self.sp2body.max())
+
+    def write_mapped_segmentation(self, fn, background=False, **kwargs):
+        """Write the superpixel map and superpixel to body map to HDF5.
+
+        Parameters
+        ----------
+        fn : string
+            The output filename.
+        background : bool, optional
+            If ``True``, write the file in a new thread.
+        **kwargs : dict
+            Keyword arguments passed through to
+            ``imio.write_mapped_segmentation``.
+
+        Returns
+        -------
+        thread : threading.Thread or None
+            The started thread, if `background` is ``True``. Wait for
+            it with ``join_writers``, which raises any error of the
+            write.
+        """
+        def write():
+            imio.write_mapped_segmentation(self.get_superpixels(),
+                                           self.sp_to_body_map(), fn,
+                                           **kwargs)
+        return _run(write, background)
+
+
+class VolumeSnapshot(Snapshot):
+    """A snapshot of a segmentation volume that has been computed.
+
+    This offers the interface of ``Snapshot`` for graphs that can only
+    return their whole segmentation, such as ``stack_np.Stack``.
+
+    Parameters
+    ----------
+    segmentation : array of int
+        The segmentation.
+    superpixel_map : array of int, same shape as `segmentation`
+        The superpixels that were agglomerated into `segmentation`.
+    threshold : float, optional
+        The agglomeration threshold at which the snapshot was taken.
+    """
+    def __init__(self, segmentation, superpixel_map, threshold=None):
+        self.threshold = threshold
+        self.segmentation = segmentation
+        self.superpixel_map = superpixel_map
+
+    def sp_to_body_map(self):
+        """Return the map from superpixels to bodies as (sp, body) rows."""
+        sps, idxs = np.unique(self.superpixel_map, return_index=True)
+        bodies = self.segmentation.ravel()[idxs]
+        return np.column_stack((sps, bodies)).astype(np.uint64)
+
+    def get_superpixels(self):
+        """Return the superpixel map."""
+        return self.superpixel_map
+
+    @property
+    def shape(self):
+        """The shape of the volume."""
+        return self.segmentation.shape
+
+    def get_segmentation(self):
+        """Return the segmentation."""
+        return self.segmentation
+
+    def segmentation_chunk(self, chunk):
+        """Return the segmentation in one chunk of the volume."""
+        return self.segmentation[chunk]
+
+    def _label_dtype(self):
+        return morpho.smallest_int_dtype(self.segmentation.max())
+
+
+def take_snapshot(g, superpixel_map, threshold=None):
+    """Return a snapshot of the current segmentation of a graph.
+
+    Parameters
+    ----------
+    g : agglo.Rag or stack_np.Stack
+        The graph. Graphs lacking a ``snapshot`` method, such as
+        ``stack_np.Stack``, compute their segmentation right away.
+    superpixel_map : array of int
+        The superpixels of `g`, for graphs lacking ``snapshot``.
+    threshold : float, optional
+        The agglomeration threshold at which the snapshot is taken.
+
+    Returns
+    -------
+    snapshot : Snapshot or VolumeSnapshot
+        The snapshot.
+    """
+    if hasattr(g, 'snapshot'):
+        return g.snapshot(threshold)
+    return VolumeSnapshot(g.get_segmentation(), superpixel_map, threshold)
+
+
+def _run(function, background):
+    """Call `function`, or start a thread running it if `background`.
+
+    An exception raised in the thread is kept, with its traceback, in
+    the ``exc_info`` attribute of the thread.
+    """
+    if not background:
+        function()
+        return None
+    def target():
+        try:
+            function()
+        except BaseException:
+            thread.exc_info = sys.exc_info()
+    thread = threading.Thread(target=target)
+    thread.exc_info = None
+    thread.start()
+    return thread
+
+
+def join_writers(threads):
+    """Wait for the threads of background writes to finish.
+
+    Parameters
+    ----------
+    threads : list of threading.Thread or None
+        The threads returned by ``Snapshot.write_segmentation`` and
+        ``Snapshot.write_mapped_segmentation``.
+
+    Raises
+    ------
+    Exception
+        The first exception raised by any of the writes, once all of
+        them are done.
+    """
+    threads = [thread for thread in threads if thread is not None]
+    for thread in threads:
+        thread.join()
+    for thread in threads:
+        if thread.exc_info is not None:
+            raise thread.exc_info[0], thread.exc_info[1], thread.exc_info[2]
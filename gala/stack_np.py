@@ -1,12 +1,14 @@
 # built-ins
 import libNeuroProofRag as neuroproof
 import morpho
+import classify
 import json
 
 from numpy import zeros_like, array, double, zeros
 import numpy
 
 def get_prob_handle(classifier):
+    classifier = classify.flatten_classifier(classifier)
     def get_prob(features):
         prediction = classifier.predict_proba(array(features))[0,1]
         return float(prediction)
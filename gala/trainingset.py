@@ -0,0 +1,311 @@
+"""Store the learning sets of many volumes and runs in a single file.
+
+``classify.save_training_data_to_disk`` writes one learning set in one
+go, so combining the sets of several volumes means loading them all and
+saving them again. A ``TrainingSet`` file is instead appended to, one
+learning set at a time, and is never read in as a whole:
+
+- the file attribute ``'names'`` lists the arrays of every learning
+  set, by default the features, labels, weights and history returned
+  by ``agglo.Rag.learn_agglomerate``;
+- each appended set is a group of ``'volumes'``, named by its position,
+  holding those arrays and its provenance as attributes: a name, such
+  as the files the set was learned from, an info string, the time it
+  was added, and any other attribute given;
+- the arrays are stored contiguously, so that they can be
+  memory-mapped. Reading a subset of rows only reads the pages holding
+  them, and reading a range of rows of one volume copies nothing.
+"""
+
+import time
+
+import numpy as np
+import h5py
+
+from . import classify
+
+
+FORMAT_VERSION = 1
+
+
+class _Rows(object):
+    """The rows of several arrays, indexed as if they were concatenated.
+
+    Indexing with an integer, a slice, or an array of indices returns
+    the rows in a new array, reading only those rows, except for a
+    slice of contiguous rows of a single array, which returns a view.
+    """
+    def __init__(self, arrays, shape, dtype):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [len(a) for a in arrays])
+        self.shape = (self.offsets[-1],) + tuple(shape)
+        self.dtype = dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idxs):
+        if isinstance(idxs, slice):
+            start, stop, step = idxs.indices(len(self))
+            i = np.searchsorted(self.offsets, start, 'right') - 1
+            if step == 1 and 0 <= i < len(self.arrays) and \
+                                            stop <= self.offsets[i + 1]:
+                offset = self.offsets[i]
+                return self.arrays[i][start - offset:stop - offset]
+            idxs = np.arange(start, stop, step)
+        elif np.isscalar(idxs):
+            return self[np.array([idxs])][0]
+        idxs = np.asarray(idxs, np.intp)
+        idxs = np.where(idxs < 0, idxs + len(self), idxs)
+        out = np.empty((len(idxs),) + self.shape[1:], self.dtype)
+        arrays = np.searchsorted(self.offsets, idxs, 'right') - 1
+        for i in np.unique(arrays):
+            selected = arrays == i
+            out[selected] = self.arrays[i][idxs[selected] - self.offsets[i]]
+        return out
+
+
+class TrainingSet(object):
+    """A file of learning sets, appended to and read without loading it.
+
+    Parameters
+    ----------
+    fn : string
+        The HDF5 file. It is created if it does not exist.
+    mode : {'a', 'r'}, optional
+        Open the file to append to it, or read-only.
+    names : list of string, optional
+        The names of the arrays of each learning set, when creating the
+        file. By default, ``['features', 'labels', 'weights',
+        'history']``.
+
+    Examples
+    --------
+    >>> ts = TrainingSet('example-train.h5', names=['features', 'labels'])
+    >>> for name in ['volume-1', 'volume-2']:
+    ...     X, y = np.random.rand(100, 5), np.arange(100) % 2
+    ...     volume = ts.append([X, y], name=name)
+    >>> len(ts), [p['name'] for p in ts.provenance()]
+    (200, ['volume-1', 'volume-2'])
+    >>> X, y = ts.sample(50, stratified=True)
+    >>> X.shape, y.sum()
+    ((50, 5), 25)
+    >>> ts.close()
+    >>> import os; os.remove('example-train.h5') # doctest cleanup
+    """
+    def __init__(self, fn, mode='a', names=None):
+        self.file = h5py.File(fn, mode)
+        if 'format' not in self.file.attrs:
+            if names is None:
+                names = ['features', 'labels', 'weights', 'history']
+            self.file.attrs['format'] = FORMAT_VERSION
+            self.file.attrs['names'] = np.array(names, dtype=np.string_)
+            self.file.create_group('volumes')
+        elif self.file.attrs['format'] != FORMAT_VERSION:
+            raise ValueError('%s is not a training set of format version %i.'
+                             % (fn, FORMAT_VERSION))
+        self.names = [str(name) for name in self.file.attrs['names']]
+        self._arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum(self.file['volumes'][v][self.names[0]].shape[0]
+                   for v in self.volumes())
+
+    def close(self):
+        """Close the file."""
+        self._arrays = {}
+        self.file.close()
+
+    def volumes(self):
+        """Return the names of the groups of the learning sets, in order."""
+        return sorted(self.file['volumes'], key=int)
+
+    def provenance(self):
+        """Return the attributes of each learning set, and its size.
+
+        Returns
+        -------
+        attrs : list of dict
+            The ``'name'``, ``'info'``, ``'created'`` and other
+            attributes of each learning set, with its number of rows in
+            ``'size'``.
+        """
+        out = []
+        for v in self.volumes():
+            group = self.file['volumes'][v]
+            attrs = dict(group.attrs)
+            attrs['size'] = group[self.names[0]].shape[0]
+            out.append(attrs)
+        return out
+
+    def append(self, data, name='', info='N/A', **attrs):
+        """Append a learning set, learned from one volume.
+
+        Parameters
+        ----------
+        data : list of array
+            The arrays of the learning set, in the order of `names`,
+            with the same number of rows. Later columns and types must
+            match those of the learning sets already in the file.
+        name : string, optional
+            The name of the learning set, such as the volume it was
+            learned from.
+        info : string, optional
+            Any description of the learning set.
+        **attrs : dict
+            Other attributes recording the provenance of the set.
+
+        Returns
+        -------
+        volume : string
+            The name of the group holding the learning set.
+        """
+        data = map(np.asarray, data)
+        if len(data) != len(self.names):
+            raise ValueError('Expected the %i arrays %s, got %i.' %
+                             (len(self.names), self.names, len(data)))
+        if len(set(len(d) for d in data)) > 1:
+            raise ValueError('The arrays of a learning set must have the '
+                             'same number of rows.')
+        volumes = self.volumes()
+        if volumes:
+            last = self.file['volumes'][volumes[-1]]
+            for key, d in zip(self.names, data):
+                if last[key].shape[1:] != d.shape[1:]:
+                    raise ValueError('Rows of %s have shape %s, expected %s.'
+                        % (key, d.shape[1:], last[key].shape[1:]))
+            data = [d.astype(last[key].dtype, copy=False)
+                    for key, d in zip(self.names, data)]
+        volume = str(int(volumes[-1]) + 1 if volumes else 0)
+        group = self.file['volumes'].create_group(volume)
+        for key, d in zip(self.names, data):
+            group.create_dataset(key, data=d)
+        group.attrs['name'] = name
+        group.attrs['info'] = info
+        group.attrs['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        for key, value in attrs.items():
+            group.attrs[key] = value
+        self.file.flush()
+        return volume
+
+    def volume(self, volume, name):
+        """Return an array of one learning set, memory-mapped if possible.
+
+        Parameters
+        ----------
+        volume : string
+            The group of the learning set, as returned by ``volumes``.
+        name : string
+            The name of the array.
+
+        Returns
+        -------
+        array : np.memmap or array
+            The array, read-only.
+        """
+        key = (volume, name)
+        if key not in self._arrays:
+            dataset = self.file['volumes'][volume][name]
+            offset = dataset.id.get_offset()
+            if offset is None: # empty, or not stored contiguously
+                self._arrays[key] = dataset[...]
+            else:
+                self._arrays[key] = np.memmap(self.file.filename,
+                        dataset.dtype, 'r', offset, dataset.shape)
+        return self._arrays[key]
+
+    def rows(self, name):
+        """Return array `name` of all learning sets, indexed lazily.
+
+        The result supports ``len`` and indexing along its first axis,
+        as if the arrays of all learning sets had been concatenated,
+        but only reads the rows it is indexed with.
+        """
+        volumes = self.volumes()
+        if not volumes:
+            return _Rows([], (), np.double)
+        arrays = [self.volume(v, name) for v in volumes]
+        return _Rows(arrays, arrays[0].shape[1:], arrays[0].dtype)
+
+    def get_data(self, names=None):
+        """Return arrays `names` of all learning sets, read into memory.
+
+        The arrays are concatenated as by
+        ``classify.concatenate_data_elements``.
+        """
+        data = []
+        for name in (names or self.names):
+            arrays = self.rows(name).arrays
+            data.append(np.concatenate(arrays) if arrays else np.zeros(0))
+        return data
+
+    def iter_batches(self, batch_size, names=None, shuffle=False,
+                     random_state=None):
+        """Iterate over the rows of all learning sets, in batches.
+
+        Parameters
+        ----------
+        batch_size : int
+            The number of rows of each batch. The last one can be
+            smaller.
+        names : list of string, optional
+            The arrays to read. By default, all of them.
+        shuffle : bool, optional
+            Read the rows in random batches, rather than in order. Each
+            row is still read exactly once, and the rows of each batch
+            are in order.
+        random_state : int, optional
+            The seed of the shuffle.
+
+        Yields
+        ------
+        batch : list of array
+            The rows of each array. Batches of consecutive rows within
+            one learning set are read-only views of the file.
+        """
+        rows = [self.rows(name) for name in (names or self.names)]
+        n = len(self)
+        if shuffle:
+            order = np.random.RandomState(random_state).permutation(n)
+        for start in range(0, n, batch_size):
+            if shuffle:
+                idxs = np.sort(order[start:start + batch_size])
+            else:
+                idxs = slice(start, min(start + batch_size, n))
+            yield [r[idxs] for r in rows]
+
+    def sample(self, num_samples=None, label_column=0, stratified=False):
+        """Return a random sample of the features and labels.
+
+        Only the sampled feature vectors are read from disk.
+
+        Parameters
+        ----------
+        num_samples : int, optional
+            The number of rows to sample. By default, all of them.
+        label_column : int, optional
+            The column of the labels to return, and to stratify by, if
+            they have several.
+        stratified : bool, optional
+            Sample each label in proportion to its frequency.
+
+        Returns
+        -------
+        features, labels : array
+            The sampled rows. See ``classify.sample_training_data``.
+        """
+        features, labels = self.names[:2]
+        labels = self.rows(labels)[:len(self)]
+        if labels.ndim > 1:
+            labels = labels[:, label_column]
+        if num_samples is None or num_samples >= len(labels):
+            return self.get_data([features])[0], labels
+        return classify.sample_training_data(self.rows(features), labels,
+                                             num_samples, stratified)
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+class UnionFind(object):
+    """Disjoint sets of non-negative integer labels, stored in an array.
+
+    Each set is identified by its root label. Unlike a textbook
+    union-find, a union can name the root of the merged set, so that
+    it matches the id of a newly created node, as in ``agglo.Rag``.
+    Lookups use path compression.
+
+    Parameters
+    ----------
+    n : int, optional
+        Initialize singleton sets for labels ``0`` to ``n - 1``. The
+        structure grows as needed when larger labels are used.
+
+    Examples
+    --------
+    >>> uf = UnionFind(6)
+    >>> uf.union(1, 2, 4)
+    4
+    >>> uf.union(3, 4, 5)
+    5
+    >>> uf[2]
+    5
+    >>> uf[np.array([[0, 1], [2, 3]])]
+    array([[0, 5],
+           [5, 5]])
+    >>> uf.map()
+    array([0, 5, 5, 5, 5, 5])
+    """
+    def __init__(self, n=0):
+        self.parent = np.arange(n)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _grow(self, n):
+        """Ensure that labels up to `n - 1` are present."""
+        m = len(self.parent)
+        if n > m:
+            self.parent = np.concatenate((self.parent,
+                                          np.arange(m, max(n, 2 * m))))
+
+    def find(self, x):
+        """Return the root of the set containing label `x`."""
+        parent = self.parent
+        if x >= len(parent):
+            return x
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def __getitem__(self, xs):
+        """Return the roots of one label or of an array of labels."""
+        if np.isscalar(xs):
+            return self.find(xs)
+        xs = np.asarray(xs)
+        if xs.size == 0:
+            return xs.astype(self.parent.dtype)
+        self._grow(xs.max() + 1)
+        if xs.size >= len(self.parent):
+            self._compress()
+            return self.parent[xs]
+        parent = self.parent
+        roots = parent[xs]
+        while True:
+            grandparents = parent[roots]
+            if np.array_equal(grandparents, roots):
+                break
+            parent[roots] = parent[grandparents]  # path halving
+            roots = grandparents
+        parent[xs] = roots
+        return roots
+
+    def union(self, u, v, root=None):
+        """Merge the sets containing `u` and `v`.
+
+        Parameters
+        ----------
+        u, v : int
+            Labels in the sets being merged.
+        root : int, optional
+            The root of the merged set. It must be a label that is not
+            in any other set. By default, the root of `v`'s set is used.
+
+        Returns
+        -------
+        root : int
+            The root of the merged set.
+        """
+        ru, rv = self.find(u), self.find(v)
+        if root is None:
+            root = rv
+        self._grow(max(ru, rv, root) + 1)
+        self.parent[[ru, rv, root]] = root
+        return root
+
+    def reset(self, labels):
+        """Make each of `labels` a singleton set again.
+
+        The labels must be leaves, that is, not the roots of sets
+        with other elements.
+        """
+        labels = np.asarray(labels, dtype=self.parent.dtype)
+        self._grow(labels.max() + 1 if len(labels) > 0 else 0)
+        self.parent[labels] = labels
+
+    def map(self):
+        """Return an array of the root of every label.
+
+        This fully compresses the structure, in O(n log n) time at
+        worst.
+        """
+        self._compress()
+        return self.parent.copy()
+
+    def _compress(self):
+        """Point every label directly at its root, by pointer jumping."""
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self.parent = parent
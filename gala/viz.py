@@ -3,6 +3,7 @@ from math import ceil
 import numpy as np
 import scipy
 import evaluate
+from mergequeue import MergeQueue
 from skimage import color
 import matplotlib
 plt = matplotlib.pyplot
@@ -187,6 +188,11 @@ def plot_vi(g, history, gt, fig=None):
     Returns
     -------
     None
+
+    See Also
+    --------
+    ``plot_vi_replay``, which tracks the VI through the merges rather
+    than evaluating each segmentation from scratch.
     """
     v = []
     n = []
@@ -202,6 +208,54 @@ def plot_vi(g, history, gt, fig=None):
     plt.ylabel('vi', figure = fig)
 
 
+def plot_vi_replay(g, history, gt, fig=None):
+    """Plot the VI of a graph through a sequence of merges.
+
+    Unlike ``plot_vi``, this replays the merges on a copy of `g`, which
+    tracks the VI as they are made, so `g` must be the graph *before*
+    any of the merges in `history`, such as a copy taken before
+    ``Rag.agglomerate``.
+
+    Parameters
+    ----------
+    g : agglo.Rag object
+        The region adjacency graph, before any of the merges in
+        `history`. It is not modified.
+
+    history : list of tuples
+        The merge history of the RAG.
+
+    gt : np.ndarray
+        The ground truth corresponding to the RAG.
+
+    fig : plt.Figure, optional
+        Use this figure for plotting. If not provided, a new figure is created.
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    The VI plotted is the sum of the components of ``Rag.split_vi``
+    after each merge.
+    """
+    g = g.copy()
+    g.merge_queue = MergeQueue() # no merge priorities are needed
+    g.set_ground_truth(gt)
+    v = []
+    n = []
+    for n1, n2 in history:
+        g.merge_nodes(n1, n2)
+        v.append(g.split_vi().sum())
+        n.append(g.number_of_nodes() - 1)
+    if fig is None:
+        fig = plt.figure()
+    plt.plot(n, v, figure = fig)
+    plt.xlabel('Number of segments', figure = fig)
+    plt.ylabel('vi', figure = fig)
+
+
 def plot_vi_breakdown_panel(px, h, title, xlab, ylab, hlines, scatter_size,
                             **kwargs):
     """Plot a single panel (over or undersegmentation) of VI breakdown plot.
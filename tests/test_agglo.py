@@ -1,12 +1,15 @@
 import os
+import shutil
+import tempfile
 
 D = os.path.dirname(os.path.abspath(__file__)) + '/'
 
 import numpy as np
 from numpy.testing import assert_equal, assert_allclose
 
-from gala import agglo
+from gala import agglo, classify, features, imio
 from gala import evaluate as ev
+from gala.snapshot import join_writers, take_snapshot
 
 
 test_idxs = range(4)
@@ -32,6 +35,80 @@ def test_empty_rag():
     assert_equal(g.nodes(), [])
     assert_equal(g.copy().nodes(), [])
 
+def boundaries(g):
+    return dict(((u, v), sorted(g[u][v]['boundary'])) for u, v in
+                                                    map(sorted, g.real_edges()))
+
+def test_shared_boundaries():
+    ws = np.array([[1, 1, 0, 2, 2],
+                   [1, 0, 3, 0, 2],
+                   [0, 3, 3, 3, 0]], np.uint32)
+    g = agglo.Rag(ws)
+    # voxel 22 is the padded index of ws[0, 2], adjacent to all 3 labels
+    assert_equal(boundaries(g), {(1, 2): [22], (1, 3): [22, 30, 38],
+                                 (2, 3): [22, 32, 42]})
+    assert_equal([g.node[n]['size'] for n in [1, 2, 3]], [3, 3, 4])
+    assert_equal(g.node[3]['entrypoint'], [3, 4])
+    g = agglo.Rag(ws, allow_shared_boundaries=False)
+    assert_equal(boundaries(g), {(1, 3): [30, 38], (2, 3): [32, 42]})
+    assert_equal(np.flatnonzero(g.ignored_boundary), [22])
+
+def test_nozeros_graph():
+    ws = np.array([[1, 1, 2], [3, 2, 2], [3, 3, 2]], np.uint32)
+    g = agglo.Rag(ws, nozeros=True)
+    assert_equal(boundaries(g), {(1, 2): [7, 8, 12], (1, 3): [6, 11],
+                                 (2, 3): [11, 12, 17, 18]})
+
+def test_compact_rag():
+    i = 1
+    g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+        normalize_probabilities=True)
+    h = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+        normalize_probabilities=True, compact=True)
+    assert_equal(boundaries(h), boundaries(g))
+    g.agglomerate(0.51)
+    h.agglomerate(0.51)
+    assert_equal(h.get_segmentation(), g.get_segmentation())
+    assert_equal(boundaries(h), boundaries(g))
+
+def test_batched_classifier_priority():
+    crop = (slice(0, 10), slice(0, 60), slice(0, 60))
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[crop]
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[crop]
+    fc = features.base.Composite(children=[features.moments.Manager(),
+                                           features.graph.Manager()])
+    g = agglo.Rag(ws, p, feature_manager=fc)
+    X = np.array([fc(g, u, v) for u, v in g.real_edges()])
+    y = np.random.RandomState(0).randint(2, size=len(X))
+    rf = classify.DefaultRandomForest(n_estimators=10, random_state=0)
+    policy = agglo.classifier_probability(fc, rf.fit(X, y))
+    histories = []
+    for mpf in [lambda g, n1, n2: policy(g, n1, n2), policy]:
+        g = agglo.Rag(ws, p, mpf, feature_manager=fc)
+        histories.append(g.agglomerate(np.inf, save_history=True)[:2])
+    assert len(histories[0][0]) > 10
+    assert_equal(histories[1], histories[0])
+
+def test_flat_forest():
+    rs = np.random.RandomState(0)
+    X = rs.randn(300, 8)
+    y = (X[:, 0] + X[:, 1] * X[:, 2] > 0).astype(int)
+    Xt = rs.randn(50, 8)
+    Xt[::5, 3] = np.nan # NaN features only reach AdaBoost
+    rf = classify.DefaultRandomForest(n_estimators=10, random_state=0)
+    ab = classify.AdaBoost().fit(X, 2 * y - 1, depth=3, T=10)
+    for cl, fit in [(rf.fit(X, y), lambda: rf.fit(X[:100], y[:100])),
+                    (ab, lambda: ab.fit(X[:100], 2 * y[:100] - 1, depth=2))]:
+        flat = classify.flatten_classifier(cl)
+        assert isinstance(flat, classify.FlatForest)
+        Xc = Xt if cl is ab else np.nan_to_num(Xt)
+        assert_allclose(flat.predict_proba(Xc), cl.predict_proba(Xc))
+        assert_allclose(flat.predict_proba(Xc[0]), cl.predict_proba(Xc[:1]))
+        fit() # refitting flattens the new trees
+        assert_allclose(flat.predict_proba(Xc), cl.predict_proba(Xc))
+    unfit = classify.DefaultRandomForest()
+    assert classify.flatten_classifier(unfit) is unfit
+
 def test_agglomeration():
     i = 1
     g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean, 
@@ -57,6 +134,377 @@ def test_no_dam_agglomeration():
     assert_allclose(ev.vi(g.get_segmentation(), results[i]), 0.0,
                     err_msg='No dam agglomeration failed.')
 
+def test_split_vi_tracking():
+    crop = (slice(0, 10), slice(0, 60), slice(0, 60))
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[crop]
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[crop]
+    gt = imio.read_h5_stack(D + 'example-data/test-gt.lzf.h5')[crop]
+    g = agglo.Rag(ws, p, gt_vol=gt)
+    assert_allclose(g.split_vi(), ev.split_vi(g.rig.tocsr()))
+    for i in range(g.number_of_nodes() - 2):
+        _, evaluation = g.agglomerate_count(1, save_history=True)
+        assert_allclose(evaluation[0][1], ev.split_vi(g.rig.tocsr()), atol=1e-10)
+
+def test_learn_flat():
+    crop = (slice(0, 10), slice(0, 60), slice(0, 60))
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[crop]
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[crop]
+    gt = imio.read_h5_stack(D + 'example-data/test-gt.lzf.h5')[crop]
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    g = agglo.Rag(ws, p, feature_manager=fm)
+    gts = [gt, gt[:, ::-1].copy()]
+    ctables = [agglo.contingency_table(g.get_segmentation(), t) for t in gts]
+    expected = map(np.array, zip(*[g.learn_edge(e, ctables, None, fm)
+                                   for e in g.real_edges()]))
+    assert_equal(g.learn_flat(gts, fm), expected)
+
+def test_learn_agglomerate_volumes():
+    ws, p, gt = [imio.read_h5_stack(D + 'example-data/test-%s.lzf.h5' % n)
+                 for n in ['ws', 'p1', 'gt']]
+    volumes = [(ws[z:z+5, :60, :60], p[z:z+5, :60, :60], gt[z:z+5, :60, :60])
+               for z in [0, 5, 10]]
+    fm = features.moments.Manager()
+    kwargs = dict(priority_mode='mean', random_state=0)
+    expected = agglo.Rag(*volumes[0][:2], feature_manager=fm
+                         ).learn_agglomerate(volumes[0][2], fm, **kwargs)
+    data, alldata, times = agglo.learn_agglomerate_volumes(volumes[:1], fm,
+                                                           **kwargs)
+    assert_equal([data, alldata], expected)
+    serial = agglo.learn_agglomerate_volumes(volumes, fm, **kwargs)
+    parallel = agglo.learn_agglomerate_volumes(volumes, fm, 2, **kwargs)
+    assert_equal(parallel[:2], serial[:2])
+    assert_equal(map(len, parallel[2]), [3, 3])
+    assert len(serial[0][0]) > len(data[0])
+    # random priorities depend only on the seed, not on the processes
+    kwargs = dict(priority_mode='random', random_state=0, min_num_epochs=3,
+                  max_num_epochs=3)
+    np.random.seed(0)
+    serial = agglo.learn_agglomerate_volumes(volumes, fm, **kwargs)
+    np.random.seed(0)
+    parallel = agglo.learn_agglomerate_volumes(volumes, fm, 2, **kwargs)
+    assert_equal(map(len, parallel[2]), [3, 3, 3])
+    assert_equal(parallel[:2], serial[:2])
+
+def test_warm_start_trainer():
+    ws, p, gt = [imio.read_h5_stack(D + 'example-data/test-%s.lzf.h5' % n)
+                 [:10, :60, :60] for n in ['ws', 'p1', 'gt']]
+    fm = features.moments.Manager()
+    trainer = classify.EpochTrainer(warm_start=True, new_trees=5,
+                                    random_state=0)
+    data, alldata = agglo.Rag(ws, p, feature_manager=fm).learn_agglomerate(
+        gt, fm, min_num_epochs=4, max_num_epochs=4, trainer=trainer)
+    assert_equal([fit['warm_start'] for fit in trainer.history],
+                 [False, True, True])
+    assert_equal([fit['trees'] for fit in trainer.history], [100, 105, 110])
+    assert_equal([fit['samples'] for fit in trainer.history[1:]],
+                 [len(epoch[0]) for epoch in alldata[1:3]])
+    assert_equal(trainer.history[0]['samples'], len(alldata[0][0]))
+
+def test_lazy_ucm():
+    i = 3
+    g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+        normalize_probabilities=True)
+    h = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+        normalize_probabilities=True, eager_ucm=True)
+    assert g.ucm is None
+    g.agglomerate(0.75)
+    h.agglomerate(0.75)
+    ucm = g.get_ucm()
+    assert_equal(ucm, h.get_ucm())
+    assert_equal(g.get_ucm(out=np.zeros(ucm.shape), block_size=2), ucm)
+    bmap = g.build_boundary_map()
+    assert_equal(g.build_boundary_map(out=np.zeros(ucm.shape)), bmap)
+
+def test_copy_rag():
+    i = 1
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    for compact in [False, True]:
+        g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+                      feature_manager=fm, gt_vol=results[i], compact=compact)
+        nodes, edges, bounds = sorted(g.nodes()), sorted(g.edges()), \
+                               boundaries(g)
+        node_features = [fm(g, n) for n in nodes]
+        h = g.copy()
+        assert h.watershed is g.watershed
+        h.agglomerate(0.5)
+        assert_equal(sorted(g.nodes()), nodes)
+        assert_equal(sorted(g.edges()), edges)
+        assert_equal(boundaries(g), bounds)
+        assert_equal([fm(g, n) for n in nodes], node_features)
+        g.agglomerate(0.25) # copy a partly agglomerated graph
+        k = g.copy()
+        g.agglomerate(0.5)
+        k.agglomerate(0.5)
+        for other in [h, k]:
+            assert_equal(other.get_segmentation(), g.get_segmentation())
+            assert_equal(other.get_ucm(), g.get_ucm())
+            assert_allclose(other.split_vi(), g.split_vi())
+
+def test_segment_map():
+    i = 3
+    g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+        normalize_probabilities=True)
+    g.agglomerate(0.75)
+    m = g.sp2segment.map()
+    for n in g.nodes():
+        if n == g.boundary_body:
+            continue
+        assert_equal(m[g.node[n]['watershed_ids']], n)
+        assert_equal(g.sp2segment[g.node[n]['watershed_ids'][0]], n)
+
+def test_agglomerate_to_thresholds():
+    i = 1
+    thresholds = [0.75, 0.25, 0.5]
+    g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+        normalize_probabilities=True)
+    snapshots = g.agglomerate_to_thresholds(thresholds)
+    g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+        normalize_probabilities=True)
+    for t, snapshot in zip(sorted(thresholds), snapshots):
+        g.agglomerate(t)
+        seg = g.get_segmentation()
+        assert_equal(snapshot.threshold, t)
+        assert_equal(snapshot.get_segmentation(), seg)
+        sp_to_body = snapshot.sp_to_body_map().astype(int)
+        assert_equal(sp_to_body[0], [0, 0])
+        sp2body = np.zeros(sp_to_body[:, 0].max() + 1, int)
+        sp2body[sp_to_body[:, 0]] = sp_to_body[:, 1]
+        sps = wss[i] != 0
+        assert_equal(sp2body[wss[i]][sps], seg[sps])
+
+def test_background_write_error():
+    g = agglo.Rag(wss[1], probs[1])
+    snapshot = g.snapshot()
+    out = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(out, 'seg.h5')
+        writers = [snapshot.write_segmentation(fn, background=True),
+                   snapshot.write_segmentation(os.path.join(out, 'missing',
+                                               'seg.h5'), background=True)]
+        try:
+            join_writers(writers)
+        except IOError:
+            pass
+        else:
+            raise AssertionError('failed write not raised')
+        assert_equal(imio.read_h5_stack(fn), snapshot.get_segmentation())
+    finally:
+        shutil.rmtree(out)
+
+class _VolumeStack(object):
+    """A graph lacking `snapshot`, like the NeuroProof `stack_np.Stack`."""
+    def __init__(self, ws, p):
+        self.g = agglo.Rag(ws, p)
+
+    def agglomerate(self, threshold):
+        self.g.agglomerate(threshold)
+
+    def number_of_nodes(self):
+        return self.g.number_of_nodes()
+
+    def get_segmentation(self):
+        return self.g.get_segmentation()
+
+    def write_plaza_json(self, fn, synapse_file, offset):
+        open(fn, 'w').close()
+
+
+def test_pipeline_volume_stack():
+    import logging
+    from argparse import Namespace
+    from gala import segmentation_pipeline
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[:4, :40, :40]
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[:4, :40, :40]
+    stack = _VolumeStack(ws, p)
+    out = tempfile.mkdtemp()
+    try:
+        image = os.path.join(out, 'image-0001.png')
+        open(image, 'w').close()
+        options = Namespace(segmentation_thresholds=[0.5], use_neuroproof=True,
+                            inclusion_removal=False, h5_output=True,
+                            synapse_file=None, border_size=0,
+                            image_stack=image)
+        segmentation_pipeline.agglomeration(options, stack, ws, p, None, out,
+                                            None,
+                                            logging.getLogger(__name__))
+        seg = stack.get_segmentation()
+        assert_equal(imio.read_h5_stack(os.path.join(out,
+                                                     'agglom-0.5.lzf.h5')),
+                     seg)
+        sp2body = take_snapshot(stack, ws).sp_to_body_map()
+        assert_equal(sp2body[np.searchsorted(sp2body[:, 0], ws), 1], seg)
+    finally:
+        shutil.rmtree(out)
+
+def test_write_segmentation():
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[:10, :60, :60]
+    ws[(ws % 3) == 0] = 0 # introduce boundaries between superpixels
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[:10, :60, :60]
+    g = agglo.Rag(ws, p)
+    g.agglomerate(0.5)
+    seg = g.get_segmentation()
+    out = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(out, 'seg.h5')
+        g.write_segmentation(fn, chunk_shape=(3, 25, 40))
+        assert_equal(imio.read_h5_stack(fn), seg)
+        assert imio.read_h5_stack(fn).dtype.itemsize < seg.dtype.itemsize
+    finally:
+        shutil.rmtree(out)
+
+def test_slab_rag():
+    crop = (slice(0, 10), slice(0, 60), slice(0, 60))
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[crop]
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[crop]
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    for ws, p, slab_size in [(wss[1], probs[1], 2), (ws, p, 3)]:
+        g = agglo.Rag(ws, p, feature_manager=fm)
+        h = agglo.Rag(ws, p, feature_manager=fm, slab_size=slab_size)
+        assert '_lazy_volumes' in h.__dict__
+        assert_equal(sorted(h.nodes()), sorted(g.nodes()))
+        assert_equal(boundaries(h), boundaries(g))
+        for n in g.nodes():
+            if n == g.boundary_body:
+                continue
+            assert_equal(h.node[n]['size'], g.node[n]['size'])
+            assert_equal(h.node[n]['entrypoint'], g.node[n]['entrypoint'])
+        for u, v in g.real_edges():
+            for c1, c2 in zip(h[u][v]['feature-cache'],
+                              g[u][v]['feature-cache']):
+                assert_allclose(c1, c2)
+        h.agglomerate(0.5)
+        g.agglomerate(0.5)
+        assert_equal(h.get_segmentation(), g.get_segmentation())
+
+def test_slab_rag_ground_truth():
+    gt = results[1].astype(int)
+    g = agglo.Rag(wss[1], probs[1], gt_vol=gt)
+    h = agglo.Rag(wss[1], probs[1], gt_vol=gt, slab_size=2)
+    assert '_lazy_volumes' in h.__dict__ # volumes not read in
+    assert_equal(h.rig.tocsr().toarray(), g.rig.tocsr().toarray())
+    h.agglomerate(0.5)
+    g.agglomerate(0.5)
+    assert_allclose(h.split_vi(), g.split_vi())
+
+def test_slab_rag_unsupported():
+    ws, p = wss[1], probs[1]
+    try:
+        agglo.Rag(ws, p, slab_size=2, orientation_map=np.zeros(p.shape[-1]))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('orientation_map accepted with slab_size')
+    try:
+        agglo.Rag(ws, p, slab_size=2,
+                  feature_manager=features.contact.Manager())
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('inexact feature manager accepted with slab_size')
+    exact = features.base.Composite(children=[features.moments.Manager(),
+                                              features.histogram.Manager()])
+    assert agglo._sums_voxel_caches(exact)
+    exact.children.append(features.contact.Manager())
+    assert not agglo._sums_voxel_caches(exact)
+
+def _caches(g):
+    caches = [g.node[n]['feature-cache'] for n in sorted(g.nodes())]
+    caches += [g[u][v]['feature-cache'] for u, v in sorted(g.edges())]
+    return caches
+
+def test_parallel_rag():
+    crop = (slice(0, 10), slice(0, 60), slice(0, 60))
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[crop]
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[crop]
+    summed = features.base.Composite(children=[features.moments.Manager(),
+                                               features.histogram.Manager()])
+    other = features.base.Composite(children=[features.moments.Manager(),
+                                              features.contact.Manager()])
+    for fm in [summed, other]:
+        g = agglo.Rag(ws, p, feature_manager=fm)
+        h = agglo.Rag(ws, p, feature_manager=fm, nprocessors=2)
+        assert_equal(h.nodes(), g.nodes())
+        assert_equal(h.edges(), g.edges())
+        assert_equal(boundaries(h), boundaries(g))
+        if fm is summed: # slab sums differ by rounding
+            assert '_lazy_volumes' in h.__dict__
+            for c1, c2 in zip(_caches(h), _caches(g)):
+                for a, b in zip(c1, c2):
+                    assert_allclose(a, b, rtol=1e-12)
+        else: # built in a single process
+            assert '_lazy_volumes' not in h.__dict__
+            assert_equal(_caches(h), _caches(g))
+        h.agglomerate(0.5)
+        g.agglomerate(0.5)
+        assert_equal(h.get_segmentation(), g.get_segmentation())
+
+def test_save_load_rag():
+    crop = (slice(0, 10), slice(0, 60), slice(0, 60))
+    ws = imio.read_h5_stack(D + 'example-data/test-ws.lzf.h5')[crop]
+    ws[(ws % 3) == 0] = 0 # introduce boundaries between superpixels
+    p = imio.read_h5_stack(D + 'example-data/test-p1.lzf.h5')[crop]
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    out = tempfile.mkdtemp()
+    try:
+        for compact, mmap in [(False, False), (True, True)]:
+            fn = os.path.join(out, 'rag.h5')
+            g = agglo.Rag(ws, p, feature_manager=fm, compact=compact)
+            g.save(fn)
+            h = agglo.Rag.load(fn, mmap=mmap)
+            assert_equal(h.nodes(), g.nodes())
+            assert_equal(h.edges(), g.edges())
+            assert_equal(boundaries(h), boundaries(g))
+            assert_equal(h.watershed, g.watershed)
+            assert_equal(h.probabilities, g.probabilities)
+            for u, v in g.edges():
+                for c1, c2 in zip(h[u][v]['feature-cache'],
+                                  g[u][v]['feature-cache']):
+                    assert_equal(c1, c2)
+            assert_equal(h.feature_manager.write_fm({}), fm.write_fm({}))
+            h.agglomerate(0.5)
+            g.agglomerate(0.5)
+            assert_equal(h.get_segmentation(), g.get_segmentation())
+            assert_equal(h.get_ucm(), g.get_ucm())
+        cache = os.path.join(out, 'cache')
+        g = agglo.cached_rag(cache, ws, p, feature_manager=fm)
+        assert_equal(len(os.listdir(cache)), 1)
+        h = agglo.cached_rag(cache, ws, p, feature_manager=fm)
+        assert h.feature_manager is fm
+        agglo.cached_rag(cache, ws, p, feature_manager=fm, connectivity=2)
+        assert_equal(len(os.listdir(cache)), 2)
+        h.agglomerate(0.5)
+        g.agglomerate(0.5)
+        assert_equal(h.get_segmentation(), g.get_segmentation())
+    finally:
+        shutil.rmtree(out)
+
+class _SetCaches(features.base.Null):
+    """A feature manager whose caches are not numeric arrays."""
+    def create_node_cache(self, g, n):
+        return set([n])
+
+def test_cached_rag_unstorable():
+    ws, p = wss[1], probs[1]
+    out = tempfile.mkdtemp()
+    try:
+        g = agglo.Rag(ws, p, feature_manager=_SetCaches())
+        try:
+            g.save(os.path.join(out, 'rag.h5'))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('non-numeric caches saved')
+        cache = os.path.join(out, 'cache')
+        g = agglo.cached_rag(cache, ws, p, feature_manager=_SetCaches())
+        assert_equal(os.listdir(cache), [])
+        assert_equal(g.node[1]['feature-cache'], set([1]))
+    finally:
+        shutil.rmtree(out)
+
 if __name__ == '__main__':
     from numpy import testing
     testing.run_module_suite()
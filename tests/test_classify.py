@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from gala import classify
+from gala.adaboost import AdaBoost
+from gala.decision_tree import Node
+from gala.decision_stump import DecisionStump
+
+
+def _learning_sets():
+    rs = np.random.RandomState(0)
+    features = rs.randint(4, size=(60, 3)).astype(np.double)
+    data = [features, rs.randint(2, size=(60, 3)), rs.rand(60, 2),
+            np.arange(120).reshape((60, 2))]
+    return [[d[:25] for d in data], [d[25:] for d in data]]
+
+
+def test_unique_training_data():
+    sets = _learning_sets()
+    expected = classify.unique_learning_data_elements(sets)
+    store = classify.UniqueTrainingData()
+    assert_equal(store.add([]), 0)
+    for data in sets:
+        store.add(data)
+    data = store.get_data()
+    assert_equal(len(store), len(expected[0]))
+    # the same rows, in the order they were first added
+    idxs = np.argsort(expected[3][:, 0])
+    for d, e in zip(data, expected):
+        assert_equal(d, e[idxs])
+    assert_equal(store.add(sets[0]), 0)
+
+
+def test_unique_training_data_failed_add():
+    sets = _learning_sets()
+    store = classify.UniqueTrainingData()
+    store.add(sets[0])
+    size = len(store)
+    bad = list(sets[1])
+    bad[1] = bad[1][:1] # too few labels for the features
+    try:
+        store.add(bad)
+    except (ValueError, IndexError):
+        pass
+    else:
+        raise AssertionError('mismatched learning set added')
+    assert_equal(len(store), size)
+    expected = classify.UniqueTrainingData()
+    for data in sets[:2]:
+        expected.add(data)
+    assert_equal(store.add(sets[1]), len(expected) - size)
+    assert_equal(store.get_data(), expected.get_data())
+
+
+def test_unique_training_data_file():
+    sets = _learning_sets()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'train.h5')
+        first = classify.unique_learning_data_elements(sets[0])
+        classify.save_training_data_to_disk(first, fn)
+        store = classify.UniqueTrainingData(fn, chunk_size=8)
+        store.add(sets[1])
+        expected = classify.UniqueTrainingData()
+        for data in [first, sets[1]]:
+            expected.add(data)
+        assert_equal(store.get_data(), expected.get_data())
+        store.close()
+        assert_equal(classify.load_training_data_from_disk(fn),
+                     expected.get_data())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _reference_tree(X, Y, w, depth):
+    # grow a tree with DecisionStump.fit on copies of each node's samples
+    node = Node()
+    yw = Y*w
+    if len(X) < 2 or len(np.unique(Y)) < 2 or depth == 0:
+        node.stump = 1.0 if abs(sum(yw[yw>=0])) > abs(sum(yw[yw<0])) else -1.0
+        return node
+    node.stump = DecisionStump().fit(X, Y, w)
+    side = node.stump.predict(X) >= 0
+    node.left = _reference_tree(X[side], Y[side], w[side], depth - 1)
+    node.right = _reference_tree(X[~side], Y[~side], w[~side], depth - 1)
+    return node
+
+
+def _same_tree(a, b):
+    if not isinstance(a.stump, DecisionStump):
+        return a.stump == b.stump
+    return (a.stump.feature_index == b.stump.feature_index and
+            a.stump.stump.threshold == b.stump.stump.threshold and
+            a.stump.stump.s == b.stump.stump.s and
+            _same_tree(a.left, b.left) and _same_tree(a.right, b.right))
+
+
+def test_presorted_adaboost():
+    rs = np.random.RandomState(0)
+    X = rs.randn(200, 5)
+    Y = np.where(X[:, 0] + X[:, 1] * X[:, 2] + rs.randn(200) > 0, 1, -1)
+    ab = AdaBoost().fit(X, Y, depth=3, T=10)
+    w = ab.weights_asymmetric * np.ones(200) / 200.0
+    tree = ab.weak_classifier_ensemble[0]
+    assert _same_tree(tree.head, _reference_tree(X, Y, w, 3))
+    reference = 0
+    for alpha, tree in zip(ab.alpha, ab.weak_classifier_ensemble):
+        assert_equal(tree.predict(X), tree._predict_node(X, tree.head))
+        reference = reference + alpha * tree._predict_node(X, tree.head)
+    assert_equal(ab.predict_score(X), reference)
+
+
+def test_flat_classifier_file():
+    rs = np.random.RandomState(0)
+    X = rs.rand(300, 6)
+    y = (X[:, 0] + rs.rand(300) > 1).astype(int)
+    X_new = rs.rand(50, 6)
+    rf = classify.DefaultRandomForest(n_estimators=10, random_state=0)
+    rf.fit(X, y)
+    rf.feature_description = '{"neuroproof_features": null}'
+    ab = AdaBoost().fit(X, 2 * y - 1, depth=2, T=5)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for cl in [rf, ab]:
+            fn = os.path.join(tmpdir, 'flat.classifier.h5')
+            classify.save_classifier(cl, fn, flat=True)
+            flat = classify.load_classifier(fn)
+            assert isinstance(flat, classify.FlatForest)
+            assert isinstance(flat.values.base, np.memmap)
+            assert not flat.values.flags.writeable
+            assert_equal(flat.predict_proba(X_new), cl.predict_proba(X_new))
+        assert not hasattr(flat, 'feature_description')
+        classify.save_classifier(rf, fn, flat=True)
+        assert_equal(classify.load_classifier(fn).feature_description,
+                     rf.feature_description)
+        for compress in [3, 0]:
+            fn = os.path.join(tmpdir, 'rf-%i.classifier.joblib' % compress)
+            classify.save_classifier(rf, fn, compress=compress)
+            assert_equal(classify.load_classifier(fn).predict_proba(X_new),
+                         rf.predict_proba(X_new))
+    finally:
+        shutil.rmtree(tmpdir)
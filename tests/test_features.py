@@ -103,6 +103,30 @@ def test_2channel_composite_feature():
     run_matched(f, os.path.join(rundir,
                     'toy-data/test-04-composite-2channel-12-13.pck'), 2)
 
+def test_bulk_feature_caches():
+    for p in [probs1, probs2]:
+        g = agglo.Rag(wss1, p)
+        g.clear()
+        g.build_graph_from_watershed() # keeps the node extents
+        g.set_feature_manager(f4)
+        for n in g.nodes():
+            assert_equal(g.node[n]['feature-cache'],
+                         f4.create_node_cache(g, n))
+        for n1, n2 in g.edges():
+            assert_equal(g[n1][n2]['feature-cache'],
+                         f4.create_edge_cache(g, n1, n2))
+
+def test_bulk_features():
+    fs = [f4, features.base.Composite(children=[
+              features.moments.Manager(normalize=True),
+              features.histogram.Manager(5)])]
+    for p in [probs1, probs2]:
+        for f in fs:
+            g = agglo.Rag(wss1, p, feature_manager=f)
+            edges = g.real_edges()
+            assert_equal(f.compute_all_features(g, edges),
+                         [f(g, n1, n2) for n1, n2 in edges])
+
 
 if __name__ == '__main__':
     from numpy import testing
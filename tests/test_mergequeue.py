@@ -0,0 +1,68 @@
+import numpy as np
+from numpy.testing import assert_equal
+from gala.mergequeue import MergeQueue
+
+def _queue_example():
+    items = [[w, True, i, i + 1] for i, w in
+             enumerate([0.5, 0.1, 0.9, 0.3, 0.7, 0.2])]
+    return items, MergeQueue(list(items))
+
+def test_pop_order():
+    items, mq = _queue_example()
+    ws = [mq.pop()[0] for i in range(len(items))]
+    assert_equal(ws, sorted(ws))
+    assert_equal([it[1] for it in items], [False] * len(items))
+
+def test_update_and_invalidate():
+    items, mq = _queue_example()
+    mq.update(items[2], 0.0)
+    mq.invalidate(items[1])
+    mq.update(items[5], 0.95)
+    assert_equal(len(mq), 5)
+    assert items[1] not in mq
+    assert_equal([mq.pop()[0] for i in range(5)], [0.0, 0.3, 0.5, 0.7, 0.95])
+    assert_equal((mq.num_updates, mq.num_removals, mq.num_stale_pops),
+                 (2, 1, 0))
+
+def test_stale_items():
+    items, mq = _queue_example()
+    items[1][1] = False
+    assert_equal(mq.peek()[0], 0.2)
+    assert_equal(mq.num_stale_pops, 1)
+    mq.push(items[1])
+    assert_equal(mq.pop()[0], 0.1)
+    assert_equal(len(mq), 5)
+
+def test_empty_through_invalidation():
+    items, mq = _queue_example()
+    for item in items[:3]:
+        mq.invalidate(item)
+    for item in items[3:]:
+        item[1] = False # marked invalid outside of the queue
+    assert_equal(len(mq), 3)
+    assert mq.peek() is None
+    assert_equal(len(mq), 0)
+    assert_equal((mq.num_removals, mq.num_stale_pops), (3, 3))
+    try:
+        mq.pop()
+    except IndexError:
+        pass
+    else:
+        raise AssertionError('pop from empty merge queue')
+
+def test_random_operations():
+    random = np.random.RandomState(0)
+    items, mq = [], MergeQueue()
+    for i in range(200):
+        op = random.randint(3)
+        if op == 0 or len(items) == 0:
+            item = [random.rand(), True, i, i + 1]
+            items.append(item)
+            mq.push(item)
+        elif op == 1:
+            mq.update(items[random.randint(len(items))], random.rand())
+        else:
+            mq.invalidate(items.pop(random.randint(len(items))))
+    assert_equal(len(mq), len(items))
+    ws = [mq.pop()[0] for i in range(len(items))]
+    assert_equal(ws, sorted(it[0] for it in items))
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+
+D = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from gala import classify
+from gala.trainingset import TrainingSet
+
+
+def test_training_set():
+    data = [np.load(D + 'example-data/train-set-%i.npz' % c) for c in [1, 4]]
+    sets = [[d['X'][:, :33], d['y']] for d in data]
+    sets.append([s[:0] for s in sets[0]])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'train.h5')
+        with TrainingSet(fn, names=['features', 'labels']) as ts:
+            for i, s in enumerate(sets[:2]):
+                ts.append(s, name='train-set-%i' % i, channels=[1, 4][i])
+        ts = TrainingSet(fn)
+        ts.append(sets[2], name='empty')
+        expected = classify.concatenate_data_elements(sets)
+        assert_equal(len(ts), len(expected[0]))
+        assert_equal(ts.get_data(), expected)
+        assert_equal([p['size'] for p in ts.provenance()],
+                     [len(s[0]) for s in sets])
+        assert_equal(ts.provenance()[1]['channels'], 4)
+        features = ts.rows('features')
+        assert isinstance(features[1000:1002], np.memmap)
+        idxs = [2000, 3, 1001, 1002, -1]
+        assert_equal(features[idxs], expected[0][idxs])
+        batches = list(ts.iter_batches(500, shuffle=True, random_state=0))
+        assert_equal(map(len, batches[0]), [500, 500])
+        rows = np.concatenate([b[0] for b in batches])
+        assert_equal(sorted(map(tuple, rows)), sorted(map(tuple, expected[0])))
+        X, y = ts.sample(1000, label_column=0, stratified=True)
+        labels = expected[1][:, 0]
+        assert_equal(len(X), 1000)
+        assert_equal((y == 1).sum(),
+                     int(round(1000 * (labels == 1).mean())))
+        ts.close()
+    finally:
+        shutil.rmtree(tmpdir)